@@ -0,0 +1,525 @@
+"""
+Этот модуль содержит асинхронный движок моста на asyncio как альтернативу потокам слушателей.
+Получение обновлений Telegram (getUpdates), Bots Long Poll VK, скачивание и загрузка файлов
+выполняются на одном цикле событий, поэтому медленная загрузка не задерживает остальные сообщения.
+Преобразование сообщений общее с потоковым движком: process_telegram_message и render_message.
+Вызовы API VK идут через общий VkScheduler, сохраняя ограничение частоты и упаковку в execute.
+Отправки в Telegram проходят через TelegramGovernor: сообщения ждут бюджета чата, а после
+ответа 429 повторяются через retry_after секунд.
+Движок экспериментальный: очереди исходящих сообщений, позиций опроса, догрузки пропущенного
+и надзора Supervisor у него нет; сообщения, полученные во время простоя, не пересылаются.
+
+Классы:
+- AsyncBridge(tg_token, routes, vk_scheduler, vk_group_id):
+  Асинхронный мост между парами чатов Telegram и VK из таблицы маршрутов.
+
+Использование:
+- asyncio.run(AsyncBridge(...).run())
+- В run_bot.py движок выбирается переменной окружения BRIDGE_ENGINE=asyncio.
+"""
+
+import asyncio
+import io
+import json
+import logging
+import tempfile
+
+import aiohttp
+import telebot
+from telebot import apihelper
+from telebot.apihelper import ApiException, ApiTelegramException
+from vk_api import VkApiError
+from vk_api.bot_longpoll import VkBotEventType, VkBotLongPoll
+from vk_api.utils import get_random_id
+
+import mediasize
+import transfer
+from namecache import NameCache
+from routing import ChatPair, RoutingTable
+from tggovernor import TelegramGovernor
+from tgvk import VK_MAX_ATTACHMENTS, process_telegram_message, vk_message_media
+from vkscheduler import VkScheduler
+from vktg import get_username, get_usernames, plan_tg_media, render_message
+
+# Максимум одновременно обрабатываемых сообщений в каждом направлении
+MAX_IN_FLIGHT = 32
+# Время ожидания long poll в секундах
+LONG_POLL_WAIT = 25
+# Пауза перед повторным подключением при проблемах с сетью
+NETWORK_RETRY_DELAY = 30
+NETWORK_RETRIES = 10
+# Типы сообщений Telegram, которые пересылаются
+TG_CONTENT_TYPES = ["text", "photo", "audio", "video", "document", "sticker"]
+
+NETWORK_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+
+
+class AsyncBridge:
+    """
+    Асинхронный мост между парами чатов Telegram и VK.
+
+    Параметры:
+        tg_token (str): Токен бота Telegram.
+        routes (RoutingTable): Таблица маршрутов пар чатов.
+        vk_scheduler (VkScheduler): Планировщик вызовов API VK.
+        vk_group_id (int): ID группы VK.
+    """
+
+    def __init__(
+        self,
+        tg_token: str,
+        routes: RoutingTable,
+        vk_scheduler: VkScheduler,
+        vk_group_id: int,
+    ) -> None:
+        # Бот нужен только для преобразования сообщений, запросы он не выполняет
+        self.bot = telebot.TeleBot(tg_token, parse_mode=None)
+        self.routes = routes
+        self.vk_scheduler = vk_scheduler
+        self.vk_group_id = vk_group_id
+        self.name_cache = NameCache(
+            lambda id: get_username(vk_scheduler, id),
+            batch_loader=lambda ids: get_usernames(vk_scheduler, ids),
+        )
+        self.governor = TelegramGovernor()
+        self._http = None
+        self._tails = {}
+        self._tasks = set()
+
+    async def run(self) -> None:
+        """
+        Запускает оба направления и работает, пока они не завершатся.
+        """
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=15, sock_read=120)
+        connector = aiohttp.TCPConnector(limit=100, limit_per_host=16)
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as http:
+            self._http = http
+            listeners = []
+            if any(pair.vk_to_tg for pair in self.routes.pairs):
+                for pair in self.routes.pairs:
+                    if pair.vk_to_tg:
+                        await asyncio.get_running_loop().run_in_executor(
+                            None, self.name_cache.warm, self.vk_scheduler, pair.vk_chat_id
+                        )
+                listeners.append(self._listen(self._poll_vk))
+            if any(pair.tg_to_vk for pair in self.routes.pairs):
+                listeners.append(self._listen(self._poll_telegram))
+            await asyncio.gather(*listeners)
+
+    # --- Общие вызовы API ---
+
+    async def _vk_call(self, method: str, **values) -> dict:
+        """
+        Вызывает метод API VK через общий планировщик, не блокируя цикл событий.
+        """
+        return await asyncio.wrap_future(self.vk_scheduler.submit(method, values))
+
+    async def _tg_call(self, method: str, params: dict = None, **request) -> dict:
+        """
+        Вызывает метод Bot API Telegram.
+
+        Параметры:
+            method (str): Название метода, например sendMessage.
+            params (dict): Параметры, передаются как JSON.
+            **request: Другие аргументы запроса aiohttp (data, headers, timeout).
+
+        Возвращает:
+            dict - поле result ответа
+        """
+        if apihelper.API_URL is None:
+            url = f"https://api.telegram.org/bot{self.bot.token}/{method}"
+        else:
+            url = apihelper.API_URL.format(self.bot.token, method)
+        if params is not None:
+            request["json"] = params
+        async with self._http.post(url, **request) as response:
+            result_json = await response.json(content_type=None)
+        if not result_json.get("ok"):
+            raise ApiTelegramException(method, response, result_json)
+        return result_json["result"]
+
+    async def _tg_send(self, tg_chat_id: int, cost: int, send) -> None:
+        """
+        Отправляет в чат Telegram с учётом бюджетов регулятора частоты. После ответа 429
+        отправка повторяется через retry_after секунд, сообщение не теряется.
+
+        Параметры:
+            tg_chat_id (int): ID чата Telegram.
+            cost (int): Количество сообщений (элементов медиагруппы).
+            send: Функция без аргументов, возвращающая корутину отправки.
+        """
+        while True:
+            wait = self.governor.reserve(tg_chat_id, cost)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            try:
+                await send()
+            except ApiTelegramException as error:
+                if error.error_code != 429:
+                    raise
+                await asyncio.sleep(self.governor.throttled(tg_chat_id, error))
+                continue
+            self.governor.succeeded(tg_chat_id)
+            return
+
+    def _tg_file_url(self, file_path: str) -> str:
+        if apihelper.FILE_URL is None:
+            return f"https://api.telegram.org/file/bot{self.bot.token}/{file_path}"
+        return apihelper.FILE_URL.format(self.bot.token, file_path)
+
+    async def _listen(self, poll) -> None:
+        """
+        Повторяет цикл получения обновлений при проблемах с сетью.
+        """
+        retries = 0
+        while retries < NETWORK_RETRIES:
+            try:
+                await poll()
+            except NETWORK_ERRORS:
+                logging.warning("Проблемы сетью, попытка повторного подключения....")
+                await asyncio.sleep(NETWORK_RETRY_DELAY)
+                retries += 1
+
+    def _dispatch(self, chat: tuple, handler, message, pair: ChatPair) -> None:
+        """
+        Запускает обработку сообщения как отдельную задачу.
+        Подготовка (скачивание и загрузка) идёт параллельно, а отправка ждёт
+        отправки предыдущего сообщения из того же чата.
+        """
+        loop = asyncio.get_running_loop()
+        previous = self._tails.get(chat)
+        done = loop.create_future()
+        self._tails[chat] = done
+        done.add_done_callback(
+            lambda _: self._tails.pop(chat) if self._tails.get(chat) is done else None
+        )
+        task = loop.create_task(handler(message, pair, previous, done))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    @staticmethod
+    async def _wait_turn(previous) -> None:
+        if previous is not None:
+            await asyncio.shield(previous)
+
+    # --- Telegram -> VK ---
+
+    async def _poll_telegram(self) -> None:
+        """
+        Получает обновления Telegram через getUpdates, пропуская накопившиеся до запуска.
+        """
+        semaphore = asyncio.Semaphore(MAX_IN_FLIGHT)
+        pending = await self._tg_call("getUpdates", {"offset": -1, "timeout": 0})
+        offset = pending[-1]["update_id"] + 1 if pending else None
+        while True:
+            updates = await self._tg_call(
+                "getUpdates",
+                {
+                    "offset": offset,
+                    "timeout": LONG_POLL_WAIT,
+                    "allowed_updates": ["message"],
+                },
+                timeout=aiohttp.ClientTimeout(total=LONG_POLL_WAIT + 10),
+            )
+            for update in updates:
+                offset = update["update_id"] + 1
+                message = telebot.types.Update.de_json(update).message
+                if (
+                    message is None
+                    or message.chat.type != "group"
+                    or message.content_type not in TG_CONTENT_TYPES
+                ):
+                    continue
+                pair = self.routes.for_telegram(message.chat.id)
+                if pair is not None:
+                    await semaphore.acquire()
+                    self._dispatch(
+                        ("tg", pair.tg_chat_id),
+                        self._guarded(semaphore, self._handle_telegram),
+                        message,
+                        pair,
+                    )
+
+    @staticmethod
+    def _guarded(semaphore: asyncio.Semaphore, handler):
+        async def run(message, pair, previous, done):
+            try:
+                await handler(message, pair, previous, done)
+            finally:
+                semaphore.release()
+
+        return run
+
+    async def _handle_telegram(self, message, pair: ChatPair, previous, done) -> None:
+        vk_chat_id = pair.vk_chat_id
+        try:
+            vk_message = process_telegram_message(self.bot, message)
+            # Все вложения загружаются сразу, параллельно друг с другом и с предыдущими сообщениями
+            uploads = [
+                asyncio.ensure_future(self._upload_vk_attachment(key, file, vk_chat_id))
+                for key, file in vk_message_media(vk_message)
+            ]
+            try:
+                await self._wait_turn(previous)
+                # Текст и вложения уходят одним сообщением, не больше VK_MAX_ATTACHMENTS вложений в каждом
+                text = vk_message.get("text")
+                for start in range(0, max(len(uploads), 1), VK_MAX_ATTACHMENTS):
+                    values = {"message": text} if text and start == 0 else {}
+                    chunk = uploads[start : start + VK_MAX_ATTACHMENTS]
+                    if chunk:
+                        values["attachment"] = ",".join(await asyncio.gather(*chunk))
+                    if values:
+                        await self._send_vk(vk_chat_id, **values)
+            finally:
+                for upload in uploads:
+                    upload.cancel()
+        except (VkApiError, ApiException) as error:
+            try:
+                await self._send_vk(vk_chat_id, message=f"ERROR: {error}")
+            except Exception:
+                logging.error(
+                    f"Невозможно доставить сообщение об ошибке пользователю. Тип ошибки: {type(error)}, Описание: {error}"
+                )
+        except Exception as e:
+            logging.error(f"Непредвиденная ошибка: {e}")
+        finally:
+            done.set_result(None)
+
+    async def _send_vk(self, vk_chat_id: int, **values) -> None:
+        await self._vk_call(
+            "messages.send", peer_id=vk_chat_id, random_id=get_random_id(), **values
+        )
+
+    async def _upload_vk_attachment(
+        self, key: str, document: transfer.TelegramFile, vk_chat_id: int
+    ) -> str:
+        """
+        Скачивает файл из Telegram и загружает его в VK.
+
+        Возвращает:
+            str - строка вложения VK
+        """
+        file_info = await self._tg_call("getFile", {"file_id": document.file_id})
+        file_url = self._tg_file_url(file_info["file_path"])
+        if key.endswith("photo"):
+            server = await self._vk_call(
+                "photos.getMessagesUploadServer", peer_id=vk_chat_id
+            )
+            async with self._http.get(file_url) as source:
+                source.raise_for_status()
+                photo = io.BytesIO(await source.read())
+            photo.name = document.file_name
+            # Пережатие идёт в пуле процессов, цикл событий только ждёт результат
+            photo = await asyncio.get_running_loop().run_in_executor(
+                None, mediasize.fit_photo, photo, mediasize.VK_PHOTO_LIMIT
+            )
+            form = aiohttp.FormData()
+            form.add_field("photo", photo.getvalue(), filename=photo.name)
+            async with self._http.post(server["upload_url"], data=form) as response:
+                uploaded = await response.json(content_type=None)
+            photo_info = (await self._vk_call("photos.saveMessagesPhoto", **uploaded))[0]
+            return f"photo{photo_info['owner_id']}_{photo_info['id']}"
+
+        server = await self._vk_call(
+            "docs.getMessagesUploadServer", type="doc", peer_id=vk_chat_id
+        )
+        uploaded = await self._post_streamed(
+            server["upload_url"],
+            {},
+            [("file", document.file_name, file_url, file_info.get("file_size"))],
+        )
+        if "file" not in uploaded:
+            raise VkApiError(f"Ошибка загрузки документа: {uploaded.get('error', uploaded)}")
+        doc_info = await self._vk_call(
+            "docs.save", file=uploaded["file"], title=document.file_name
+        )
+        return f"doc{doc_info['doc']['owner_id']}_{doc_info['doc']['id']}"
+
+    # --- Потоковая передача ---
+
+    async def _spool(self, url: str) -> tuple:
+        """
+        Скачивает файл неизвестного размера во временный файл.
+
+        Возвращает:
+            tuple - (файловый объект, размер в байтах)
+        """
+        spooled = tempfile.SpooledTemporaryFile(max_size=transfer.SPOOL_MEMORY_LIMIT)
+        async with self._http.get(url, headers={"Accept-Encoding": "identity"}) as source:
+            source.raise_for_status()
+            async for chunk in source.content.iter_chunked(transfer.CHUNK_SIZE):
+                spooled.write(chunk)
+        size = spooled.tell()
+        spooled.seek(0)
+        return spooled, size
+
+    async def _post_streamed(self, url: str, fields: dict, files: list, **request) -> dict:
+        """
+        Отправляет multipart-запрос, передавая файлы по ссылкам потоком без буферизации.
+
+        Параметры:
+            url (str): Адрес запроса.
+            fields (dict): Текстовые поля формы.
+            files (list): Кортежи (имя поля, имя файла, ссылка на источник, размер или None).
+
+        Возвращает:
+            dict - ответ в формате JSON
+        """
+        prepared = []
+        for name, file_name, source_url, size in files:
+            if not size:
+                # Без размера нельзя посчитать Content-Length, поэтому файл сбрасывается на диск
+                source_url, size = await self._spool(source_url)
+            prepared.append((name, file_name, source_url, size))
+        content_type, parts = transfer.build_multipart(fields, prepared)
+
+        async def body():
+            for part in parts:
+                if isinstance(part, bytes):
+                    yield part
+                    continue
+                source, size = part
+                if not isinstance(source, str):
+                    with source:
+                        while chunk := source.read(transfer.CHUNK_SIZE):
+                            yield chunk
+                    continue
+                async with self._http.get(
+                    source, headers={"Accept-Encoding": "identity"}
+                ) as response:
+                    response.raise_for_status()
+                    remaining = size
+                    while remaining:
+                        chunk = await response.content.read(
+                            min(transfer.CHUNK_SIZE, remaining)
+                        )
+                        if not chunk:
+                            raise IOError("Источник файла оказался короче заявленного размера")
+                        remaining -= len(chunk)
+                        yield chunk
+
+        headers = {
+            "Content-Type": content_type,
+            "Content-Length": str(transfer.multipart_length(parts)),
+        }
+        async with self._http.post(url, data=body(), headers=headers, **request) as response:
+            return await response.json(content_type=None)
+
+    # --- VK -> Telegram ---
+
+    async def _poll_vk(self) -> None:
+        """
+        Получает события Bots Long Poll VK.
+        """
+        semaphore = asyncio.Semaphore(MAX_IN_FLIGHT)
+        server = await self._vk_call("groups.getLongPollServer", group_id=self.vk_group_id)
+        ts = server["ts"]
+        while True:
+            async with self._http.get(
+                server["server"],
+                params={"act": "a_check", "key": server["key"], "ts": ts, "wait": LONG_POLL_WAIT},
+                timeout=aiohttp.ClientTimeout(total=LONG_POLL_WAIT + 10),
+            ) as response:
+                result = await response.json(content_type=None)
+            if "failed" in result:
+                if result["failed"] == 1:
+                    ts = result["ts"]
+                else:
+                    fresh = await self._vk_call(
+                        "groups.getLongPollServer", group_id=self.vk_group_id
+                    )
+                    server["key"], server["server"] = fresh["key"], fresh["server"]
+                    if result["failed"] == 3:
+                        ts = fresh["ts"]
+                continue
+            ts = result["ts"]
+            for raw_event in result["updates"]:
+                event_class = VkBotLongPoll.CLASS_BY_EVENT_TYPE.get(
+                    raw_event["type"], VkBotLongPoll.DEFAULT_EVENT_CLASS
+                )
+                event = event_class(raw_event)
+                if event.type != VkBotEventType.MESSAGE_NEW:
+                    continue
+                pair = self.routes.for_vk(event.object.message["peer_id"])
+                if pair is not None:
+                    await semaphore.acquire()
+                    self._dispatch(
+                        ("vk", pair.vk_chat_id),
+                        self._guarded(semaphore, self._handle_vk),
+                        event.message,
+                        pair,
+                    )
+
+    async def _handle_vk(self, message, pair: ChatPair, previous, done) -> None:
+        tg_chat_id = pair.tg_chat_id
+        try:
+            # Имена берутся из кэша; промах кэша - блокирующий вызов, поэтому в пуле потоков
+            text, media_dict = await asyncio.get_running_loop().run_in_executor(
+                None, render_message, message, self.name_cache
+            )
+            texts, groups = plan_tg_media(media_dict, text)
+            await self._wait_turn(previous)
+            for text in texts:
+                params = {"chat_id": tg_chat_id, "text": text}
+                await self._tg_send(tg_chat_id, 1, lambda: self._tg_call("sendMessage", params))
+            for kind, items, caption in groups:
+                if kind == "doc":
+                    await self._tg_send(
+                        tg_chat_id,
+                        len(items),
+                        lambda: self._send_tg_documents(tg_chat_id, items, caption),
+                    )
+                elif len(items) == 1:
+                    params = {"chat_id": tg_chat_id, "photo": items[0].media}
+                    if caption:
+                        params["caption"] = caption
+                    await self._tg_send(tg_chat_id, 1, lambda: self._tg_call("sendPhoto", params))
+                else:
+                    items[0].caption = caption
+                    params = {"chat_id": tg_chat_id, "media": [item.to_dict() for item in items]}
+                    await self._tg_send(
+                        tg_chat_id, len(items), lambda: self._tg_call("sendMediaGroup", params)
+                    )
+        except (VkApiError, ApiException) as error:
+            try:
+                params = {"chat_id": tg_chat_id, "text": f"ERROR: {error}"}
+                await self._tg_send(tg_chat_id, 1, lambda: self._tg_call("sendMessage", params))
+            except Exception:
+                logging.error(
+                    f"Невозможно доставить сообщение об ошибке пользователю. Тип ошибки: {type(error)}, Описание: {error}"
+                )
+        except Exception as e:
+            logging.error(f"Непредвиденная ошибка: {e}, {type(e)}")
+        finally:
+            done.set_result(None)
+
+    async def _send_tg_documents(
+        self, tg_chat_id: int, documents: list, caption: str = None
+    ) -> None:
+        """
+        Потоково отправляет документы VK в Telegram одним запросом.
+        """
+        files = [
+            (f"file{number}", document.title, document.url, document.size)
+            for number, document in enumerate(documents)
+        ]
+        fields = {"chat_id": tg_chat_id}
+        method = "sendMediaGroup"
+        if len(files) > 1:
+            media = [{"type": "document", "media": f"attach://{file[0]}"} for file in files]
+            if caption:
+                media[0]["caption"] = caption
+            fields["media"] = json.dumps(media)
+        else:
+            method = "sendDocument"
+            if caption:
+                fields["caption"] = caption
+            files[0] = ("document",) + files[0][1:]
+        if apihelper.API_URL is None:
+            url = f"https://api.telegram.org/bot{self.bot.token}/{method}"
+        else:
+            url = apihelper.API_URL.format(self.bot.token, method)
+        result_json = await self._post_streamed(url, fields, files)
+        if not result_json.get("ok"):
+            raise ApiTelegramException(method, None, result_json)
@@ -0,0 +1,118 @@
+"""
+Этот модуль содержит сборщик альбомов Telegram.
+Каждое фото альбома приходит отдельным обновлением с общим media_group_id. Сборщик держит
+такие обновления короткое окно времени и выдаёт альбом одним списком, чтобы он ушёл в VK
+одним сообщением. Пока в чате собирается альбом, остальные сообщения этого чата тоже
+задерживаются, чтобы не обогнать альбом.
+
+Классы:
+- AlbumCollector(emit, window):
+  Сборщик альбомов. emit(messages, done) вызывается для каждого альбома или одиночного сообщения.
+
+Использование:
+- collector.add(message, done) для каждого сообщения Telegram. done передаётся в emit вместе
+  с сообщением (для альбома - одна функция на все его сообщения), чтобы позиция опроса
+  сохранялась только после записи сообщения в журнал.
+"""
+
+import threading
+from typing import Callable
+
+# Сколько ждать следующее фото альбома после предыдущего, в секундах
+ALBUM_WINDOW = 1.0
+
+
+class AlbumCollector:
+    """
+    Сборщик альбомов Telegram.
+
+    Параметры:
+        emit (Callable[[list, Callable], None]): Получает список сообщений (альбом или одно
+            сообщение) и функцию подтверждения их записи в журнал или None.
+        window (float): Окно ожидания следующего сообщения альбома в секундах.
+    """
+
+    def __init__(self, emit: Callable[[list, Callable], None], window: float = ALBUM_WINDOW) -> None:
+        self._emit = emit
+        self._window = window
+        # id чата -> [(сообщение, подтверждение), метка]
+        self._buffers = {}
+        self._timers = {}
+        # Общая блокировка защищает только буферы; выдача идёт под блокировкой чата,
+        # чтобы одиночное сообщение не обогнало альбом, который выдаётся по таймеру,
+        # а запись в очередь одного чата не задерживала остальные
+        self._lock = threading.Lock()
+        self._chat_locks = {}
+
+    def add(self, message, done: Callable[[], None] = None) -> None:
+        """
+        Принимает сообщение Telegram.
+
+        Параметры:
+            message: Объект сообщения телеграм.
+            done (Callable): Вызывается, когда сообщение записано в журнал.
+
+        Возвращает:
+            None
+        """
+        chat_id = message.chat.id
+        with self._chat_lock(chat_id):
+            with self._lock:
+                buffer = self._buffers.get(chat_id)
+                if buffer is None and not message.media_group_id:
+                    emit = True
+                else:
+                    emit = False
+                    if buffer is None:
+                        buffer = self._buffers[chat_id] = [[], None]
+                    buffer[0].append((message, done))
+                    # Окно отсчитывается от последнего сообщения; метка не даёт запоздавшему
+                    # таймеру выдать альбом, в который только что добавилось сообщение
+                    buffer[1] = token = object()
+                    if chat_id in self._timers:
+                        self._timers[chat_id].cancel()
+                    timer = threading.Timer(self._window, self._flush, args=(chat_id, token))
+                    timer.daemon = True
+                    self._timers[chat_id] = timer
+                    timer.start()
+            if emit:
+                self._emit([message], done)
+
+    def _chat_lock(self, chat_id: int) -> threading.Lock:
+        with self._lock:
+            lock = self._chat_locks.get(chat_id)
+            if lock is None:
+                lock = self._chat_locks[chat_id] = threading.Lock()
+            return lock
+
+    def _flush(self, chat_id: int, token: object) -> None:
+        """
+        Выдаёт накопленные сообщения чата: альбомы целиком, остальные по одному.
+        """
+        with self._chat_lock(chat_id):
+            with self._lock:
+                buffer = self._buffers.get(chat_id)
+                if buffer is None or buffer[1] is not token:
+                    return
+                del self._buffers[chat_id]
+                self._timers.pop(chat_id, None)
+            group = []
+            for message, done in buffer[0]:
+                if group and message.media_group_id != group[0][0].media_group_id:
+                    self._emit_group(group)
+                    group = []
+                if message.media_group_id:
+                    group.append((message, done))
+                else:
+                    self._emit([message], done)
+            if group:
+                self._emit_group(group)
+
+    def _emit_group(self, group: list) -> None:
+        dones = [done for _, done in group if done is not None]
+
+        def done():
+            for item in dones:
+                item()
+
+        self._emit([message for message, _ in group], done if dones else None)
@@ -0,0 +1,132 @@
+"""
+Этот модуль содержит продолжение опроса VK после перезапуска и догрузку пропущенных сообщений.
+Позиция Bots Long Poll (ts) хранится в журнале очереди исходящих сообщений, и после перезапуска
+опрос продолжается с неё. Если сервер VK сообщает, что события с этой позиции уже потеряны,
+пропущенные сообщения забираются через messages.getHistory, начиная после последнего
+пересланного сообщения беседы. Несколько страниц истории запрашиваются сразу и уходят одним
+запросом execute, поэтому догрузка идёт быстро, но в пределах ограничения частоты VK.
+
+Классы:
+- ResumableLongPoll(vk, group_id, ts, wait):
+  Bots Long Poll, который начинает с сохранённой позиции и сообщает о потерянных событиях.
+
+Функции:
+- fetch_missed(vk_scheduler, peer_id, last_id, group_id):
+  Возвращает сообщения беседы после last_id в порядке отправки.
+
+Использование:
+- longpoll = ResumableLongPoll(vk_session, group_id, outbox.get_cursor("vk:ts"))
+- events = longpoll.check(); если longpoll.lost - догрузите историю через fetch_missed.
+- После записи событий в журнал сохраните longpoll.ts.
+"""
+
+import logging
+
+from vk_api.bot_longpoll import VkBotLongPoll
+
+from vkscheduler import VkScheduler
+
+# Количество сообщений на странице messages.getHistory (максимум VK)
+HISTORY_PAGE_SIZE = 200
+# Сколько страниц истории запрашивается сразу (одним запросом execute)
+HISTORY_PAGES_PER_CALL = 5
+# Максимальное количество догружаемых сообщений одной беседы
+BACKFILL_LIMIT = 5000
+
+
+class ResumableLongPoll(VkBotLongPoll):
+    """
+    Bots Long Poll VK, который продолжает опрос с сохранённой позиции.
+    Атрибут lost становится True, если сервер сообщил о потере событий (позиция устарела
+    или истёк ключ); после догрузки истории его нужно сбросить.
+
+    Параметры:
+        vk: Сессия vk_api.VkApi.
+        group_id (int): ID группы VK.
+        ts (str): Сохранённая позиция или None, чтобы начать с текущей.
+        wait (int): Время ожидания long poll в секундах.
+    """
+
+    __slots__ = ("lost",)
+
+    def __init__(self, vk, group_id: int, ts: str = None, wait: int = 25) -> None:
+        self.lost = False
+        super().__init__(vk, group_id, wait)
+        if ts is not None:
+            self.ts = ts
+
+    def check(self) -> list:
+        """
+        Получает события от сервера один раз.
+
+        Возвращает:
+            list - события
+        """
+        response = self.session.get(
+            self.url,
+            params={"act": "a_check", "key": self.key, "ts": self.ts, "wait": self.wait},
+            timeout=self.wait + 10,
+        ).json()
+        if "failed" not in response:
+            self.ts = response["ts"]
+            return [self._parse_event(raw_event) for raw_event in response["updates"]]
+        # 1 - история событий устарела, 3 - потеряна информация о пользователе: события пропущены
+        if response["failed"] == 1:
+            self.lost = True
+            self.ts = response["ts"]
+        elif response["failed"] == 2:
+            self.update_longpoll_server(update_ts=False)
+        else:
+            self.lost = True
+            self.update_longpoll_server()
+        return []
+
+
+def fetch_missed(vk_scheduler: VkScheduler, peer_id: int, last_id: int, group_id: int) -> list:
+    """
+    Возвращает сообщения беседы, отправленные после сообщения last_id, в порядке отправки.
+    Собственные сообщения сообщества (пересланные из Telegram) пропускаются.
+
+    Параметры:
+        vk_scheduler (VkScheduler): Планировщик вызовов API VK.
+        peer_id (int): ID беседы VK.
+        last_id (int): conversation_message_id последнего пересланного сообщения.
+        group_id (int): ID группы VK.
+
+    Возвращает:
+        list - сообщения в формате события message_new
+    """
+    missed = []
+    offset = 0
+    while len(missed) < BACKFILL_LIMIT:
+        # Страницы отправляются вместе, планировщик упаковывает их в один execute
+        pages = [
+            vk_scheduler.submit(
+                "messages.getHistory",
+                {
+                    "peer_id": peer_id,
+                    "offset": offset + number * HISTORY_PAGE_SIZE,
+                    "count": HISTORY_PAGE_SIZE,
+                },
+            )
+            for number in range(HISTORY_PAGES_PER_CALL)
+        ]
+        offset += HISTORY_PAGES_PER_CALL * HISTORY_PAGE_SIZE
+        for page in pages:
+            items = page.result()["items"]
+            for item in items:
+                # История идёт от новых сообщений к старым
+                if item["conversation_message_id"] <= last_id:
+                    return _in_order(missed)
+                if item["from_id"] != -group_id:
+                    missed.append(item)
+            if len(items) < HISTORY_PAGE_SIZE:
+                return _in_order(missed)
+    logging.warning(
+        f"В беседе {peer_id} пропущено больше {BACKFILL_LIMIT} сообщений, догружены последние"
+    )
+    return _in_order(missed[:BACKFILL_LIMIT])
+
+
+def _in_order(messages: list) -> list:
+    return sorted(messages, key=lambda message: message["conversation_message_id"])
@@ -0,0 +1,564 @@
+"""
+Этот модуль содержит нагрузочный тест моста на локальных заглушках API Telegram и VK.
+Заглушки поднимаются HTTP-сервером в том же процессе: Bot API Telegram (getUpdates, getFile,
+скачивание файлов, sendMessage, sendPhoto, sendMediaGroup, sendDocument) и API VK (Bots Long
+Poll, messages.send, execute, серверы загрузки, users.get, groups.getById). Telegram
+перенаправляется на заглушку через apihelper.API_URL и FILE_URL, VK - адаптером общей
+HTTP-сессии, который переписывает адрес https://api.vk.com. Настоящие listen_telegram и
+listen_vk работают с заглушками без изменений, поэтому измеряется весь путь сообщения.
+
+Каждое синтетическое сообщение должно давать ровно одну отправку в принимающий мессенджер
+(текст с вложениями до 10 штук уходит одним запросом), а склейка сообщений выключена; тогда
+k-я отправка соответствует k-му сообщению и задержка считается точно.
+
+С флагом --tg-limit заглушка Telegram отвечает 429 Too Many Requests (retry_after 1 с), если
+в чат отправлено больше указанного количества сообщений за секунду; так проверяется, что
+регулятор частоты отправки не теряет сообщения.
+
+С флагом --webhook мост принимает обновления Telegram через webhook: заглушка запоминает
+адрес и секретный токен из setWebhook и отправляет туда обновления POST-запросами.
+
+Отчёт: сообщений в секунду, задержка p50/p99 по направлениям, вызовов API на сообщение
+(по методам) и пиковый RSS процесса (вместе с заглушками).
+
+Использование:
+- python benchmark.py --messages 500 --rate 50 --photo-ratio 0.3 --media-size 200000 --depth 2
+"""
+
+import argparse
+import email.parser
+import json
+import logging
+import os
+import queue
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+import vk_api
+from requests.adapters import HTTPAdapter
+from telebot import apihelper
+
+import httppool
+from mediacache import MediaCache
+from messagemap import MessageMap
+from outbox import Outbox
+from routing import RoutingTable
+from tggovernor import TelegramGovernor
+from tgvk import listen_telegram
+from vkscheduler import VK_API_VERSION, VkScheduler
+from vktg import listen_vk
+from webhook import WebhookConfig
+
+TG_TOKEN = "123456:BENCHMARK"
+VK_GROUP_ID = 1
+TG_CHAT_ID = -1001
+VK_CHAT_ID = 2000000001
+# Отправки, которыми сообщение доставляется в принимающий мессенджер
+TG_DELIVERY_METHODS = {"sendMessage", "sendPhoto", "sendMediaGroup", "sendDocument"}
+VK_DELIVERY_METHODS = {"messages.send"}
+
+
+class FakeApi:
+    """
+    Состояние заглушек: очереди входящих обновлений, счётчики вызовов и время доставки.
+
+    Параметры:
+        media_size (int): Размер скачиваемых файлов в байтах.
+        tg_limit (int): Сообщений в секунду, после которых Telegram отвечает 429; 0 - без ограничения.
+    """
+
+    def __init__(self, media_size: int, tg_limit: int = 0) -> None:
+        self.base_url = None
+        self.tg_limit = tg_limit
+        self._tg_sent = deque()  # время отправок в Telegram за последнюю секунду
+        self.media = os.urandom(media_size)
+        self.calls = Counter()  # HTTP-запросы к заглушкам
+        self.batched = Counter()  # вызовы VK внутри execute
+        self.tg_updates = []
+        self.vk_events = []
+        self.injected = {"tg_to_vk": [], "vk_to_tg": []}
+        self.delivered = {"tg_to_vk": [], "vk_to_tg": []}
+        self.tg_polling = threading.Event()
+        self.vk_polling = threading.Event()
+        self.webhook = None  # (адрес, секретный токен) из setWebhook
+        self._webhook_updates = queue.Queue()
+        self._ids = Counter()
+        self._changed = threading.Condition()
+
+    def next_id(self, name: str) -> int:
+        with self._changed:
+            self._ids[name] += 1
+            return self._ids[name]
+
+    def inject_telegram(self, message: dict) -> None:
+        with self._changed:
+            update_id = len(self.tg_updates) + 1
+            message["message_id"] = update_id
+            self.tg_updates.append({"update_id": update_id, "message": message})
+            self.injected["tg_to_vk"].append(time.perf_counter())
+            self._changed.notify_all()
+        if self.webhook is not None:
+            self._webhook_updates.put(self.tg_updates[update_id - 1])
+
+    def push_webhook(self) -> None:
+        """
+        Отправляет обновления на webhook моста по порядку, как это делает Telegram.
+        """
+        url, secret = self.webhook
+        with requests.Session() as session:
+            while True:
+                update = self._webhook_updates.get()
+                while True:
+                    response = session.post(
+                        url, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": secret}
+                    )
+                    if response.status_code == 200:
+                        break
+                    time.sleep(0.1)
+
+    def inject_vk(self, message: dict) -> None:
+        with self._changed:
+            message["conversation_message_id"] = len(self.vk_events) + 1
+            self.vk_events.append(
+                {
+                    "type": "message_new",
+                    "object": {"message": message, "client_info": {}},
+                    "group_id": VK_GROUP_ID,
+                    "event_id": str(len(self.vk_events)),
+                }
+            )
+            self.injected["vk_to_tg"].append(time.perf_counter())
+            self._changed.notify_all()
+
+    def deliver(self, direction: str) -> None:
+        with self._changed:
+            self.delivered[direction].append(time.perf_counter())
+            self._changed.notify_all()
+
+    def tg_flooded(self, method: str, params: dict) -> bool:
+        """
+        Проверяет ограничение частоты отправки в Telegram; медиагруппа - по количеству элементов.
+        """
+        if not self.tg_limit or method not in TG_DELIVERY_METHODS:
+            return False
+        count = len(json.loads(params["media"])) if method == "sendMediaGroup" else 1
+        with self._changed:
+            now = time.monotonic()
+            while self._tg_sent and self._tg_sent[0] < now - 1:
+                self._tg_sent.popleft()
+            if len(self._tg_sent) + count > self.tg_limit:
+                return True
+            self._tg_sent.extend([now] * count)
+            return False
+
+    def wait_updates(self, events: list, start: int, timeout: float) -> list:
+        """
+        Длинный опрос: ждёт событий с номером не меньше start.
+        """
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while len(events) <= start and time.monotonic() < deadline:
+                self._changed.wait(deadline - time.monotonic())
+            return events[start:]
+
+    def wait_delivered(self, counts: dict, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while time.monotonic() < deadline:
+                if all(len(self.delivered[key]) >= count for key, count in counts.items()):
+                    return True
+                self._changed.wait(deadline - time.monotonic())
+        return False
+
+    # Ответы Bot API Telegram
+
+    def tg_message(self, **fields) -> dict:
+        return {
+            "message_id": self.next_id("tg_message"),
+            "date": int(time.time()),
+            "chat": {"id": TG_CHAT_ID, "type": "group"},
+            **fields,
+        }
+
+    def tg_photo(self) -> list:
+        number = self.next_id("tg_file")
+        return [
+            {
+                "file_id": f"sent{number}",
+                "file_unique_id": f"sent-unique{number}",
+                "width": 1280,
+                "height": 960,
+            }
+        ]
+
+    def telegram(self, method: str, params: dict):
+        if method == "getUpdates":
+            offset = int(params.get("offset") or 0)
+            if offset == -1:
+                return self.tg_updates[-1:]
+            self.tg_polling.set()
+            return self.wait_updates(
+                self.tg_updates, max(offset - 1, 0), min(float(params.get("timeout") or 0), 1.0)
+            )
+        if method == "setWebhook" and params.get("url"):
+            self.webhook = (params["url"], params["secret_token"])
+            threading.Thread(target=self.push_webhook, daemon=True).start()
+            self.tg_polling.set()
+            return True
+        if method in ("setWebhook", "deleteWebhook"):
+            return True
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Benchmark", "username": "bench_bot"}
+        if method == "getFile":
+            return {
+                "file_id": params["file_id"],
+                "file_unique_id": f"unique-{params['file_id']}",
+                "file_size": len(self.media),
+                "file_path": f"photos/{params['file_id']}.jpg",
+            }
+        if method in TG_DELIVERY_METHODS:
+            self.deliver("vk_to_tg")
+        if method == "sendMediaGroup":
+            media = json.loads(params["media"])
+            if media[0]["type"] == "document":
+                return [self.tg_message(document=self.tg_photo()[0]) for _ in media]
+            return [self.tg_message(photo=self.tg_photo()) for _ in media]
+        if method == "sendPhoto":
+            return self.tg_message(photo=self.tg_photo())
+        if method == "sendDocument":
+            return self.tg_message(document=self.tg_photo()[0])
+        return self.tg_message(text=params.get("text", ""))
+
+    # Ответы API VK
+
+    def vk(self, method: str, params: dict):
+        if method == "execute":
+            calls = parse_execute(params["code"])
+            self.batched.update(name for name, _ in calls)
+            return [self.vk(name, values) for name, values in calls]
+        if method in VK_DELIVERY_METHODS:
+            self.deliver("tg_to_vk")
+            if "peer_ids" in params:
+                return [
+                    {
+                        "peer_id": int(params["peer_ids"]),
+                        "message_id": 0,
+                        "conversation_message_id": self.next_id("vk_message"),
+                    }
+                ]
+            return self.next_id("vk_message")
+        if method == "groups.getLongPollServer":
+            return {"key": "key", "server": f"{self.base_url}/vk/longpoll", "ts": "0"}
+        if method == "messages.getConversationMembers":
+            return {"items": [], "profiles": [], "groups": []}
+        if method == "users.get":
+            return [
+                {"id": int(user_id), "first_name": "User", "last_name": str(user_id)}
+                for user_id in str(params.get("user_ids", "1")).split(",")
+            ]
+        if method == "groups.getById":
+            return [{"id": VK_GROUP_ID, "name": "Benchmark"}]
+        if method in ("photos.getMessagesUploadServer", "docs.getMessagesUploadServer"):
+            return {"upload_url": f"{self.base_url}/vk/upload"}
+        if method == "photos.saveMessagesPhoto":
+            return [{"id": self.next_id("vk_photo"), "owner_id": -VK_GROUP_ID}]
+        if method == "docs.save":
+            return {"type": "doc", "doc": {"id": self.next_id("vk_doc"), "owner_id": -VK_GROUP_ID}}
+        return 1
+
+
+def parse_execute(code: str) -> list:
+    """
+    Разбирает код execute, собранный планировщиком: return [API.метод({...}),...];
+    """
+    decoder = json.JSONDecoder()
+    calls = []
+    for match in re.finditer(r"API\.([\w.]+)\(", code):
+        values, _ = decoder.raw_decode(code, match.end())
+        calls.append((match.group(1), values))
+    return calls
+
+
+def parse_params(handler: BaseHTTPRequestHandler, body: bytes) -> dict:
+    """
+    Собирает параметры запроса из строки запроса и тела (form, JSON или multipart).
+    """
+    params = {key: values[0] for key, values in parse_qs(urlsplit(handler.path).query).items()}
+    content_type = handler.headers.get("Content-Type", "")
+    if content_type.startswith("application/x-www-form-urlencoded"):
+        params.update({key: values[0] for key, values in parse_qs(body.decode()).items()})
+    elif content_type.startswith("application/json"):
+        params.update(json.loads(body))
+    elif content_type.startswith("multipart/form-data"):
+        message = email.parser.BytesParser().parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + body
+        )
+        for part in message.get_payload():
+            if part.get_filename() is None:
+                params[part.get_param("name", header="content-disposition")] = part.get_payload()
+    return params
+
+
+def make_handler(fake: FakeApi) -> type:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format: str, *args) -> None:
+            pass
+
+        def reply(self, payload, content_type: str = "application/json") -> None:
+            body = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def handle_request(self) -> None:
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length) if length else b""
+            path = urlsplit(self.path).path.strip("/").split("/")
+            params = parse_params(self, body)
+            if path[0] == "file":
+                fake.calls["tg:file"] += 1
+                self.reply(fake.media, "application/octet-stream")
+            elif path[0].startswith("bot") and fake.tg_flooded(path[1], params):
+                fake.calls["tg:429"] += 1
+                self.reply(
+                    {
+                        "ok": False,
+                        "error_code": 429,
+                        "description": "Too Many Requests: retry after 1",
+                        "parameters": {"retry_after": 1},
+                    }
+                )
+            elif path[0].startswith("bot"):
+                fake.calls[f"tg:{path[1]}"] += 1
+                self.reply({"ok": True, "result": fake.telegram(path[1], params)})
+            elif path[:2] == ["vk", "longpoll"]:
+                fake.calls["vk:longpoll"] += 1
+                fake.vk_polling.set()
+                start = int(params.get("ts") or 0)
+                events = fake.wait_updates(fake.vk_events, start, min(float(params.get("wait", 1)), 1.0))
+                self.reply({"ts": str(start + len(events)), "updates": events})
+            elif path[:2] == ["vk", "upload"]:
+                fake.calls["vk:upload"] += 1
+                self.reply({"server": 1, "photo": "[]", "hash": "hash", "file": "file"})
+            elif path[:2] == ["vk", "media"]:
+                fake.calls["vk:media"] += 1
+                self.reply(fake.media, "application/octet-stream")
+            elif path[0] == "method":
+                fake.calls[f"vk:{path[1]}"] += 1
+                self.reply({"response": fake.vk(path[1], params)})
+            else:
+                self.send_error(404)
+
+        do_GET = handle_request
+        do_POST = handle_request
+
+    return Handler
+
+
+class RedirectAdapter(HTTPAdapter):
+    """
+    Адаптер requests, который отправляет запросы к https://api.vk.com на заглушку.
+    """
+
+    def __init__(self, base_url: str, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self._base_url = base_url
+
+    def send(self, request, **kwargs):
+        request.url = self._base_url + request.url[len("https://api.vk.com") :]
+        return super().send(request, **kwargs)
+
+
+def telegram_message(fake: FakeApi, number: int, photo: bool) -> dict:
+    message = {
+        "date": int(time.time()),
+        "chat": {"id": TG_CHAT_ID, "type": "group"},
+        "from": {"id": 100 + number % 5, "is_bot": False, "first_name": f"User{number % 5}"},
+    }
+    if photo:
+        message["photo"] = [
+            {
+                "file_id": f"photo{number}",
+                "file_unique_id": f"photo-unique{number}",
+                "width": 1280,
+                "height": 960,
+                "file_size": len(fake.media),
+            }
+        ]
+    else:
+        message["text"] = f"Сообщение {number}"
+    return message
+
+
+def vk_message(fake: FakeApi, number: int, photo: bool, depth: int) -> dict:
+    message = {
+        "date": int(time.time()),
+        "from_id": 100 + number % 5,
+        "peer_id": VK_CHAT_ID,
+        "id": 0,
+        "text": f"Сообщение {number}",
+        "attachments": [],
+        "fwd_messages": [],
+    }
+    if photo:
+        message["attachments"].append(
+            {
+                "type": "photo",
+                "photo": {
+                    "id": number,
+                    "owner_id": 100,
+                    "sizes": [{"type": "x", "width": 1280, "height": 960, "url": f"{fake.base_url}/vk/media/{number}.jpg"}],
+                },
+            }
+        )
+    # Цепочка пересланных сообщений заданной глубины
+    parent = message
+    for level in range(depth):
+        forwarded = {
+            "date": int(time.time()),
+            "from_id": 200 + level,
+            "text": f"Пересланное сообщение {level}",
+            "attachments": [],
+            "fwd_messages": [],
+        }
+        parent["fwd_messages"].append(forwarded)
+        parent = forwarded
+    return message
+
+
+def percentile(values: list, fraction: float) -> float:
+    values = sorted(values)
+    if not values:
+        return float("nan")
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Нагрузочный тест моста Telegram - VK")
+    parser.add_argument("--messages", type=int, default=200, help="сообщений в каждом направлении")
+    parser.add_argument("--rate", type=float, default=0, help="сообщений в секунду на направление, 0 - без ограничения")
+    parser.add_argument("--photo-ratio", type=float, default=0.2, help="доля сообщений с фотографией")
+    parser.add_argument("--media-size", type=int, default=100_000, help="размер файла в байтах")
+    parser.add_argument("--depth", type=int, default=1, help="глубина пересланных сообщений VK")
+    parser.add_argument("--direction", choices=["both", "tg_to_vk", "vk_to_tg"], default="both")
+    parser.add_argument("--tg-limit", type=int, default=0, help="сообщений в секунду в чат Telegram до ответа 429, 0 - без ограничения")
+    parser.add_argument("--webhook", action="store_true", help="получать обновления Telegram через webhook")
+    parser.add_argument("--timeout", type=float, default=300, help="предельное время теста в секундах")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    fake = FakeApi(args.media_size, args.tg_limit)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(fake))
+    server.daemon_threads = True
+    fake.base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    apihelper.API_URL = fake.base_url + "/bot{0}/{1}"
+    apihelper.FILE_URL = fake.base_url + "/file/bot{0}/{1}"
+    httppool.install_telebot_session()
+    session = httppool.get_session()
+    session.mount("https://api.vk.com/", RedirectAdapter(fake.base_url))
+    vk_scheduler = VkScheduler(
+        vk_api.VkApi(token="benchmark", session=session, api_version=VK_API_VERSION)
+    )
+
+    workdir = tempfile.mkdtemp(prefix="bridge-benchmark-")
+    outbox = Outbox(os.path.join(workdir, "outbox.sqlite3"))
+    media_cache = MediaCache(os.path.join(workdir, "mediacache.sqlite3"))
+    message_map = MessageMap(os.path.join(workdir, "messagemap.sqlite3"))
+    directions = ["tg_to_vk", "vk_to_tg"] if args.direction == "both" else [args.direction]
+    routes = RoutingTable.single(TG_CHAT_ID, VK_CHAT_ID, "tg_to_vk" in directions, "vk_to_tg" in directions)
+    if "vk_to_tg" in directions:
+        threading.Thread(
+            target=listen_vk,
+            args=(
+                vk_scheduler,
+                VK_GROUP_ID,
+                routes,
+                TG_TOKEN,
+                outbox,
+                0,
+                media_cache,
+                message_map,
+                # Ограничения настоящего Telegram сделали бы тест бессмысленно долгим;
+                # с --tg-limit регулятор подстраивается под ответы 429 заглушки
+                TelegramGovernor(global_rate=1e6, chat_rate=1e6, group_rate=1e6),
+            ),
+            daemon=True,
+        ).start()
+        fake.vk_polling.wait()
+    if "tg_to_vk" in directions:
+        webhook_port = server.server_address[1] + 1
+        threading.Thread(
+            target=listen_telegram,
+            args=(
+                TG_TOKEN,
+                routes,
+                vk_scheduler,
+                outbox,
+                0,
+                media_cache,
+                WebhookConfig(
+                    f"http://127.0.0.1:{webhook_port}/telegram", host="127.0.0.1", port=webhook_port
+                )
+                if args.webhook
+                else None,
+                message_map,
+            ),
+            daemon=True,
+        ).start()
+        fake.tg_polling.wait()
+    fake.calls.clear()
+    fake.batched.clear()
+
+    started = time.perf_counter()
+    photo_every = round(1 / args.photo_ratio) if args.photo_ratio > 0 else 0
+    for number in range(args.messages):
+        photo = photo_every > 0 and number % photo_every == 0
+        if "tg_to_vk" in directions:
+            fake.inject_telegram(telegram_message(fake, number, photo))
+        if "vk_to_tg" in directions:
+            fake.inject_vk(vk_message(fake, number, photo, args.depth))
+        if args.rate > 0:
+            time.sleep(max(0.0, started + (number + 1) / args.rate - time.perf_counter()))
+    completed = fake.wait_delivered({direction: args.messages for direction in directions}, args.timeout)
+    elapsed = time.perf_counter() - started
+
+    total = args.messages * len(directions)
+    print(f"Сообщений: {total} за {elapsed:.2f} с{'' if completed else ' (не все доставлены)'}")
+    for direction in directions:
+        latencies = [
+            delivered - injected
+            for injected, delivered in zip(fake.injected[direction], fake.delivered[direction])
+        ]
+        finished = fake.delivered[direction][-1] - started if fake.delivered[direction] else elapsed
+        print(
+            f"{direction}: {len(latencies)} сообщений, {len(latencies) / finished:.1f} сообщ./с,"
+            f" p50 {percentile(latencies, 0.5) * 1000:.1f} мс, p99 {percentile(latencies, 0.99) * 1000:.1f} мс"
+        )
+    calls = sum(fake.calls.values())
+    print(f"Вызовов API на сообщение: {calls / total:.2f}")
+    for method, count in fake.calls.most_common():
+        print(f"  {method}: {count / total:.2f}")
+    for method, count in fake.batched.most_common():
+        print(f"  vk:execute -> {method}: {count / total:.2f}")
+    print(f"Пиковый RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} МБ")
+    sys.stdout.flush()
+    # Потоки слушателей бесконечны, поэтому процесс завершается без их остановки
+    os._exit(0 if completed else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""
+Этот модуль содержит склейку коротких текстовых сообщений перед постановкой в очередь.
+В активных чатах люди пишут много однострочных сообщений подряд; каждое из них стоило бы
+отдельного вызова messages.send или send_message. Склейщик держит текстовые сообщения одного
+получателя короткое окно времени и ставит их в очередь одним сообщением. Сообщение с медиа
+сначала выталкивает накопленный текст, поэтому порядок сохраняется.
+
+Функции:
+- pack_texts(texts, limit):
+  Собирает тексты в как можно меньшее число сообщений не длиннее limit.
+
+Классы:
+- Coalescer(put, merge, window, limit):
+  Склейщик сообщений одного направления.
+
+Использование:
+- coalescer.add(key, direction, target, payload, text, created, lane, done) вместо outbox.put;
+  text передаётся только для сообщений без вложений. Склеиваются только сообщения быстрой полосы.
+  done вызывается, когда сообщение записано в журнал, - после него можно сохранять позицию опроса.
+"""
+
+import threading
+from typing import Callable
+
+from outbox import FAST_LANE
+
+# Окно склейки в секундах; 0 отключает склейку
+COALESCE_WINDOW = 0.0
+# Максимальная длина сообщения в VK и Telegram
+TEXT_LIMIT = 4096
+
+
+def pack_texts(texts: list, limit: int = TEXT_LIMIT, separator: str = "\n") -> list:
+    """
+    Собирает тексты по порядку в как можно меньшее число сообщений не длиннее limit.
+    Текст длиннее limit режется на куски по limit символов.
+
+    Параметры:
+        texts (list): Тексты по порядку.
+        limit (int): Максимальная длина сообщения.
+        separator (str): Разделитель между текстами.
+
+    Возвращает:
+        list - тексты сообщений
+    """
+    packed = []
+    for text in texts:
+        if packed and len(packed[-1]) + len(separator) + len(text) <= limit:
+            packed[-1] += separator + text
+        else:
+            packed += [text[start : start + limit] for start in range(0, len(text), limit)] or [""]
+    return packed
+
+
+class Coalescer:
+    """
+    Склейщик коротких текстовых сообщений одного направления.
+
+    Параметры:
+        put (Callable): put(key, direction, target, payload, created, lane) - постановка в очередь (Outbox.put).
+        merge (Callable[[list], dict]): Собирает одно сообщение из списка склеиваемых.
+        window (float): Окно склейки в секундах, отсчитывается от первого сообщения.
+        limit (int): Максимальная суммарная длина склеиваемых текстов.
+    """
+
+    def __init__(
+        self,
+        put: Callable,
+        merge: Callable[[list], dict],
+        window: float = COALESCE_WINDOW,
+        limit: int = TEXT_LIMIT,
+    ) -> None:
+        self._put = put
+        self._merge = merge
+        self._window = window
+        self._limit = limit
+        # (направление, получатель) -> [ключ, сообщения, длина текста, метка, время первого
+        # сообщения, подтверждения]
+        self._buffers = {}
+        self._timers = {}
+        self._lock = threading.Lock()
+
+    def add(
+        self,
+        key: str,
+        direction: str,
+        target,
+        payload: dict,
+        text: str = None,
+        created: float = None,
+        lane: str = FAST_LANE,
+        done: Callable[[], None] = None,
+    ) -> None:
+        """
+        Принимает сообщение для постановки в очередь.
+
+        Параметры:
+            key (str): Ключ идемпотентности.
+            direction (str): Направление.
+            target: Получатель.
+            payload (dict): Сообщение.
+            text (str): Текст сообщения, если в нём нет вложений; None - сообщение не склеивается.
+            created (float): Время отправки сообщения в источнике (unix time).
+            lane (str): Полоса доставки; сообщения медленной полосы ставятся в очередь сразу.
+            done (Callable): Вызывается после записи сообщения в журнал.
+
+        Возвращает:
+            None
+        """
+        if self._window <= 0 or lane != FAST_LANE:
+            self._put(key, direction, target, payload, created, lane)
+            if done is not None:
+                done()
+            return
+        buffer_key = (direction, target)
+        # Постановка в очередь идёт под блокировкой, чтобы сообщения не обгоняли друг друга
+        with self._lock:
+            buffer = self._buffers.get(buffer_key)
+            if text is None or (
+                buffer is not None and buffer[2] + 1 + len(text) > self._limit
+            ):
+                self._flush_locked(buffer_key)
+                buffer = None
+            if text is None:
+                self._put(key, direction, target, payload, created, lane)
+                if done is not None:
+                    done()
+                return
+            if buffer is None:
+                # Метка не даёт запоздавшему таймеру вытолкнуть следующую пачку
+                token = object()
+                self._buffers[buffer_key] = [key, [payload], len(text), token, created, [done]]
+                timer = threading.Timer(self._window, self._flush, args=(buffer_key, token))
+                timer.daemon = True
+                self._timers[buffer_key] = timer
+                timer.start()
+            else:
+                buffer[1].append(payload)
+                buffer[2] += 1 + len(text)
+                buffer[5].append(done)
+
+    def _flush(self, buffer_key: tuple, token: object) -> None:
+        with self._lock:
+            buffer = self._buffers.get(buffer_key)
+            if buffer is not None and buffer[3] is token:
+                self._flush_locked(buffer_key)
+
+    def _flush_locked(self, buffer_key: tuple) -> None:
+        """
+        Ставит в очередь накопленные сообщения получателя. Вызывается под блокировкой.
+        """
+        buffer = self._buffers.pop(buffer_key, None)
+        timer = self._timers.pop(buffer_key, None)
+        if timer is not None:
+            timer.cancel()
+        if buffer is None:
+            return
+        key, payloads, _, _, created, dones = buffer
+        direction, target = buffer_key
+        payload = payloads[0] if len(payloads) == 1 else self._merge(payloads)
+        self._put(key, direction, target, payload, created)
+        for done in dones:
+            if done is not None:
+                done()
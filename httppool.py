@@ -0,0 +1,72 @@
+"""
+Этот модуль содержит общий пул HTTP-соединений для обоих направлений пересылки.
+Одна сессия requests с keep-alive используется сессией VK, загрузчиком VK, long poll,
+apihelper библиотеки telebot и потоковой передачей файлов, поэтому TCP+TLS соединения
+переиспользуются между сообщениями.
+
+Функции:
+- get_session():
+  Возвращает общую сессию requests, создавая её при первом вызове.
+- install_telebot_session():
+  Подключает общую сессию к apihelper библиотеки telebot.
+
+Использование:
+- Вызовите install_telebot_session() до создания ботов.
+- Передавайте get_session() в vk_api.VkApi(session=...) и используйте её для скачивания файлов.
+"""
+
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from telebot import apihelper
+
+import metrics
+
+# Сколько хостов держать в пуле одновременно (CDN VK раздаёт файлы с разных хостов)
+POOL_HOSTS = 32
+# Соединений на хост по умолчанию
+POOL_SIZE_PER_HOST = 8
+# Размер пула для отдельных хостов
+HOST_POOL_SIZES = {
+    "https://api.telegram.org/": 16,
+    "https://api.vk.com/": 4,
+}
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """
+    Возвращает общую сессию requests с пулом соединений.
+
+    Возвращает:
+        requests.Session
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=POOL_HOSTS, pool_maxsize=POOL_SIZE_PER_HOST
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            for prefix, pool_size in HOST_POOL_SIZES.items():
+                session.mount(
+                    prefix, HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+                )
+            # Каждый ответ учитывается в метриках вызовов API и переданных байт
+            session.hooks["response"].append(metrics.record_response)
+            _session = session
+        return _session
+
+
+def install_telebot_session() -> None:
+    """
+    Подключает общую сессию к apihelper библиотеки telebot.
+    """
+    apihelper.session = get_session()
+    # Общая сессия живёт всё время работы процесса
+    apihelper.SESSION_TIME_TO_LIVE = None
@@ -0,0 +1,106 @@
+"""
+Этот модуль содержит постоянный кэш медиафайлов, уже переданных через мост.
+Стикеры, мемы и репосты пересылаются снова и снова; кэш помнит, куда файл уже загружен, и
+повторный файл не скачивается и не загружается заново. Кэш общий для обоих направлений:
+файл, загруженный мостом из Telegram в VK, при обратной пересылке тоже берётся из кэша.
+Вложения пользователей VK приватные (нужен access_key), поэтому для них запоминается только
+file_id Telegram.
+
+Ключи кэша:
+- tg:<file_unique_id> и sha1:<хэш содержимого> - строка вложения VK, загруженного мостом
+  (photo<owner>_<id>, doc<owner>_<id>);
+- vk:photo<owner>_<id>, vk:doc<owner>_<id>, vk:sticker<id> - file_id Telegram.
+
+Классы:
+- MediaCache(path, max_size):
+  Кэш на SQLite с вытеснением давно не использованных записей.
+
+Использование:
+- media_cache.get(key) перед скачиванием, media_cache.put(key, value) после загрузки.
+"""
+
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+# Максимальное количество записей кэша
+MEDIA_CACHE_SIZE = 100000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS media (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS media_used ON media (used);
+"""
+
+
+class MediaCache:
+    """
+    Постоянный кэш соответствия медиафайлов Telegram и VK.
+
+    Параметры:
+        path (str): Путь к файлу кэша.
+        max_size (int): Максимальное количество записей; при переполнении вытесняются
+            давно не использованные.
+    """
+
+    def __init__(self, path: str, max_size: int = MEDIA_CACHE_SIZE) -> None:
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        self._max_size = max_size
+        self._size = self._db.execute("SELECT COUNT(*) FROM media").fetchone()[0]
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Возвращает значение из кэша и отмечает запись использованной.
+
+        Параметры:
+            key (str): Ключ файла.
+
+        Возвращает:
+            str или None, если файла нет в кэше
+        """
+        with self._lock:
+            row = self._db.execute("SELECT value FROM media WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._db.execute("UPDATE media SET used = ? WHERE key = ?", (time.time(), key))
+        return row[0]
+
+    def put(self, key: str, value: str) -> None:
+        """
+        Записывает значение в кэш.
+
+        Параметры:
+            key (str): Ключ файла.
+            value (str): Строка вложения VK или file_id Telegram.
+
+        Возвращает:
+            None
+        """
+        with self._lock:
+            known = self._db.execute("SELECT 1 FROM media WHERE key = ?", (key,)).fetchone()
+            # Кэш общий для процессов-обработчиков: ту же запись может одновременно добавить
+            # другой процесс, поэтому вставка и обновление - одним запросом
+            self._db.execute(
+                "INSERT INTO media (key, value, used) VALUES (?, ?, ?)"
+                " ON CONFLICT (key) DO UPDATE SET value = excluded.value, used = excluded.used",
+                (key, value, time.time()),
+            )
+            if known is None:
+                self._size += 1
+            if self._size > self._max_size:
+                # Вытесняется десятая часть, чтобы не чистить кэш на каждой записи
+                evict = self._size - self._max_size + self._max_size // 10
+                self._db.execute(
+                    "DELETE FROM media WHERE key IN"
+                    " (SELECT key FROM media ORDER BY used LIMIT ?)",
+                    (evict,),
+                )
+                self._size = self._db.execute("SELECT COUNT(*) FROM media").fetchone()[0]
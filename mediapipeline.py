@@ -0,0 +1,74 @@
+"""
+Этот модуль содержит конвейер обработки вложений одного сообщения.
+Скачивание и загрузка вложений выполняются параллельно на ограниченном пуле потоков,
+а результаты выдаются строго в исходном порядке, чтобы вложения попадали в чат
+в том же порядке, что и в оригинальном сообщении.
+
+Классы:
+- MediaPipeline(workers):
+  Пул потоков с упорядоченной выдачей результатов.
+
+Переменные:
+- pipeline: общий конвейер процесса.
+
+Использование:
+- for result in pipeline.map_ordered(func, items): отправить(result)
+- Не вызывайте map_ordered из задач самого конвейера: вложенное ожидание может занять все потоки.
+"""
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator
+
+# Количество одновременных скачиваний и загрузок
+MEDIA_WORKERS = 4
+
+
+class MediaPipeline:
+    """
+    Пул потоков для параллельной обработки вложений с упорядоченной выдачей результатов.
+
+    Параметры:
+        workers (int): Максимальное количество одновременно выполняемых задач.
+    """
+
+    def __init__(self, workers: int = MEDIA_WORKERS) -> None:
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="media"
+        )
+
+    def submit(self, func: Callable, *args) -> Future:
+        """
+        Ставит одну задачу в пул.
+
+        Параметры:
+            func (Callable): Функция задачи.
+            *args: Аргументы функции.
+
+        Возвращает:
+            Future
+        """
+        return self._executor.submit(func, *args)
+
+    def map_ordered(self, func: Callable, items: Iterable) -> Iterator:
+        """
+        Запускает func для всех элементов сразу и выдаёт результаты в исходном порядке.
+        Результат i-го элемента выдаётся, как только готовы все элементы до него включительно.
+
+        Параметры:
+            func (Callable): Функция обработки одного элемента.
+            items (Iterable): Элементы.
+
+        Возвращает:
+            Iterator - результаты; исключение задачи пробрасывается на её позиции
+        """
+        futures = [self._executor.submit(func, item) for item in items]
+        try:
+            for future in futures:
+                yield future.result()
+        finally:
+            # Если отправка прервалась, не тратим пул на ненужные задачи
+            for future in futures:
+                future.cancel()
+
+
+pipeline = MediaPipeline()
@@ -0,0 +1,228 @@
+"""
+Этот модуль содержит подгонку размеров медиафайлов под ограничения платформы-получателя.
+Из нескольких размеров фотографии выбирается наименьший, который не меньше целевого
+разрешения, - больший Telegram и VK всё равно сожмут. Фотографии сверх ограничения размера
+уменьшаются и пережимаются в пуле процессов (нужна библиотека Pillow из requirements.txt;
+без неё файл отправляется как есть). Документы раскладываются по запросам так, чтобы суммарный размер
+одного запроса не превышал ограничение Telegram.
+
+Функции:
+- configure(target_resolution): Задаёт целевое разрешение фотографий.
+- pick_rendition(renditions, dimensions): Выбирает размер фотографии.
+- pick_vk_size(sizes): Выбирает размер фотографии или стикера VK.
+- pick_tg_photo(photo_sizes): Выбирает размер фотографии Telegram.
+- fit_photo(photo, limit): Уменьшает фотографию, если она больше limit байт.
+- split_batches(items, limit, size, max_count): Раскладывает файлы по запросам.
+- is_size_error(error): Проверяет, что Telegram отклонил фотографию из-за размера.
+
+Использование:
+- configure(...) при запуске, затем pick_* при разборе сообщения и fit_photo перед загрузкой.
+"""
+
+import io
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Optional
+
+from telebot.apihelper import ApiTelegramException
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Целевое разрешение фотографий по длинной стороне в пикселях
+TARGET_RESOLUTION = 1280
+# Максимальный размер фотографии, загружаемой в Telegram
+TG_PHOTO_LIMIT = 10 * 1024 * 1024
+# Максимальный суммарный размер файлов одного запроса к API Telegram
+TG_REQUEST_LIMIT = 50 * 1024 * 1024
+# Максимальный размер фотографии, загружаемой в VK
+VK_PHOTO_LIMIT = 50 * 1024 * 1024
+# Максимальная длинная сторона фотографии после уменьшения
+MAX_PHOTO_SIDE = 2560
+# Количество процессов пережатия фотографий
+SHRINK_WORKERS = 2
+# Фрагменты описаний ошибок Telegram, когда фотография по ссылке слишком большая
+SIZE_ERRORS = ("HTTP URL", "PHOTO_", "too big", "Too Large", "IMAGE_PROCESS_FAILED")
+
+_target_resolution = TARGET_RESOLUTION
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def configure(target_resolution: int) -> None:
+    """
+    Задаёт целевое разрешение фотографий.
+
+    Параметры:
+        target_resolution (int): Длинная сторона в пикселях.
+
+    Возвращает:
+        None
+    """
+    global _target_resolution
+    _target_resolution = target_resolution
+    if Image is None:
+        logging.error(
+            "Pillow не установлен: фотографии больше ограничения платформы не будут уменьшаться"
+        )
+
+
+def pick_rendition(renditions: list, dimensions: Callable, target: int = None):
+    """
+    Выбирает наименьший размер фотографии, длинная сторона которого не меньше целевого
+    разрешения; если таких нет - наибольший.
+
+    Параметры:
+        renditions (list): Размеры одной фотографии.
+        dimensions (Callable): Функция, возвращающая (ширина, высота) размера.
+        target (int): Целевое разрешение, по умолчанию заданное configure.
+
+    Возвращает:
+        Выбранный размер
+    """
+    target = target or _target_resolution
+    # Размеры без заявленных сторон (старые фотографии VK) не сравниваются
+    known = [rendition for rendition in renditions if max(dimensions(rendition)) > 0]
+    if not known:
+        return renditions[-1]
+    known.sort(key=lambda rendition: max(dimensions(rendition)))
+    for rendition in known:
+        if max(dimensions(rendition)) >= target:
+            return rendition
+    return known[-1]
+
+
+def pick_vk_size(sizes: list) -> dict:
+    """
+    Выбирает размер фотографии (sizes) или стикера (images) VK.
+
+    Параметры:
+        sizes (list): Размеры с полями width, height и url.
+
+    Возвращает:
+        dict
+    """
+    return pick_rendition(sizes, lambda size: (size.get("width") or 0, size.get("height") or 0))
+
+
+def pick_tg_photo(photo_sizes: list):
+    """
+    Выбирает размер фотографии Telegram.
+
+    Параметры:
+        photo_sizes (list): Объекты telebot.types.PhotoSize.
+
+    Возвращает:
+        telebot.types.PhotoSize
+    """
+    return pick_rendition(photo_sizes, lambda size: (size.width or 0, size.height or 0))
+
+
+def _shrink(data: bytes, limit: int, max_side: int) -> bytes:
+    """
+    Уменьшает и пережимает изображение в JPEG не больше limit байт. Выполняется в пуле процессов.
+    """
+    image = Image.open(io.BytesIO(data))
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    image.thumbnail((max_side, max_side))
+    quality = 90
+    while True:
+        output = io.BytesIO()
+        image.save(output, "JPEG", quality=quality, optimize=True)
+        if output.tell() <= limit:
+            return output.getvalue()
+        if quality > 60:
+            quality -= 15
+        else:
+            # Качество уже низкое, дальше уменьшаются стороны
+            image.thumbnail((image.width * 3 // 4, image.height * 3 // 4))
+            quality = 85
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Процессы запускаются заново, а не через fork: fork многопоточного процесса
+            # копирует захваченные другими потоками блокировки
+            _pool = ProcessPoolExecutor(
+                max_workers=SHRINK_WORKERS, mp_context=multiprocessing.get_context("spawn")
+            )
+        return _pool
+
+
+def fit_photo(photo: io.BytesIO, limit: int, max_side: int = MAX_PHOTO_SIDE) -> io.BytesIO:
+    """
+    Возвращает фотографию не больше limit байт. Пережатие идёт в отдельном процессе, поэтому
+    потоки скачивания и загрузки не занимают процессор и GIL.
+
+    Параметры:
+        photo (io.BytesIO): Фотография; атрибут name сохраняется.
+        limit (int): Максимальный размер в байтах.
+        max_side (int): Максимальная длинная сторона после уменьшения.
+
+    Возвращает:
+        io.BytesIO - исходный объект, если фотография помещается или Pillow не установлен
+    """
+    if photo.getbuffer().nbytes <= limit:
+        return photo
+    if Image is None:
+        logging.warning("Фотография больше допустимого размера, а Pillow не установлен")
+        return photo
+    name = getattr(photo, "name", "photo.jpg")
+    data = _get_pool().submit(_shrink, photo.getvalue(), limit, max_side).result()
+    shrunk = io.BytesIO(data)
+    shrunk.name = name.rsplit(".", 1)[0] + ".jpg"
+    return shrunk
+
+
+def split_batches(
+    items: list, limit: int, size: Callable, max_count: Optional[int] = None
+) -> list:
+    """
+    Раскладывает файлы по порядку на группы с суммарным размером не больше limit и не больше
+    max_count файлов в группе. Файл больше limit идёт отдельной группой.
+
+    Параметры:
+        items (list): Файлы.
+        limit (int): Максимальный суммарный размер группы в байтах.
+        size (Callable): Функция, возвращающая размер файла (0, если неизвестен).
+        max_count (int): Максимальное количество файлов в группе.
+
+    Возвращает:
+        list - список групп
+    """
+    batches = []
+    batch_size = 0
+    for item in items:
+        item_size = size(item)
+        if (
+            not batches
+            or batch_size + item_size > limit
+            or (max_count and len(batches[-1]) >= max_count)
+        ):
+            batches.append([])
+            batch_size = 0
+        batches[-1].append(item)
+        batch_size += item_size
+    return batches
+
+
+def is_size_error(error: ApiTelegramException) -> bool:
+    """
+    Проверяет, что Telegram отклонил фотографию по ссылке из-за размера или формата.
+
+    Параметры:
+        error (ApiTelegramException): Ошибка API Telegram.
+
+    Возвращает:
+        bool
+    """
+    return error.error_code in (400, 413) and any(
+        fragment in (error.description or "") for fragment in SIZE_ERRORS
+    )
@@ -0,0 +1,156 @@
+"""
+Этот модуль содержит соответствие пересланных сообщений Telegram и VK.
+Для каждого сообщения, доставленного мостом, запоминается пара (чат и message_id Telegram,
+беседа и conversation_message_id VK). По ней ответ на известное сообщение доставляется как
+настоящий ответ (reply_to_message_id в Telegram, forward с is_reply в VK), а вложения
+исходного сообщения не скачиваются и не загружаются повторно.
+Недавние записи хранятся в памяти (LRU), все - в SQLite с вытеснением самых старых.
+
+Классы:
+- MessageMap(path, max_size, memory_size):
+  Соответствие сообщений в обе стороны.
+
+Использование:
+- message_map.put(tg_chat_id, tg_message_id, vk_peer_id, vk_message_id) после доставки.
+- message_map.vk_for_tg(tg_chat_id, tg_message_id) -> (vk_peer_id, conversation_message_id) или None.
+- message_map.tg_for_vk(vk_peer_id, conversation_message_id) -> (tg_chat_id, message_id) или None.
+"""
+
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+# Максимальное количество записей на диске
+MESSAGE_MAP_SIZE = 1000000
+# Количество записей в памяти для каждого направления
+MESSAGE_MAP_MEMORY = 10000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    tg_chat INTEGER NOT NULL,
+    tg_id INTEGER NOT NULL,
+    vk_peer INTEGER NOT NULL,
+    vk_id INTEGER NOT NULL,
+    UNIQUE (tg_chat, tg_id, vk_peer, vk_id)
+);
+CREATE INDEX IF NOT EXISTS messages_vk ON messages (vk_peer, vk_id);
+"""
+
+
+class MessageMap:
+    """
+    Соответствие сообщений Telegram и VK, доставленных мостом.
+    Одно сообщение может соответствовать нескольким (текст и медиагруппы, склеенные сообщения);
+    поиск возвращает самое раннее.
+
+    Параметры:
+        path (str): Путь к файлу базы.
+        max_size (int): Максимальное количество записей на диске.
+        memory_size (int): Количество записей в памяти для каждого направления.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_size: int = MESSAGE_MAP_SIZE,
+        memory_size: int = MESSAGE_MAP_MEMORY,
+    ) -> None:
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        self._max_size = max_size
+        self._memory_size = memory_size
+        self._size = self._db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+        self._by_tg = OrderedDict()  # (чат, message_id) -> (беседа, conversation_message_id)
+        self._by_vk = OrderedDict()  # (беседа, conversation_message_id) -> (чат, message_id)
+
+    def put(self, tg_chat_id: int, tg_message_id: int, vk_peer_id: int, vk_message_id: int) -> None:
+        """
+        Запоминает, что сообщения соответствуют друг другу.
+
+        Параметры:
+            tg_chat_id (int): ID чата Telegram.
+            tg_message_id (int): message_id Telegram.
+            vk_peer_id (int): ID беседы VK.
+            vk_message_id (int): conversation_message_id VK.
+
+        Возвращает:
+            None
+        """
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT OR IGNORE INTO messages (tg_chat, tg_id, vk_peer, vk_id) VALUES (?, ?, ?, ?)",
+                (tg_chat_id, tg_message_id, vk_peer_id, vk_message_id),
+            )
+            self._size += cursor.rowcount
+            if self._size > self._max_size:
+                # Вытесняется десятая часть, чтобы не чистить базу на каждой записи
+                self._db.execute(
+                    "DELETE FROM messages WHERE id IN (SELECT id FROM messages ORDER BY id LIMIT ?)",
+                    (self._size - self._max_size + self._max_size // 10,),
+                )
+                self._size = self._db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+                self._by_tg.clear()
+                self._by_vk.clear()
+            # Первое сопоставление остаётся основным, как и при поиске в базе
+            self._remember(self._by_tg, (tg_chat_id, tg_message_id), (vk_peer_id, vk_message_id))
+            self._remember(self._by_vk, (vk_peer_id, vk_message_id), (tg_chat_id, tg_message_id))
+
+    def vk_for_tg(self, tg_chat_id: int, tg_message_id: int) -> Optional[tuple]:
+        """
+        Возвращает сообщение VK, соответствующее сообщению Telegram.
+
+        Параметры:
+            tg_chat_id (int): ID чата Telegram.
+            tg_message_id (int): message_id Telegram.
+
+        Возвращает:
+            tuple - (ID беседы VK, conversation_message_id) или None
+        """
+        return self._lookup(
+            self._by_tg,
+            (tg_chat_id, tg_message_id),
+            "SELECT vk_peer, vk_id FROM messages WHERE tg_chat = ? AND tg_id = ? ORDER BY vk_id LIMIT 1",
+        )
+
+    def tg_for_vk(self, vk_peer_id: int, vk_message_id: int) -> Optional[tuple]:
+        """
+        Возвращает сообщение Telegram, соответствующее сообщению VK.
+
+        Параметры:
+            vk_peer_id (int): ID беседы VK.
+            vk_message_id (int): conversation_message_id VK.
+
+        Возвращает:
+            tuple - (ID чата Telegram, message_id) или None
+        """
+        return self._lookup(
+            self._by_vk,
+            (vk_peer_id, vk_message_id),
+            "SELECT tg_chat, tg_id FROM messages WHERE vk_peer = ? AND vk_id = ? ORDER BY tg_id LIMIT 1",
+        )
+
+    def _lookup(self, memory: OrderedDict, key: tuple, query: str) -> Optional[tuple]:
+        with self._lock:
+            value = memory.get(key)
+            if value is not None:
+                memory.move_to_end(key)
+                return value
+            row = self._db.execute(query, key).fetchone()
+            if row is None:
+                return None
+            value = tuple(row)
+            self._remember(memory, key, value)
+            return value
+
+    def _remember(self, memory: OrderedDict, key: tuple, value: tuple) -> None:
+        if key in memory:
+            memory.move_to_end(key)
+            return
+        memory[key] = value
+        while len(memory) > self._memory_size:
+            memory.popitem(last=False)
@@ -0,0 +1,271 @@
+"""
+Этот модуль содержит метрики моста в формате Prometheus.
+Счётчики и гистограммы задержек собираются в памяти процесса и отдаются по HTTP
+(GET /metrics), если задан порт. Сторонние библиотеки не нужны.
+
+Основные метрики:
+- bridge_stage_seconds{stage} - длительность этапов обработки сообщения;
+- bridge_api_calls_total{api, method}, bridge_api_seconds{api, method} - вызовы API Telegram и VK;
+  загрузка и скачивание файлов с серверов VK учитываются как api="http", method="upload" / "download";
+- bridge_bytes_total{direction} - переданные байты (sent / received);
+- bridge_messages_total{direction, result} - доставленные, повторённые, отложенные
+  и недоставленные сообщения;
+- bridge_tg_throttled_total - ответы 429 Too Many Requests от Telegram;
+- bridge_delivery_lag_seconds{direction} - задержка от отправки в источнике до доставки;
+- bridge_outbox_depth - количество недоставленных сообщений в очереди.
+
+Функции:
+- inc(name, amount, **labels): Увеличивает счётчик.
+- observe(name, value, **labels): Добавляет значение в гистограмму.
+- timed(stage): Замеряет длительность этапа (контекстный менеджер и декоратор).
+- gauge(name, func): Регистрирует показатель, который вычисляется при каждом запросе метрик.
+- record_response(response): Учитывает HTTP-ответ общей сессии requests.
+- render(): Возвращает метрики в текстовом формате Prometheus.
+- check(path, func): Регистрирует проверку состояния (например, /livez), 200 или 503.
+- serve(port): Запускает HTTP-сервер метрик и проверок в фоновом потоке.
+"""
+
+import bisect
+import contextlib
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+from urllib.parse import urlsplit
+
+import requests
+
+# Границы корзин гистограмм в секундах
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_lock = threading.Lock()
+_counters = {}  # (имя, метки) -> значение
+_histograms = {}  # (имя, метки) -> [счётчики корзин, сумма, количество]
+_gauges = {}  # имя -> функция
+_checks = {}  # путь -> функция проверки
+
+
+def _labels(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def inc(name: str, amount: float = 1, **labels) -> None:
+    """
+    Увеличивает счётчик.
+
+    Параметры:
+        name (str): Имя метрики.
+        amount (float): Приращение.
+        **labels: Метки.
+
+    Возвращает:
+        None
+    """
+    key = (name, _labels(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def observe(name: str, value: float, **labels) -> None:
+    """
+    Добавляет значение в гистограмму.
+
+    Параметры:
+        name (str): Имя метрики.
+        value (float): Значение в секундах.
+        **labels: Метки.
+
+    Возвращает:
+        None
+    """
+    key = (name, _labels(labels))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+        index = bisect.bisect_left(BUCKETS, value)
+        if index < len(BUCKETS):
+            histogram[0][index] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+
+@contextlib.contextmanager
+def timed(stage: str):
+    """
+    Замеряет длительность этапа в bridge_stage_seconds и считает ошибки этапа
+    в bridge_stage_errors_total. Работает как контекстный менеджер и как декоратор.
+
+    Параметры:
+        stage (str): Название этапа.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        inc("bridge_stage_errors_total", stage=stage)
+        raise
+    finally:
+        observe("bridge_stage_seconds", time.perf_counter() - start, stage=stage)
+
+
+def gauge(name: str, func: Callable[[], float]) -> None:
+    """
+    Регистрирует показатель, значение которого вычисляется при каждом запросе метрик.
+
+    Параметры:
+        name (str): Имя метрики.
+        func (Callable): Функция без аргументов, возвращающая значение.
+
+    Возвращает:
+        None
+    """
+    with _lock:
+        _gauges[name] = func
+
+
+def check(path: str, func: Callable[[], bool]) -> None:
+    """
+    Регистрирует проверку состояния, доступную на сервере метрик: GET path отвечает 200,
+    если func() истинна, и 503 иначе.
+
+    Параметры:
+        path (str): Путь, например /livez.
+        func (Callable): Функция без аргументов, возвращающая bool.
+
+    Возвращает:
+        None
+    """
+    with _lock:
+        _checks[path] = func
+
+
+def record_response(response: requests.Response, *args, **kwargs) -> None:
+    """
+    Учитывает HTTP-ответ: вызов API, его длительность и переданные байты.
+    Подключается как обработчик hooks["response"] сессии requests.
+
+    Параметры:
+        response (requests.Response): Ответ.
+
+    Возвращает:
+        None
+    """
+    url = urlsplit(response.url)
+    path = url.path.strip("/").split("/")
+    if url.hostname == "api.telegram.org" and path[0] == "file":
+        api, method = "telegram", "file"
+    elif url.hostname == "api.telegram.org" and len(path) > 1:
+        api, method = "telegram", path[-1]
+    elif url.hostname == "api.vk.com" and path[0] == "method" and len(path) > 1:
+        api, method = "vk", path[1]
+    else:
+        # Серверы загрузки и хранения файлов VK и другие адреса: имён хостов CDN много,
+        # поэтому метка одна на вид запроса, а не на хост
+        api, method = "http", "upload" if response.request.method == "POST" else "download"
+    inc("bridge_api_calls_total", api=api, method=method)
+    observe("bridge_api_seconds", response.elapsed.total_seconds(), api=api, method=method)
+    sent = response.request.headers.get("Content-Length")
+    if sent:
+        inc("bridge_bytes_total", int(sent), direction="sent")
+    received = response.headers.get("Content-Length")
+    if received:
+        inc("bridge_bytes_total", int(received), direction="received")
+    return response
+
+
+def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+    labels = labels + extra
+    if not labels:
+        return ""
+    values = ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in labels
+    )
+    return "{" + values + "}"
+
+
+def render() -> str:
+    """
+    Возвращает метрики в текстовом формате Prometheus.
+
+    Возвращает:
+        str
+    """
+    lines = []
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted(
+            (key, [list(value[0]), value[1], value[2]]) for key, value in _histograms.items()
+        )
+        gauges = sorted(_gauges.items())
+    typed = set()
+    for (name, labels), value in counters:
+        if name not in typed:
+            lines.append(f"# TYPE {name} counter")
+            typed.add(name)
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+    for (name, labels), (buckets, total, count) in histograms:
+        if name not in typed:
+            lines.append(f"# TYPE {name} histogram")
+            typed.add(name)
+        cumulative = 0
+        for bound, bucket in zip(BUCKETS, buckets):
+            cumulative += bucket
+            lines.append(
+                f"{name}_bucket{_format_labels(labels, (('le', bound),))} {cumulative}"
+            )
+        lines.append(f"{name}_bucket{_format_labels(labels, (('le', '+Inf'),))} {count}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+        lines.append(f"{name}_count{_format_labels(labels)} {count}")
+    for name, func in gauges:
+        try:
+            value = func()
+        except Exception as e:
+            logging.warning(f"Не удалось вычислить метрику {name}: {e}")
+            continue
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        path = self.path.split("?")[0]
+        with _lock:
+            health_check = _checks.get(path)
+        if health_check is not None:
+            healthy = health_check()
+            body = b"ok\n" if healthy else b"fail\n"
+            self.send_response(200 if healthy else 503)
+        elif path == "/metrics":
+            body = render().encode("utf-8")
+            self.send_response(200)
+        else:
+            self.send_error(404)
+            return
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        # Запросы метрик не пишутся в лог
+        pass
+
+
+def serve(port: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+    """
+    Запускает HTTP-сервер метрик в фоновом потоке.
+
+    Параметры:
+        port (int): Порт.
+        host (str): Адрес.
+
+    Возвращает:
+        ThreadingHTTPServer
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,196 @@
+"""
+Этот модуль содержит кэш имён пользователей и сообществ VK.
+Кэш ограничен по размеру (LRU) и по времени жизни записей (TTL). Устаревшие записи
+обновляются в фоновом потоке, поэтому пересылка сообщений не ждёт запросов к API.
+
+Классы:
+- NameCache(loader, ttl, max_size, batch_loader):
+  Кэш имён. loader - функция, получающая имя по id через API VK, batch_loader - то же
+  для нескольких id одним запросом.
+
+Использование:
+- Создайте NameCache, передав функцию загрузки имени.
+- Вызовите warm(vk_scheduler, peer_id), чтобы заранее заполнить кэш участниками беседы.
+- Получайте имена через get(id); id = 0 означает собственное сообщество бота.
+- Имена всех авторов дерева сообщений получайте одним вызовом get_many(ids).
+"""
+
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable
+
+from vk_api import VkApiError
+
+from vkscheduler import VkScheduler
+
+# Время жизни записи в секундах
+NAME_TTL = 3600
+# Максимальное количество записей в кэше
+NAME_CACHE_SIZE = 5000
+
+
+class NameCache:
+    """
+    Кэш имён пользователей и сообществ VK с вытеснением LRU и временем жизни записей.
+
+    Параметры:
+        loader (Callable[[int], str]): Функция, возвращающая имя по id через API VK.
+        ttl (float): Время жизни записи в секундах.
+        max_size (int): Максимальное количество записей.
+        batch_loader (Callable[[list], dict]): Функция, возвращающая имена нескольких id
+            ({id: имя}) за один запрос; без неё промахи get_many загружаются по одному.
+    """
+
+    def __init__(
+        self,
+        loader: Callable[[int], str],
+        ttl: float = NAME_TTL,
+        max_size: int = NAME_CACHE_SIZE,
+        batch_loader: Callable[[list], dict] = None,
+    ) -> None:
+        self._loader = loader
+        self._batch_loader = batch_loader
+        self._ttl = ttl
+        self._max_size = max_size
+        self._entries = OrderedDict()  # id -> (имя, время загрузки)
+        self._group_name = None
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._refresh_queue = queue.Queue()
+        self._refresher = threading.Thread(target=self._refresh_loop, daemon=True)
+        self._refresher.start()
+
+    def get(self, id: int = 0) -> str:
+        """
+        Возвращает имя пользователя или сообщества.
+
+        Параметры:
+            id (int): id пользователя (> 0), сообщества (< 0) или 0 для своего сообщества.
+
+        Возвращает:
+            str
+        """
+        if id == 0:
+            if self._group_name is None:
+                self._group_name = self._loader(0)
+            return self._group_name
+
+        with self._lock:
+            entry = self._entries.get(id)
+            if entry is not None:
+                self._entries.move_to_end(id)
+                name, loaded_at = entry
+                # Устаревшая запись отдаётся сразу, а обновляется в фоне
+                if time.monotonic() - loaded_at > self._ttl and id not in self._pending:
+                    self._pending.add(id)
+                    self._refresh_queue.put(id)
+                return name
+
+        # Промах: загружаем синхронно, иначе отображать нечего
+        name = self._loader(id)
+        self.put(id, name)
+        return name
+
+    def get_many(self, ids) -> dict:
+        """
+        Возвращает имена нескольких пользователей и сообществ; промахи загружаются одним запросом.
+
+        Параметры:
+            ids: id пользователей, сообществ или 0 для своего сообщества.
+
+        Возвращает:
+            dict - {id: имя}
+        """
+        names = {}
+        missing = []
+        for id in set(ids):
+            if id == 0:
+                names[0] = self.get(0)
+                continue
+            with self._lock:
+                cached = id in self._entries
+            if cached:
+                names[id] = self.get(id)
+            else:
+                missing.append(id)
+        if missing and self._batch_loader is not None:
+            loaded = self._batch_loader(missing)
+            for id, name in loaded.items():
+                self.put(id, name)
+            names.update(loaded)
+        # Оставшиеся (или все, если пакетной загрузки нет) загружаются по одному
+        for id in missing:
+            if id not in names:
+                names[id] = self.get(id)
+        return names
+
+    def put(self, id: int, name: str) -> None:
+        """
+        Добавляет или обновляет запись в кэше.
+
+        Параметры:
+            id (int): id пользователя или сообщества.
+            name (str): Имя.
+
+        Возвращает:
+            None
+        """
+        if id == 0:
+            self._group_name = name
+            return
+        with self._lock:
+            self._entries[id] = (name, time.monotonic())
+            self._entries.move_to_end(id)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def warm(self, vk_scheduler: VkScheduler, peer_id: int) -> int:
+        """
+        Заполняет кэш участниками беседы и именем собственного сообщества.
+
+        Параметры:
+            vk_scheduler (VkScheduler): Планировщик вызовов API VK.
+            peer_id (int): ID беседы VK.
+
+        Возвращает:
+            int - количество загруженных имён
+        """
+        loaded = 0
+        try:
+            self.get(0)
+            members = vk_scheduler.get_api().messages.getConversationMembers(
+                peer_id=peer_id
+            )
+        except VkApiError as vk_api_error:
+            # Без прав администратора беседы список участников недоступен
+            logging.warning(
+                f"Не удалось заполнить кэш имён беседы {peer_id}: {vk_api_error}"
+            )
+            return loaded
+        for profile in members.get("profiles", []):
+            self.put(
+                profile["id"],
+                str(profile["first_name"]) + " " + str(profile["last_name"]),
+            )
+            loaded += 1
+        for group in members.get("groups", []):
+            self.put(-group["id"], group["name"])
+            loaded += 1
+        return loaded
+
+    def _refresh_loop(self) -> None:
+        """
+        Фоновое обновление устаревших записей.
+        """
+        while True:
+            id = self._refresh_queue.get()
+            try:
+                self.put(id, self._loader(id))
+            except Exception as e:
+                logging.warning(f"Не удалось обновить имя {id}: {e}")
+            finally:
+                with self._lock:
+                    self._pending.discard(id)
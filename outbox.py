@@ -0,0 +1,458 @@
+"""
+Этот модуль содержит устойчивую очередь исходящих сообщений (журнал SQLite).
+Преобразованное сообщение сначала записывается в журнал, а затем доставляется отдельным потоком
+с повторными попытками и экспоненциальной задержкой. Каждое сообщение имеет детерминированный
+ключ идемпотентности (направление, исходный чат, id сообщения), поэтому повторно полученное
+обновление не попадёт в очередь дважды, а повторная отправка в VK использует тот же random_id
+и отбрасывается сервером как дубликат. Уже доставленные части сообщения (текст, вложения)
+отмечаются в журнале и при повторе не отправляются. После перезапуска недоставленные
+сообщения доставляются из журнала.
+В том же журнале хранятся позиции опроса источников (offset Telegram, ts VK), поэтому после
+перезапуска мост продолжает с места остановки.
+Сообщения получателя идут по двум полосам: быстрой (текст, фотографии) и медленной (большие
+вложения). Полосы обслуживаются отдельными пулами потоков, поэтому текст не ждёт загрузки
+больших файлов; порядок соблюдается внутри полосы. Большое сообщение делится отправителем на
+заглушку в быстрой полосе и вложения в медленной.
+
+Классы:
+- RetryLater(delay, reason):
+  Исключение функции отправки: получатель просит подождать (например, 429 Telegram).
+- Delivery(outbox, entry_id, key, parts_done):
+  Состояние доставки одного сообщения, передаётся в функцию отправки.
+- Outbox(path, workers, bulk_workers, deliver):
+  Очередь исходящих сообщений.
+- CursorTracker(outbox, name):
+  Позиция опроса, которая сохраняется, когда все сообщения до неё записаны в журнал.
+
+Функции:
+- countdown(count, done): Функция подтверждения, которая вызывает done после count вызовов.
+
+Использование:
+- outbox.register(direction, send, on_failure) - функция отправки для направления.
+- outbox.put(key, direction, target, payload, created, lane) - поставить сообщение в очередь.
+- Сообщения одного получателя в одной полосе доставляются строго по порядку, разных - параллельно.
+- Функция отправки может выбросить RetryLater(delay): доставка повторится ровно через delay
+  секунд, попытка не засчитывается, а доставленные части не отправляются повторно.
+- outbox.get_cursor(name), outbox.set_cursor(name, value) - позиция опроса источника.
+- Outbox(path, deliver=False) - журнал только для позиций опроса, без потоков доставки.
+- ack = tracker.add(value, count) после каждого ответа источника; ack() вызывается для каждого
+  из count сообщений, когда оно записано в журнал (или отброшено).
+"""
+
+import hashlib
+import json
+import logging
+import random
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+import metrics
+
+# Количество параллельно обслуживаемых получателей в быстрой и медленной полосах
+OUTBOX_WORKERS = 4
+BULK_WORKERS = 2
+# Полосы доставки
+FAST_LANE = "fast"
+BULK_LANE = "bulk"
+# Суммарный размер вложений, начиная с которого они отправляются медленной полосой
+BULK_SIZE = 5 * 1024 * 1024
+# Задержка перед первой повторной попыткой и максимальная задержка, в секундах
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 300.0
+# После стольких неудачных попыток сообщение считается недоставленным
+MAX_ATTEMPTS = 10
+# Сколько хранить доставленные записи для отсева дубликатов, в секундах
+RETENTION = 24 * 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT NOT NULL UNIQUE,
+    direction TEXT NOT NULL,
+    target TEXT NOT NULL,
+    lane TEXT NOT NULL DEFAULT 'fast',
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    parts_done INTEGER NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL DEFAULT 0,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (state, id);
+CREATE TABLE IF NOT EXISTS cursors (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+class RetryLater(Exception):
+    """
+    Доставку нужно повторить позже: получатель ограничил частоту отправки.
+    Попытка не считается неудачной, поэтому сообщение не будет потеряно.
+
+    Параметры:
+        delay (float): Через сколько секунд повторить.
+        reason (str): Причина для журнала.
+    """
+
+    def __init__(self, delay: float, reason: str = "") -> None:
+        super().__init__(f"повтор через {delay:.1f} с: {reason}")
+        self.delay = delay
+
+
+class Delivery:
+    """
+    Состояние доставки одного сообщения.
+    Сообщение состоит из частей (текст, вложения), пронумерованных по порядку отправки.
+
+    Параметры:
+        outbox (Outbox): Очередь, в которой хранится сообщение.
+        entry_id (int): id записи в журнале.
+        key (str): Ключ идемпотентности.
+        parts_done (int): Количество уже доставленных частей.
+    """
+
+    def __init__(self, outbox: "Outbox", entry_id: int, key: str, parts_done: int) -> None:
+        self._outbox = outbox
+        self._entry_id = entry_id
+        self.key = key
+        self.parts_done = parts_done
+
+    def random_id(self, part: int) -> int:
+        """
+        Возвращает детерминированный random_id VK для части сообщения.
+        """
+        digest = hashlib.sha1(f"{self.key}:{part}".encode("utf-8")).hexdigest()
+        return int(digest[:8], 16) & 0x7FFFFFFF
+
+    def done(self, part: int) -> bool:
+        """
+        Проверяет, доставлена ли часть при предыдущих попытках.
+        """
+        return part < self.parts_done
+
+    def mark(self, part: int) -> None:
+        """
+        Отмечает часть доставленной.
+        """
+        if part + 1 > self.parts_done:
+            self.parts_done = part + 1
+            self._outbox._update(self._entry_id, parts_done=self.parts_done)
+
+
+class Outbox:
+    """
+    Устойчивая очередь исходящих сообщений на SQLite.
+
+    Параметры:
+        path (str): Путь к файлу журнала.
+        workers (int): Количество параллельно обслуживаемых получателей в быстрой полосе.
+        bulk_workers (int): То же для медленной полосы.
+        deliver (bool): Запускать ли доставку; без неё журнал хранит только позиции опроса.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        workers: int = OUTBOX_WORKERS,
+        bulk_workers: int = BULK_WORKERS,
+        deliver: bool = True,
+    ) -> None:
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        # Журнал, созданный до появления полос
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(outbox)")]
+        if "lane" not in columns:
+            self._db.execute("ALTER TABLE outbox ADD COLUMN lane TEXT NOT NULL DEFAULT 'fast'")
+        # Индекс для выборки первых сообщений получателей, создаётся после добавления полос
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS outbox_heads ON outbox (state, direction, target, lane, id)"
+        )
+        self._db_lock = threading.Lock()
+        self._handlers = {}
+        # Получатели, сообщение которых сейчас доставляется; меняются из потоков пула
+        self._busy_targets = set()
+        self._busy_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        if not deliver:
+            return
+        self._executors = {
+            FAST_LANE: ThreadPoolExecutor(max_workers=workers, thread_name_prefix="outbox"),
+            BULK_LANE: ThreadPoolExecutor(
+                max_workers=bulk_workers, thread_name_prefix="outbox-bulk"
+            ),
+        }
+        self._dispatcher = threading.Thread(target=self._dispatch_loop, daemon=True)
+        self._dispatcher.start()
+
+    def register(self, direction: str, send: Callable, on_failure: Callable = None) -> None:
+        """
+        Регистрирует функцию отправки для направления.
+
+        Параметры:
+            direction (str): Направление, например tg_to_vk.
+            send (Callable): send(target, payload, delivery) - отправляет сообщение.
+            on_failure (Callable): on_failure(target, error) - вызывается, если доставка не удалась.
+
+        Возвращает:
+            None
+        """
+        self._handlers[direction] = (send, on_failure)
+        self._notify()
+
+    def put(
+        self,
+        key: str,
+        direction: str,
+        target,
+        payload: dict,
+        created: float = None,
+        lane: str = FAST_LANE,
+    ) -> bool:
+        """
+        Записывает сообщение в журнал.
+
+        Параметры:
+            key (str): Ключ идемпотентности.
+            direction (str): Направление.
+            target: Получатель (id чата), сохраняется в JSON.
+            payload (dict): Сообщение, сохраняется в JSON.
+            created (float): Время отправки сообщения в источнике (unix time), по нему считается
+                задержка доставки; по умолчанию - текущее время.
+            lane (str): Полоса доставки, FAST_LANE или BULK_LANE.
+
+        Возвращает:
+            bool - False, если сообщение с таким ключом уже было в очереди
+        """
+        with self._db_lock:
+            cursor = self._db.execute(
+                "INSERT OR IGNORE INTO outbox (key, direction, target, lane, payload, created)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    direction,
+                    json.dumps(target),
+                    lane,
+                    json.dumps(payload, ensure_ascii=False),
+                    created or time.time(),
+                ),
+            )
+        self._notify()
+        return cursor.rowcount > 0
+
+    def get_cursor(self, name: str) -> Optional[str]:
+        """
+        Возвращает сохранённую позицию опроса источника.
+
+        Параметры:
+            name (str): Имя позиции, например tg:offset.
+
+        Возвращает:
+            str или None, если позиция ещё не сохранялась
+        """
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT value FROM cursors WHERE name = ?", (name,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_cursor(self, name: str, value) -> None:
+        """
+        Сохраняет позицию опроса источника. Сохраняйте её после того, как полученные
+        сообщения записаны в журнал.
+
+        Параметры:
+            name (str): Имя позиции.
+            value: Значение, сохраняется строкой.
+
+        Возвращает:
+            None
+        """
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO cursors (name, value) VALUES (?, ?)",
+                (name, str(value)),
+            )
+
+    def depth(self) -> int:
+        """
+        Возвращает количество недоставленных сообщений.
+        """
+        with self._db_lock:
+            return self._db.execute(
+                "SELECT COUNT(*) FROM outbox WHERE state = 'pending'"
+            ).fetchone()[0]
+
+    def _notify(self) -> None:
+        self._wakeup.set()
+
+    def _update(self, entry_id: int, **values) -> None:
+        columns = ", ".join(f"{column} = ?" for column in values)
+        with self._db_lock:
+            self._db.execute(
+                f"UPDATE outbox SET {columns} WHERE id = ?", (*values.values(), entry_id)
+            )
+
+    def _dispatch_loop(self) -> None:
+        """
+        Выбирает первое недоставленное сообщение каждой полосы получателя и отправляет его в пул.
+        """
+        last_cleanup = 0.0
+        while True:
+            now = time.time()
+            if now - last_cleanup > 3600:
+                with self._db_lock:
+                    self._db.execute(
+                        "DELETE FROM outbox WHERE state != 'pending' AND created < ?",
+                        (now - RETENTION,),
+                    )
+                last_cleanup = now
+            # Выбираются только первые сообщения полос получателей: следующие ждут, пока
+            # не будет доставлено первое, поэтому длинная очередь не перечитывается целиком
+            with self._db_lock:
+                rows = self._db.execute(
+                    "SELECT id, key, direction, target, payload, parts_done, attempts, next_attempt,"
+                    " created, lane FROM outbox WHERE id IN (SELECT MIN(id) FROM outbox"
+                    " WHERE state = 'pending' GROUP BY direction, target, lane) ORDER BY id"
+                ).fetchall()
+            wait = None
+            for row in rows:
+                target = (row[2], row[3], row[9])
+                if row[2] not in self._handlers:
+                    continue
+                if row[7] > now:
+                    wait = row[7] - now if wait is None else min(wait, row[7] - now)
+                    continue
+                with self._busy_lock:
+                    if target in self._busy_targets:
+                        continue
+                    self._busy_targets.add(target)
+                self._executors.get(row[9], self._executors[FAST_LANE]).submit(self._deliver, row)
+            self._wakeup.wait(timeout=wait if wait is not None else 5)
+            self._wakeup.clear()
+
+    def _deliver(self, row: tuple) -> None:
+        """
+        Доставляет одно сообщение и обновляет журнал.
+        """
+        entry_id, key, direction, raw_target, payload, parts_done, attempts, _, created, lane = row
+        send, on_failure = self._handlers[direction]
+        target = json.loads(raw_target)
+        try:
+            send(target, json.loads(payload), Delivery(self, entry_id, key, parts_done))
+            self._update(entry_id, state="done")
+            metrics.inc("bridge_messages_total", direction=direction, result="delivered")
+            metrics.observe(
+                "bridge_delivery_lag_seconds", time.time() - created, direction=direction
+            )
+        except RetryLater as e:
+            metrics.inc("bridge_messages_total", direction=direction, result="deferred")
+            logging.info(f"Доставка {key} отложена, {e}")
+            self._update(entry_id, next_attempt=time.time() + e.delay)
+        except Exception as e:
+            attempts += 1
+            if attempts >= MAX_ATTEMPTS:
+                metrics.inc("bridge_messages_total", direction=direction, result="failed")
+                logging.error(f"Сообщение {key} не доставлено после {attempts} попыток: {e}")
+                self._update(entry_id, state="failed", attempts=attempts)
+                if on_failure is not None:
+                    try:
+                        on_failure(target, e)
+                    except Exception as failure_error:
+                        logging.error(
+                            f"Невозможно доставить сообщение об ошибке пользователю. Тип ошибки: {type(failure_error)}, Описание: {failure_error}"
+                        )
+            else:
+                metrics.inc("bridge_messages_total", direction=direction, result="retry")
+                delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempts - 1))
+                delay *= random.uniform(0.5, 1.0)
+                logging.warning(
+                    f"Ошибка доставки {key}, попытка {attempts}, повтор через {delay:.1f} с: {e}"
+                )
+                self._update(entry_id, attempts=attempts, next_attempt=time.time() + delay)
+        finally:
+            with self._busy_lock:
+                self._busy_targets.discard((direction, raw_target, lane))
+            self._notify()
+
+
+class CursorTracker:
+    """
+    Позиция опроса источника, которая сохраняется только тогда, когда все сообщения, полученные
+    до неё, записаны в журнал. Сообщения могут задерживаться в сборщике альбомов и склейщике,
+    поэтому позиция, сохранённая сразу после получения, при падении процесса потеряла бы их.
+
+    Параметры:
+        outbox (Outbox): Журнал, в котором хранится позиция.
+        name (str): Имя позиции.
+    """
+
+    def __init__(self, outbox: Outbox, name: str) -> None:
+        self._outbox = outbox
+        self.name = name
+        self._batches = deque()  # [неподтверждённые сообщения, позиция] по порядку получения
+        self._lock = threading.Lock()
+
+    def add(self, value, count: int) -> Callable[[], None]:
+        """
+        Регистрирует ответ источника из count сообщений, после которого позиция равна value.
+
+        Параметры:
+            value: Позиция после этих сообщений.
+            count (int): Количество сообщений.
+
+        Возвращает:
+            Callable - функция подтверждения, вызывается по разу для каждого сообщения
+        """
+        batch = [count, value]
+        with self._lock:
+            self._batches.append(batch)
+            self._commit()
+
+        def ack():
+            with self._lock:
+                batch[0] -= 1
+                self._commit()
+
+        return ack
+
+    def _commit(self) -> None:
+        # Вызывается под блокировкой, чтобы позиции сохранялись по порядку
+        value = None
+        while self._batches and self._batches[0][0] <= 0:
+            value = self._batches.popleft()[1]
+        if value is not None:
+            self._outbox.set_cursor(self.name, value)
+
+
+def countdown(count: int, done: Callable[[], None]) -> Callable[[], None]:
+    """
+    Объединяет подтверждения нескольких сообщений в одно.
+
+    Параметры:
+        count (int): Количество сообщений.
+        done (Callable): Вызывается, когда подтверждены все сообщения (сразу, если count == 0).
+
+    Возвращает:
+        Callable - функция подтверждения, вызывается по разу для каждого сообщения
+    """
+    remaining = [count]
+    lock = threading.Lock()
+
+    def ack():
+        with lock:
+            remaining[0] -= 1
+            finished = remaining[0] == 0
+        if finished:
+            done()
+
+    if count == 0:
+        done()
+    return ack
@@ -0,0 +1,113 @@
+"""
+Этот модуль содержит таблицу маршрутизации пар чатов Telegram и VK.
+Один процесс с одним опросом Telegram и одним long poll VK обслуживает много пар чатов;
+пара для входящего обновления находится по словарю за O(1).
+
+Классы:
+- ChatPair(tg_chat_id, vk_chat_id, tg_to_vk, vk_to_tg):
+  Пара связанных чатов и включённые направления пересылки.
+- RoutingTable(pairs):
+  Таблица маршрутизации.
+
+Формат файла маршрутов (JSON):
+    {
+        "pairs": [
+            {"telegram_chat_id": -100123, "vk_chat_id": 2000000001},
+            {"telegram_chat_id": -100456, "vk_chat_id": 2000000002, "vk_to_tg": false}
+        ]
+    }
+
+Использование:
+- RoutingTable.from_file(path) - загрузить маршруты из файла.
+- RoutingTable.single(tg_chat_id, vk_chat_id) - одна пара из переменных окружения.
+"""
+
+import json
+from typing import NamedTuple, Optional
+
+
+class ChatPair(NamedTuple):
+    """
+    Пара связанных чатов Telegram и VK.
+    """
+
+    tg_chat_id: int
+    vk_chat_id: int
+    tg_to_vk: bool = True
+    vk_to_tg: bool = True
+
+
+class RoutingTable:
+    """
+    Таблица маршрутизации пар чатов.
+
+    Параметры:
+        pairs (list): Список ChatPair.
+    """
+
+    def __init__(self, pairs: list) -> None:
+        self.pairs = list(pairs)
+        self._by_tg = {}
+        self._by_vk = {}
+        for pair in self.pairs:
+            if pair.tg_chat_id in self._by_tg or pair.vk_chat_id in self._by_vk:
+                raise ValueError(f"Чат из пары {pair} уже указан в другой паре")
+            self._by_tg[pair.tg_chat_id] = pair
+            self._by_vk[pair.vk_chat_id] = pair
+
+    @classmethod
+    def single(
+        cls, tg_chat_id: int, vk_chat_id: int, tg_to_vk: bool = True, vk_to_tg: bool = True
+    ) -> "RoutingTable":
+        """
+        Создаёт таблицу из одной пары чатов.
+        """
+        return cls([ChatPair(tg_chat_id, vk_chat_id, tg_to_vk, vk_to_tg)])
+
+    @classmethod
+    def from_file(cls, path: str) -> "RoutingTable":
+        """
+        Загружает таблицу из JSON-файла.
+
+        Параметры:
+            path (str): Путь к файлу маршрутов.
+
+        Возвращает:
+            RoutingTable
+        """
+        with open(path, encoding="utf-8") as file:
+            config = json.load(file)
+        return cls(
+            ChatPair(
+                int(pair["telegram_chat_id"]),
+                int(pair["vk_chat_id"]),
+                bool(pair.get("tg_to_vk", True)),
+                bool(pair.get("vk_to_tg", True)),
+            )
+            for pair in config["pairs"]
+        )
+
+    def for_telegram(self, chat_id: int) -> Optional[ChatPair]:
+        """
+        Возвращает пару для чата Telegram, если пересылка из него в VK включена.
+        """
+        pair = self._by_tg.get(chat_id)
+        return pair if pair is not None and pair.tg_to_vk else None
+
+    def for_vk(self, peer_id: int) -> Optional[ChatPair]:
+        """
+        Возвращает пару для беседы VK, если пересылка из неё в Telegram включена.
+        """
+        pair = self._by_vk.get(peer_id)
+        return pair if pair is not None and pair.vk_to_tg else None
+
+    def restricted(self, tg_to_vk: bool, vk_to_tg: bool) -> "RoutingTable":
+        """
+        Возвращает таблицу, в которой направления дополнительно ограничены глобальными флагами.
+        """
+        return RoutingTable(
+            pair._replace(
+                tg_to_vk=pair.tg_to_vk and tg_to_vk, vk_to_tg=pair.vk_to_tg and vk_to_tg
+            )
+            for pair in self.pairs
+        )
@@ -10,14 +10,26 @@
 - Запустите этот модуль для запуска бота.
 """
 
+import asyncio
 import logging
 import os
-import threading
-import time
+import vk_api
 from dotenv import load_dotenv
 
+import httppool
+import mediasize
+import metrics
+from mediacache import MediaCache
+from messagemap import MessageMap
+from outbox import Outbox
+from routing import RoutingTable
+from sharding import Intake, WorkerConfig
+from supervisor import STALL_TIMEOUT, Supervisor
+from tggovernor import TelegramGovernor
 from tgvk import listen_telegram
-from vktg import listen_vk
+from vktg import create_name_cache, listen_vk
+from vkscheduler import VK_API_VERSION, VkScheduler
+from webhook import WebhookConfig
 
 load_dotenv()
 # Setup logging
@@ -25,13 +37,15 @@ logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
 )
 logging.getLogger().setLevel(logging.WARNING)
+# Файл маршрутов с парами чатов; без него используется одна пара из TELEGRAM_CHAT_ID и VK_CHAT_ID
+BRIDGE_ROUTES = os.environ.get("BRIDGE_ROUTES")
 required_values = [
     "TELEGRAM_BOT_TOKEN",
-    "TELEGRAM_CHAT_ID",
     "VK_GROUP_TOKEN",
     "VK_GROUP_ID",
-    "VK_CHAT_ID",
 ]
+if BRIDGE_ROUTES is None:
+    required_values += ["TELEGRAM_CHAT_ID", "VK_CHAT_ID"]
 missing_values = [value for value in required_values if os.environ.get(value) is None]
 if len(missing_values) > 0:
     logging.error(
@@ -41,29 +55,169 @@ if len(missing_values) > 0:
 
 VK_GROUP_TOKEN = os.environ.get("VK_GROUP_TOKEN")
 VK_GROUP_ID = int(os.environ.get("VK_GROUP_ID"))
-VK_CHAT_ID = int(os.environ.get("VK_CHAT_ID"))
 TG_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
-TG_CHAT_ID = int(os.environ.get("TELEGRAM_CHAT_ID"))
 # BOT_LANGUAGE = os.environ.get("BOT_LANG", "ru")
 TG_TO_VK = os.environ.get("TG_TO_VK", "True") == "True"
 VK_TO_TG = os.environ.get("VK_TO_TG", "True") == "True"
+if BRIDGE_ROUTES is not None:
+    ROUTES = RoutingTable.from_file(BRIDGE_ROUTES).restricted(TG_TO_VK, VK_TO_TG)
+else:
+    ROUTES = RoutingTable.single(
+        int(os.environ.get("TELEGRAM_CHAT_ID")),
+        int(os.environ.get("VK_CHAT_ID")),
+        TG_TO_VK,
+        VK_TO_TG,
+    )
+# Журнал очереди исходящих сообщений
+OUTBOX_PATH = os.environ.get("OUTBOX_PATH", "outbox.sqlite3")
+# Движок моста: threads - по потоку на направление, asyncio - один цикл событий
+BRIDGE_ENGINE = os.environ.get("BRIDGE_ENGINE", "threads")
+# Количество процессов-обработчиков; 1 - всё в одном процессе
+BRIDGE_WORKERS = int(os.environ.get("BRIDGE_WORKERS", "1"))
+# Окно склейки коротких текстовых сообщений в секундах, 0 - без склейки
+COALESCE_WINDOW = float(os.environ.get("COALESCE_WINDOW", "0"))
+# Кэш уже переданных медиафайлов
+MEDIA_CACHE_PATH = os.environ.get("MEDIA_CACHE_PATH", "mediacache.sqlite3")
+# Соответствие пересланных сообщений для настоящих ответов
+MESSAGE_MAP_PATH = os.environ.get("MESSAGE_MAP_PATH", "messagemap.sqlite3")
+# Целевое разрешение фотографий по длинной стороне: выбирается наименьший подходящий размер
+MEDIA_TARGET_RESOLUTION = int(os.environ.get("MEDIA_TARGET_RESOLUTION", "1280"))
+# Порт HTTP-сервера метрик Prometheus (GET /metrics); без него метрики не публикуются
+METRICS_PORT = os.environ.get("METRICS_PORT")
+# Публичный адрес webhook Telegram; без него обновления получаются длинным опросом
+TG_WEBHOOK_URL = os.environ.get("TG_WEBHOOK_URL")
+TG_WEBHOOK = (
+    WebhookConfig(
+        TG_WEBHOOK_URL,
+        os.environ.get("TG_WEBHOOK_SECRET"),
+        os.environ.get("TG_WEBHOOK_HOST", "0.0.0.0"),
+        int(os.environ.get("TG_WEBHOOK_PORT", "8443")),
+        int(os.environ.get("TG_WEBHOOK_WORKERS", "4")),
+    )
+    if TG_WEBHOOK_URL
+    else None
+)
 
 
 if __name__ == "__main__":
     # print("BOT started")
-    # Запуск потоков
+    # Общий пул HTTP-соединений и планировщик вызовов API VK для обоих направлений
+    httppool.install_telebot_session()
+    mediasize.configure(MEDIA_TARGET_RESOLUTION)
+    vk_scheduler = VkScheduler(
+        vk_api.VkApi(
+            token=VK_GROUP_TOKEN,
+            session=httppool.get_session(),
+            api_version=VK_API_VERSION,
+        )
+    )
+    if METRICS_PORT is not None:
+        metrics.serve(int(METRICS_PORT))
+        metrics.gauge("bridge_vk_queue_depth", vk_scheduler.depth)
+    if BRIDGE_ENGINE == "asyncio":
+        # Асинхронный движок не поддерживает журнал, позиции опроса и надзор за слушателями
+        if BRIDGE_WORKERS > 1 or TG_WEBHOOK is not None:
+            logging.error("BRIDGE_ENGINE=asyncio несовместим с BRIDGE_WORKERS > 1 и TG_WEBHOOK_URL")
+            exit(1)
+        logging.error(
+            "BRIDGE_ENGINE=asyncio - экспериментальный движок: без очереди исходящих сообщений,"
+            " сохранения позиций опроса, догрузки пропущенного и перезапуска слушателей."
+            " Сообщения, отправленные во время сбоя или простоя, будут потеряны"
+        )
+        # aiohttp нужен только асинхронному движку
+        from aiobridge import AsyncBridge
+
+        asyncio.run(
+            AsyncBridge(TG_TOKEN, ROUTES, vk_scheduler, VK_GROUP_ID).run()
+        )
+        exit(0)
+    if BRIDGE_WORKERS > 1:
+        # Журнал процесса приёма хранит только позиции опроса: сообщения доставляют обработчики
+        # из своих журналов
+        intake_outbox = Outbox(OUTBOX_PATH, deliver=False)
+        if intake_outbox.depth():
+            logging.error(
+                f"В {OUTBOX_PATH} остались недоставленные сообщения ({intake_outbox.depth()}):"
+                " запустите мост без BRIDGE_WORKERS, дождитесь их доставки и перезапустите"
+            )
+            exit(1)
+        # Этот процесс только принимает обновления и раздаёт их обработчикам по парам чатов
+        intake = Intake(
+            WorkerConfig(
+                TG_TOKEN,
+                VK_GROUP_TOKEN,
+                VK_GROUP_ID,
+                OUTBOX_PATH,
+                MEDIA_CACHE_PATH,
+                MESSAGE_MAP_PATH,
+                COALESCE_WINDOW,
+                MEDIA_TARGET_RESOLUTION,
+                int(METRICS_PORT) if METRICS_PORT is not None else None,
+            ),
+            ROUTES,
+            BRIDGE_WORKERS,
+            intake_outbox,
+        )
+        supervisor = Supervisor()
+        metrics.check("/livez", supervisor.live)
+        metrics.check("/readyz", supervisor.ready)
+        for shard in intake.shards():
+            supervisor.add(f"worker-{shard}", intake.run_worker, (shard,))
+        if VK_TO_TG:
+            supervisor.add("vk", intake.poll_vk, (vk_scheduler.vk_session,))
+        if TG_TO_VK:
+            supervisor.add(
+                "telegram",
+                intake.poll_telegram,
+                (TG_WEBHOOK,),
+                stall_timeout=None if TG_WEBHOOK else STALL_TIMEOUT,
+            )
+        supervisor.run()
+        exit(0)
+    # Очередь исходящих сообщений для обоих направлений
+    outbox = Outbox(OUTBOX_PATH)
+    media_cache = MediaCache(MEDIA_CACHE_PATH)
+    message_map = MessageMap(MESSAGE_MAP_PATH)
+    metrics.gauge("bridge_outbox_depth", outbox.depth)
+    # Слушатели работают в потоках под надзором: упавший перезапускается, зависший
+    # отмечается в проверке liveness
+    supervisor = Supervisor()
+    metrics.check("/livez", supervisor.live)
+    metrics.check("/readyz", supervisor.ready)
     if VK_TO_TG:
-        thread_vk = threading.Thread(
-            target=listen_vk,
-            args=(VK_GROUP_TOKEN, VK_GROUP_ID, VK_CHAT_ID, TG_TOKEN, TG_CHAT_ID),
+        # Кэш имён и регулятор отправки переживают перезапуски слушателя
+        supervisor.add(
+            "vk",
+            listen_vk,
+            (
+                vk_scheduler,
+                VK_GROUP_ID,
+                ROUTES,
+                TG_TOKEN,
+                outbox,
+                COALESCE_WINDOW,
+                media_cache,
+                message_map,
+                TelegramGovernor(),
+                None,
+                create_name_cache(vk_scheduler, ROUTES),
+            ),
         )
-        thread_vk.start()
     if TG_TO_VK:
-        thread_telegram = threading.Thread(
-            target=listen_telegram,
-            args=(TG_TOKEN, TG_CHAT_ID, VK_GROUP_TOKEN, VK_CHAT_ID),
+        supervisor.add(
+            "telegram",
+            listen_telegram,
+            (
+                TG_TOKEN,
+                ROUTES,
+                vk_scheduler,
+                outbox,
+                COALESCE_WINDOW,
+                media_cache,
+                TG_WEBHOOK,
+                message_map,
+            ),
+            # Webhook только принимает запросы, опроса, который может зависнуть, нет
+            stall_timeout=None if TG_WEBHOOK else STALL_TIMEOUT,
         )
-        thread_telegram.start()
-
-    while True:
-        time.sleep(1)  # Бесконечный цикл с паузой, чтобы не загружать процессор
+    supervisor.run()
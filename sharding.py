@@ -0,0 +1,480 @@
+"""
+Этот модуль содержит многопроцессный режим моста.
+Один процесс упирается в GIL: преобразование сообщений, разбор JSON, TLS и обработка медиа
+занимают одно ядро. В многопроцессном режиме основной процесс только принимает обновления
+(getUpdates или webhook Telegram и Bots Long Poll VK) и раздаёт их процессам-обработчикам
+через очереди multiprocessing. Обработчик выбирается по хэшу пары чатов, поэтому все
+сообщения пары идут в один процесс и в одну очередь, и их порядок сохраняется.
+
+Каждый обработчик - обычные listen_telegram и listen_vk, которые берут обновления из очереди
+вместо опроса, со своим журналом исходящих сообщений (outbox.N.sqlite3) и своей долей
+ограничений частоты API VK и Telegram. Подтверждение обновления проходит вместе с сообщением
+через сборщик альбомов и склейщик и отправляется процессу приёма, когда сообщение записано
+в журнал (обновление, которое не пересылается, подтверждается сразу после обработки); позиция
+опроса сохраняется только тогда, когда подтверждены все обновления до неё. Упавший или зависший обработчик перезапускается, и неподтверждённые обновления
+передаются ему повторно (повторы отсеивает журнал по ключу идемпотентности).
+
+Классы:
+- WorkerConfig(...):
+  Параметры процесса-обработчика.
+- Intake(config, routes, workers, outbox):
+  Приём обновлений и раздача их процессам-обработчикам.
+
+Функции:
+- shard_of(pair, workers): Номер обработчика пары чатов.
+- shard_path(path, shard): Путь к журналу обработчика.
+- run_worker(shard, workers, config, routes, inbox, events, parent_pid):
+  Точка входа процесса-обработчика.
+
+Использование:
+- intake = Intake(config, routes, workers, outbox), затем под надзором Supervisor:
+  intake.run_worker(shard) для каждого номера из intake.shards(), intake.poll_vk(vk_session)
+  и intake.poll_telegram(webhook).
+- Число обработчиков нельзя менять, пока в журналах обработчиков есть недоставленные сообщения:
+  пары чатов перераспределятся между журналами.
+"""
+
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+from functools import partial
+from typing import Callable, NamedTuple, Optional
+
+import telebot
+import vk_api
+from telebot import apihelper
+from vk_api.bot_longpoll import VkBotEventType
+
+import httppool
+import mediasize
+import metrics
+from backfill import ResumableLongPoll
+from mediacache import MediaCache
+from messagemap import MessageMap
+from outbox import Outbox
+from routing import ChatPair, RoutingTable
+from supervisor import STALL_TIMEOUT, Supervisor
+from tggovernor import GLOBAL_RATE, TelegramGovernor
+from tgvk import TG_OFFSET_CURSOR, listen_telegram
+from vkscheduler import VK_API_VERSION, VK_RPS, VkScheduler
+from vktg import VK_TS_CURSOR, create_name_cache, listen_vk
+from webhook import WebhookConfig, serve_webhook
+
+# Как часто обработчик сообщает процессу приёма, что он жив, в секундах
+BEAT_INTERVAL = 5.0
+# Время ожидания getUpdates в секундах
+LONG_POLL_TIMEOUT = 20
+
+
+class WorkerConfig(NamedTuple):
+    """
+    Параметры процесса-обработчика. Передаются в новый процесс, поэтому содержат только
+    простые значения.
+    """
+
+    tg_token: str
+    vk_token: str
+    vk_group_id: int
+    outbox_path: str
+    media_cache_path: str
+    message_map_path: str
+    coalesce_window: float = 0.0
+    target_resolution: int = mediasize.TARGET_RESOLUTION
+    metrics_port: Optional[int] = None
+
+
+class _Batch:
+    """
+    Обновления одного ответа источника и позиция опроса после них.
+    """
+
+    __slots__ = ("cursor", "value", "remaining", "done")
+
+    def __init__(self, cursor: Optional[str], value, done: Callable[[], None] = None) -> None:
+        self.cursor = cursor
+        self.value = value
+        self.remaining = set()
+        self.done = done
+
+
+def shard_of(pair: ChatPair, workers: int) -> int:
+    """
+    Возвращает номер обработчика пары чатов. Хэш не зависит от запуска процесса,
+    поэтому после перезапуска пара попадает к тому же обработчику и в тот же журнал.
+
+    Параметры:
+        pair (ChatPair): Пара чатов.
+        workers (int): Количество обработчиков.
+
+    Возвращает:
+        int
+    """
+    return zlib.crc32(f"{pair.tg_chat_id}:{pair.vk_chat_id}".encode()) % workers
+
+
+def shard_path(path: str, shard: int) -> str:
+    """
+    Возвращает путь к журналу обработчика: outbox.sqlite3 -> outbox.0.sqlite3.
+
+    Параметры:
+        path (str): Путь к журналу процесса приёма.
+        shard (int): Номер обработчика.
+
+    Возвращает:
+        str
+    """
+    root, extension = os.path.splitext(path)
+    return f"{root}.{shard}{extension}"
+
+
+class Intake:
+    """
+    Приём обновлений Telegram и VK и раздача их процессам-обработчикам.
+
+    Параметры:
+        config (WorkerConfig): Параметры обработчиков.
+        routes (RoutingTable): Таблица маршрутов пар чатов.
+        workers (int): Количество обработчиков.
+        outbox (Outbox): Журнал процесса приёма без доставки (deliver=False), в нём хранятся
+            позиции опроса.
+    """
+
+    def __init__(
+        self, config: WorkerConfig, routes: RoutingTable, workers: int, outbox: Outbox
+    ) -> None:
+        self._config = config
+        self._routes = routes
+        self._workers = workers
+        self._outbox = outbox
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._inboxes = [None] * workers
+        # Неподтверждённые обновления каждого обработчика: номер -> (вид, обновление)
+        self._unacked = [OrderedDict() for _ in range(workers)]
+        self._batches = {}  # номер обновления -> партия
+        self._pending = {}  # позиция опроса -> партии по порядку
+        metrics.gauge(
+            "bridge_intake_unacked", lambda: sum(len(unacked) for unacked in self._unacked)
+        )
+
+    def shards(self) -> list:
+        """
+        Возвращает номера обработчиков, которым досталась хотя бы одна пара чатов.
+        """
+        return sorted({shard_of(pair, self._workers) for pair in self._routes.pairs})
+
+    def submit(
+        self, items: list, cursor: str = None, value=None, done: Callable[[], None] = None
+    ) -> None:
+        """
+        Передаёт обновления обработчикам. Позиция опроса cursor сохраняется со значением value,
+        когда подтверждены эти и все более ранние обновления источника.
+
+        Параметры:
+            items (list): Обновления в виде (номер обработчика, вид "tg" или "vk", обновление).
+            cursor (str): Имя позиции опроса или None.
+            value: Позиция после этих обновлений.
+            done (Callable): Вызывается, когда подтверждены все эти обновления.
+
+        Возвращает:
+            None
+        """
+        if not items and done is not None:
+            done()
+        with self._lock:
+            batch = _Batch(cursor, value, done)
+            for shard, kind, raw in items:
+                self._seq += 1
+                self._unacked[shard][self._seq] = (kind, raw)
+                self._batches[self._seq] = batch
+                batch.remaining.add(self._seq)
+                # Обработчику, который сейчас перезапускается, обновление передаст run_worker
+                if self._inboxes[shard] is not None:
+                    self._inboxes[shard].put((kind, self._seq, raw))
+            if cursor is not None:
+                self._pending.setdefault(cursor, deque()).append(batch)
+                self._commit(cursor)
+
+    def poll_telegram(
+        self, webhook: WebhookConfig = None, heartbeat: Callable[[], None] = None
+    ) -> None:
+        """
+        Получает обновления Telegram и раздаёт их обработчикам. Ошибки не перехватываются:
+        приём перезапускает Supervisor.
+
+        Параметры:
+            webhook (WebhookConfig): Параметры webhook; без них - длинный опрос.
+            heartbeat (Callable): Вызывается после каждого цикла опроса.
+
+        Возвращает:
+            None
+        """
+        token = self._config.tg_token
+        if webhook is not None:
+            bot = telebot.TeleBot(token, parse_mode=None, threaded=False)
+            serve_webhook(
+                bot,
+                webhook,
+                lambda update, done: self.submit(self._telegram_items([update]), done=done),
+            )
+            return
+        apihelper.delete_webhook(token)
+        offset = self._outbox.get_cursor(TG_OFFSET_CURSOR)
+        while True:
+            # Обновления разбираются обработчиками, здесь только JSON
+            updates = apihelper.get_updates(
+                token,
+                int(offset) + 1 if offset is not None else None,
+                None,
+                LONG_POLL_TIMEOUT,
+                None,
+                LONG_POLL_TIMEOUT,
+            )
+            if updates:
+                offset = max(update["update_id"] for update in updates)
+                self.submit(self._telegram_items(updates), TG_OFFSET_CURSOR, offset)
+            if heartbeat is not None:
+                heartbeat()
+
+    def poll_vk(self, vk_session: vk_api.VkApi, heartbeat: Callable[[], None] = None) -> None:
+        """
+        Получает события Bots Long Poll VK и раздаёт сообщения обработчикам. Если события
+        потеряны, каждый обработчик с беседами VK догружает историю сам: последние пересланные
+        сообщения бесед хранятся в его журнале.
+
+        Параметры:
+            vk_session (vk_api.VkApi): Сессия API VK.
+            heartbeat (Callable): Вызывается после каждого цикла опроса.
+
+        Возвращает:
+            None
+        """
+        longpoll = ResumableLongPoll(
+            vk_session, self._config.vk_group_id, self._outbox.get_cursor(VK_TS_CURSOR)
+        )
+        longpoll.session = httppool.get_session()
+        vk_shards = sorted(
+            {shard_of(pair, self._workers) for pair in self._routes.pairs if pair.vk_to_tg}
+        )
+        while True:
+            events = longpoll.check()
+            items = []
+            if longpoll.lost:
+                items += [(shard, "vk", None) for shard in vk_shards]
+                longpoll.lost = False
+            for event in events:
+                if event.type != VkBotEventType.MESSAGE_NEW:
+                    continue
+                message = event.raw["object"]["message"]
+                pair = self._routes.for_vk(message["peer_id"])
+                if pair is not None:
+                    items.append((shard_of(pair, self._workers), "vk", message))
+            self.submit(items, VK_TS_CURSOR, longpoll.ts)
+            if heartbeat is not None:
+                heartbeat()
+
+    def run_worker(self, shard: int, heartbeat: Callable[[], None] = None) -> None:
+        """
+        Запускает процесс-обработчик и принимает от него подтверждения, пока он работает.
+        Обработчик, который дольше STALL_TIMEOUT не сообщает о себе, завершается, чтобы
+        Supervisor запустил его заново.
+
+        Параметры:
+            shard (int): Номер обработчика.
+            heartbeat (Callable): Вызывается, когда обработчик сообщает, что он жив.
+
+        Возвращает:
+            None
+        """
+        # Новый процесс запускается с чистого интерпретатора: fork скопировал бы потоки
+        # и соединения с базами процесса приёма
+        context = multiprocessing.get_context("spawn")
+        inbox = context.Queue()
+        events = context.Queue()
+        routes = RoutingTable(
+            pair for pair in self._routes.pairs if shard_of(pair, self._workers) == shard
+        )
+        process = context.Process(
+            target=run_worker,
+            args=(shard, self._workers, self._config, routes, inbox, events, os.getpid()),
+            name=f"bridge-worker-{shard}",
+        )
+        process.start()
+        with self._lock:
+            # Неподтверждённые обновления передаются заново в прежнем порядке
+            for seq, (kind, raw) in self._unacked[shard].items():
+                inbox.put((kind, seq, raw))
+            self._inboxes[shard] = inbox
+        last_beat = time.monotonic()
+        try:
+            while process.is_alive():
+                try:
+                    event = events.get(timeout=1)
+                except queue.Empty:
+                    if time.monotonic() - last_beat > STALL_TIMEOUT:
+                        logging.error(f"Обработчик {shard} не отвечает, процесс будет перезапущен")
+                        break
+                    continue
+                if event[0] == "ack":
+                    self._ack(shard, event[1])
+                else:
+                    last_beat = time.monotonic()
+                    if heartbeat is not None:
+                        heartbeat()
+        finally:
+            with self._lock:
+                self._inboxes[shard] = None
+            if process.is_alive():
+                process.kill()
+            process.join()
+            # Подтверждения, отправленные перед завершением
+            try:
+                while True:
+                    event = events.get_nowait()
+                    if event[0] == "ack":
+                        self._ack(shard, event[1])
+            except Exception:
+                pass
+            # Очередь завершённого процесса больше не читается, её буфер не ждём
+            inbox.cancel_join_thread()
+        logging.error(f"Обработчик {shard} завершился с кодом {process.exitcode}")
+
+    def _telegram_items(self, updates: list) -> list:
+        items = []
+        for update in updates:
+            message = update.get("message")
+            if message is None:
+                continue
+            pair = self._routes.for_telegram(message["chat"]["id"])
+            if pair is not None:
+                items.append((shard_of(pair, self._workers), "tg", update))
+        return items
+
+    def _ack(self, shard: int, seq: int) -> None:
+        with self._lock:
+            self._unacked[shard].pop(seq, None)
+            batch = self._batches.pop(seq, None)
+            if batch is None:
+                return
+            batch.remaining.discard(seq)
+            finished = not batch.remaining
+            if batch.cursor is not None:
+                self._commit(batch.cursor)
+        if finished and batch.done is not None:
+            batch.done()
+
+    def _commit(self, cursor: str) -> None:
+        # Вызывается под блокировкой, чтобы позиции сохранялись по порядку
+        batches = self._pending.get(cursor)
+        value = None
+        while batches and not batches[0].remaining:
+            value = batches.popleft().value
+        if value is not None:
+            self._outbox.set_cursor(cursor, value)
+
+
+def run_worker(
+    shard: int,
+    workers: int,
+    config: WorkerConfig,
+    routes: RoutingTable,
+    inbox: multiprocessing.Queue,
+    events: multiprocessing.Queue,
+    parent_pid: int,
+) -> None:
+    """
+    Точка входа процесса-обработчика: запускает listen_telegram и listen_vk для своих пар чатов
+    и передаёт им обновления из очереди. Завершается вместе с процессом приёма.
+
+    Параметры:
+        shard (int): Номер обработчика.
+        workers (int): Количество обработчиков.
+        config (WorkerConfig): Параметры обработчика.
+        routes (RoutingTable): Пары чатов этого обработчика.
+        inbox (multiprocessing.Queue): Обновления (вид, номер, обновление).
+        events (multiprocessing.Queue): Подтверждения ("ack", номер) и ("beat",).
+        parent_pid (int): PID процесса приёма.
+
+    Возвращает:
+        None
+    """
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.WARNING
+    )
+    httppool.install_telebot_session()
+    mediasize.configure(config.target_resolution)
+    # Ограничения частоты API общие для бота и сообщества, поэтому делятся между обработчиками;
+    # ограничения чатов остаются целыми - каждый чат обслуживает один обработчик
+    vk_scheduler = VkScheduler(
+        vk_api.VkApi(
+            token=config.vk_token, session=httppool.get_session(), api_version=VK_API_VERSION
+        ),
+        rate=VK_RPS / workers,
+    )
+    outbox = Outbox(shard_path(config.outbox_path, shard))
+    media_cache = MediaCache(config.media_cache_path)
+    message_map = MessageMap(config.message_map_path)
+    if config.metrics_port is not None:
+        # Метрики обработчика - на следующих портах после порта процесса приёма
+        metrics.serve(config.metrics_port + 1 + shard)
+        metrics.gauge("bridge_vk_queue_depth", vk_scheduler.depth)
+        metrics.gauge("bridge_outbox_depth", outbox.depth)
+
+    supervisor = Supervisor()
+    queues = {"tg": queue.Queue(), "vk": queue.Queue()}
+    if any(pair.vk_to_tg for pair in routes.pairs):
+        supervisor.add(
+            "vk",
+            listen_vk,
+            (
+                vk_scheduler,
+                config.vk_group_id,
+                routes,
+                config.tg_token,
+                outbox,
+                config.coalesce_window,
+                media_cache,
+                message_map,
+                TelegramGovernor(global_rate=GLOBAL_RATE / workers),
+                queues["vk"],
+                create_name_cache(vk_scheduler, routes),
+            ),
+        )
+    if any(pair.tg_to_vk for pair in routes.pairs):
+        supervisor.add(
+            "telegram",
+            listen_telegram,
+            (
+                config.tg_token,
+                routes,
+                vk_scheduler,
+                outbox,
+                config.coalesce_window,
+                media_cache,
+                None,
+                message_map,
+                queues["tg"],
+            ),
+        )
+    threading.Thread(target=supervisor.run, daemon=True).start()
+
+    last_beat = 0.0
+    # Процесс приёма мог завершиться, не остановив обработчика
+    while os.getppid() == parent_pid:
+        try:
+            kind, seq, raw = inbox.get(timeout=BEAT_INTERVAL)
+            # Подтверждение вызывается после записи сообщения в журнал, а не после возврата
+            # из обработчика: альбом и склеиваемый текст к этому моменту ещё ждут в буфере
+            queues[kind].put((raw, partial(events.put, ("ack", seq))))
+        except queue.Empty:
+            pass
+        now = time.monotonic()
+        # Зависший слушатель - повод перезапустить весь процесс
+        if now - last_beat >= BEAT_INTERVAL and supervisor.live():
+            events.put(("beat",))
+            last_beat = now
@@ -0,0 +1,173 @@
+"""
+Этот модуль содержит надзор за потоками слушателей Telegram и VK.
+Слушатель, завершившийся с ошибкой или без неё, перезапускается с экспоненциальной задержкой
+со случайным разбросом: первая попытка - через доли секунды, поэтому после кратковременного
+сбоя сети мост восстанавливается за секунды. Слушатель сообщает о каждом цикле опроса
+(heartbeat); если сообщений нет дольше stall_timeout, опрос считается зависшим. Зависший
+поток в Python не остановить, поэтому он отмечается как неживой, и процесс должна перезапустить
+внешняя система (Docker, Kubernetes, systemd) по проверке liveness.
+
+Классы:
+- Supervisor():
+  Запускает слушателей в потоках, перезапускает их и отвечает на проверки состояния.
+
+Использование:
+- supervisor.add("vk", listen_vk, args) - target вызывается как
+  target(*args, heartbeat=функция), функцию нужно вызывать после каждого цикла опроса.
+- supervisor.run() - не возвращает управление.
+- supervisor.live() и supervisor.ready() - проверки liveness и readiness
+  (GET /livez и /readyz на порту метрик).
+"""
+
+import logging
+import random
+import threading
+import time
+from typing import Callable, Optional
+
+import metrics
+
+# Задержка перед первым перезапуском и максимальная задержка, в секундах
+RESTART_BASE_DELAY = 0.5
+RESTART_MAX_DELAY = 60.0
+# Слушатель, проработавший столько секунд, снова перезапускается без задержки
+STABLE_PERIOD = 60.0
+# Период проверки слушателей, в секундах
+CHECK_INTERVAL = 1.0
+# Через сколько секунд без heartbeat опрос считается зависшим (long poll ждёт до 25-35 секунд)
+STALL_TIMEOUT = 90.0
+
+
+class _Listener:
+    def __init__(self, name: str, target: Callable, args: tuple, stall_timeout: Optional[float]):
+        self.name = name
+        self.target = target
+        self.args = args
+        self.stall_timeout = stall_timeout
+        self.thread = None
+        self.started = 0.0
+        self.beat = None
+        self.failures = 0
+        self.restart_at = 0.0
+        self.reported = False
+
+
+class Supervisor:
+    """
+    Надзор за потоками слушателей.
+    """
+
+    def __init__(self) -> None:
+        self._listeners = {}
+        self._lock = threading.Lock()
+
+    def add(
+        self,
+        name: str,
+        target: Callable,
+        args: tuple = (),
+        stall_timeout: Optional[float] = STALL_TIMEOUT,
+    ) -> None:
+        """
+        Добавляет слушателя.
+
+        Параметры:
+            name (str): Имя слушателя в логах и метриках.
+            target (Callable): Функция слушателя, вызывается как target(*args, heartbeat=функция).
+            args (tuple): Аргументы функции.
+            stall_timeout (float): Через сколько секунд без heartbeat опрос считается зависшим;
+                None - не проверять (например, webhook, который только принимает запросы).
+
+        Возвращает:
+            None
+        """
+        with self._lock:
+            self._listeners[name] = _Listener(name, target, args, stall_timeout)
+
+    def run(self) -> None:
+        """
+        Запускает слушателей и следит за ними. Не возвращает управление.
+
+        Возвращает:
+            None
+        """
+        metrics.gauge("bridge_listeners_ready", lambda: int(self.ready()))
+        while True:
+            now = time.monotonic()
+            with self._lock:
+                listeners = list(self._listeners.values())
+            for listener in listeners:
+                if listener.thread is not None and listener.thread.is_alive():
+                    if self._stalled(listener, now) and not listener.reported:
+                        logging.error(f"Слушатель {listener.name} не отвечает")
+                        listener.reported = True
+                    continue
+                if listener.thread is not None:
+                    self._schedule_restart(listener, now)
+                    listener.thread = None
+                if now >= listener.restart_at:
+                    self._start(listener)
+            time.sleep(CHECK_INTERVAL)
+
+    def live(self) -> bool:
+        """
+        Проверка liveness: ни один слушатель не завис. Слушатель, ожидающий перезапуска, живой.
+
+        Возвращает:
+            bool
+        """
+        now = time.monotonic()
+        with self._lock:
+            return not any(self._stalled(listener, now) for listener in self._listeners.values())
+
+    def ready(self) -> bool:
+        """
+        Проверка readiness: все слушатели работают и хотя бы раз завершили цикл опроса.
+
+        Возвращает:
+            bool
+        """
+        with self._lock:
+            return all(self._up(listener) for listener in self._listeners.values())
+
+    def _up(self, listener: _Listener) -> bool:
+        if listener.thread is None or not listener.thread.is_alive():
+            return False
+        if listener.stall_timeout is None:
+            return True
+        return listener.beat is not None and not self._stalled(listener, time.monotonic())
+
+    def _stalled(self, listener: _Listener, now: float) -> bool:
+        if listener.stall_timeout is None or listener.thread is None:
+            return False
+        # До первого heartbeat отсчёт идёт от запуска: подключение тоже может зависнуть
+        last = listener.beat if listener.beat is not None else listener.started
+        return now - last > listener.stall_timeout
+
+    def _schedule_restart(self, listener: _Listener, now: float) -> None:
+        if now - listener.started >= STABLE_PERIOD:
+            listener.failures = 0
+        # Полный случайный разброс, чтобы слушатели не переподключались одновременно
+        delay = random.uniform(
+            0, min(RESTART_MAX_DELAY, RESTART_BASE_DELAY * 2**listener.failures)
+        )
+        listener.failures += 1
+        listener.restart_at = now + delay
+        metrics.inc("bridge_listener_restarts_total", listener=listener.name)
+        logging.warning(f"Слушатель {listener.name} остановлен, перезапуск через {delay:.1f} с")
+
+    def _start(self, listener: _Listener) -> None:
+        def heartbeat():
+            listener.beat = time.monotonic()
+            listener.reported = False
+
+        def run():
+            try:
+                listener.target(*listener.args, heartbeat=heartbeat)
+            except BaseException as e:
+                logging.error(f"Слушатель {listener.name} завершился с ошибкой: {e}, {type(e)}")
+
+        listener.started = time.monotonic()
+        listener.beat = None
+        listener.thread = threading.Thread(target=run, name=listener.name, daemon=True)
+        listener.thread.start()
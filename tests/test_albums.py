@@ -0,0 +1,101 @@
+import threading
+import time
+
+import telebot
+
+import tgvk
+from albums import AlbumCollector
+
+
+def message(message_id, chat_id=1, media_group_id=None, caption=None, content_type="photo"):
+    data = {
+        "message_id": message_id,
+        "date": 0,
+        "chat": {"id": chat_id, "type": "group"},
+        "from": {"id": 7, "is_bot": False, "first_name": "Иван"},
+    }
+    if media_group_id:
+        data["media_group_id"] = media_group_id
+    if content_type == "photo":
+        data["photo"] = [
+            {"file_id": f"f{message_id}", "file_unique_id": f"u{message_id}", "width": 1, "height": 1}
+        ]
+    else:
+        data["text"] = f"текст {message_id}"
+    if caption:
+        data["caption"] = caption
+    return telebot.types.Message.de_json(data)
+
+
+class Emitted:
+    def __init__(self):
+        self.groups = []
+        self.lock = threading.Lock()
+
+    def __call__(self, messages, done=None):
+        with self.lock:
+            self.groups.append([m.message_id for m in messages])
+
+
+def test_album_is_emitted_once_in_order():
+    emitted = Emitted()
+    collector = AlbumCollector(emitted, window=0.05)
+    collector.add(message(1, media_group_id="a"))
+    collector.add(message(2, media_group_id="a"))
+    collector.add(message(3, content_type="text"))
+    time.sleep(0.2)
+    assert emitted.groups == [[1, 2], [3]]
+
+
+def test_stale_timer_does_not_flush_partial_album():
+    emitted = Emitted()
+    collector = AlbumCollector(emitted, window=10)
+    collector.add(message(1, media_group_id="a"))
+    stale = collector._buffers[1][1]
+    collector.add(message(2, media_group_id="a"))
+    # Таймер первого сообщения уже сработал, но альбом продолжился
+    collector._flush(1, stale)
+    assert emitted.groups == []
+    collector._flush(1, collector._buffers[1][1])
+    assert emitted.groups == [[1, 2]]
+
+
+def test_emit_does_not_block_other_chats():
+    release = threading.Event()
+    emitted = []
+
+    def emit(messages, done=None):
+        if messages[0].chat.id == 1:
+            release.wait(5)
+        emitted.append(messages[0].chat.id)
+
+    collector = AlbumCollector(emit, window=0.01)
+    slow = threading.Thread(target=collector.add, args=(message(1, content_type="text"),))
+    slow.start()
+    time.sleep(0.05)
+    collector.add(message(2, chat_id=2, content_type="text"))
+    assert emitted == [2]
+    release.set()
+    slow.join()
+    assert emitted == [2, 1]
+
+
+def test_captioned_photo_keeps_caption():
+    vk_message = tgvk.process_telegram_message(None, message(1, caption="Привет"))
+    assert vk_message["text"] == "Иван: Привет"
+    assert "photo" in vk_message
+
+
+def test_album_caption_from_any_element():
+    album = [
+        message(1, media_group_id="a"),
+        message(2, media_group_id="a", caption="Hello album"),
+    ]
+    vk_message = tgvk.process_telegram_album(None, album)
+    assert vk_message["text"] == "Иван: Hello album"
+    assert len(vk_message["album"]) == 2
+
+
+def test_album_without_caption_names_author():
+    album = [message(1, media_group_id="a"), message(2, media_group_id="a")]
+    assert tgvk.process_telegram_album(None, album)["text"] == "Иван: "
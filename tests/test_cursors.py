@@ -0,0 +1,98 @@
+import threading
+import time
+
+from coalesce import Coalescer
+from outbox import BULK_LANE, CursorTracker, Outbox, countdown
+
+
+class Journal:
+    """
+    Заглушка Outbox: запоминает порядок записей и сохранённые позиции.
+    """
+
+    def __init__(self):
+        self.log = []
+        self.cursors = {}
+
+    def put(self, key, direction, target, payload, created=None, lane="fast"):
+        self.log.append(("put", key))
+
+    def set_cursor(self, name, value):
+        self.cursors[name] = value
+        self.log.append(("cursor", value))
+
+
+def test_cursor_waits_for_all_earlier_messages():
+    journal = Journal()
+    tracker = CursorTracker(journal, "tg:offset")
+    first = tracker.add(10, 2)
+    second = tracker.add(12, 1)
+    second()
+    assert "tg:offset" not in journal.cursors
+    first()
+    assert "tg:offset" not in journal.cursors
+    first()
+    assert journal.cursors["tg:offset"] == 12
+
+
+def test_empty_batch_commits_after_earlier_ones():
+    journal = Journal()
+    tracker = CursorTracker(journal, "vk:ts")
+    tracker.add(1, 0)
+    assert journal.cursors["vk:ts"] == 1
+    ack = tracker.add(2, 1)
+    tracker.add(3, 0)
+    assert journal.cursors["vk:ts"] == 1
+    ack()
+    assert journal.cursors["vk:ts"] == 3
+
+
+def test_cursor_is_saved_after_coalesced_put():
+    journal = Journal()
+    tracker = CursorTracker(journal, "tg:offset")
+    coalescer = Coalescer(journal.put, lambda payloads: {"merged": payloads}, window=0.05)
+    ack = tracker.add(5, 2)
+    coalescer.add("a", "tg_to_vk", 1, {"text": "a"}, "a", done=ack)
+    coalescer.add("b", "tg_to_vk", 1, {"text": "b"}, "b", done=ack)
+    # Сообщения ещё в окне склейки: позиция не сохраняется
+    assert journal.log == []
+    time.sleep(0.2)
+    assert journal.log == [("put", "a"), ("cursor", 5)]
+
+
+def test_media_flushes_text_before_cursor():
+    journal = Journal()
+    tracker = CursorTracker(journal, "vk:ts")
+    coalescer = Coalescer(journal.put, lambda payloads: {"merged": payloads}, window=10)
+    coalescer.add("a", "vk_to_tg", 1, {}, "a", done=tracker.add(1, 1))
+    coalescer.add("b", "vk_to_tg", 1, {}, None, lane=BULK_LANE, done=tracker.add(2, 1))
+    assert journal.cursors == {}
+    coalescer.add("c", "vk_to_tg", 1, {}, None, done=tracker.add(3, 1))
+    assert journal.log == [
+        ("put", "b"),
+        ("put", "a"),
+        ("cursor", 2),
+        ("put", "c"),
+        ("cursor", 3),
+    ]
+
+
+def test_countdown():
+    done = threading.Event()
+    ack = countdown(2, done.set)
+    ack()
+    assert not done.is_set()
+    ack()
+    assert done.is_set()
+    empty = threading.Event()
+    countdown(0, empty.set)
+    assert empty.is_set()
+
+
+def test_tracker_persists_in_outbox(tmp_path):
+    box = Outbox(str(tmp_path / "outbox.sqlite3"))
+    tracker = CursorTracker(box, "tg:offset")
+    ack = tracker.add(7, 1)
+    assert box.get_cursor("tg:offset") is None
+    ack()
+    assert box.get_cursor("tg:offset") == "7"
@@ -0,0 +1,19 @@
+from mediacache import MediaCache
+
+
+def test_put_from_two_processes_same_key(tmp_path):
+    path = str(tmp_path / "mediacache.sqlite3")
+    first = MediaCache(path)
+    second = MediaCache(path)
+    first.put("tg:abc", "photo-1_1")
+    # Другой обработчик не знает о записи и добавляет тот же ключ
+    second.put("tg:abc", "photo-1_2")
+    assert first.get("tg:abc") == "photo-1_2"
+
+
+def test_eviction_keeps_recent(tmp_path):
+    cache = MediaCache(str(tmp_path / "mediacache.sqlite3"), max_size=10)
+    for number in range(12):
+        cache.put(f"k{number}", str(number))
+    assert cache.get("k11") == "11"
+    assert cache.get("k0") is None
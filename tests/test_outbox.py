@@ -0,0 +1,148 @@
+import threading
+import time
+
+import pytest
+
+import outbox
+from outbox import Outbox, RetryLater
+
+
+class Recorder:
+    """
+    Функция отправки, которая записывает доставленные части и может падать по сценарию.
+    """
+
+    def __init__(self, failures=()):
+        self.sent = []
+        self.calls = 0
+        self.failures = list(failures)
+        self.event = threading.Event()
+
+    def __call__(self, target, payload, delivery):
+        self.calls += 1
+        for part, item in enumerate(payload["parts"]):
+            if delivery.done(part):
+                continue
+            if self.failures and self.failures[0] == (self.calls, part):
+                error = self.failures.pop(0)
+                raise error[2] if len(error) > 2 else RuntimeError("сбой отправки")
+            self.sent.append((target, item))
+            delivery.mark(part)
+        self.event.set()
+
+    def wait(self, count, timeout=5):
+        deadline = time.monotonic() + timeout
+        while len(self.sent) < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return self.sent
+
+
+@pytest.fixture
+def box(tmp_path, monkeypatch):
+    monkeypatch.setattr(outbox, "RETRY_BASE_DELAY", 0.01)
+    return Outbox(str(tmp_path / "outbox.sqlite3"))
+
+
+def entry(box, key):
+    return box._db.execute(
+        "SELECT state, attempts, parts_done FROM outbox WHERE key = ?", (key,)
+    ).fetchone()
+
+
+def test_put_deduplicates_by_key(box):
+    send = Recorder()
+    assert box.put("tg_to_vk:1:1", "tg_to_vk", 100, {"parts": ["a"]})
+    assert not box.put("tg_to_vk:1:1", "tg_to_vk", 100, {"parts": ["a"]})
+    box.register("tg_to_vk", send)
+    assert send.wait(1) == [(100, "a")]
+    time.sleep(0.1)
+    assert send.sent == [(100, "a")]
+    # Доставленное сообщение тоже не ставится в очередь повторно
+    assert not box.put("tg_to_vk:1:1", "tg_to_vk", 100, {"parts": ["a"]})
+
+
+def test_failed_delivery_is_retried(box):
+    send = Recorder(failures=[(1, 0)])
+    box.register("tg_to_vk", send)
+    box.put("k", "tg_to_vk", 100, {"parts": ["a"]})
+    assert send.wait(1) == [(100, "a")]
+    assert send.calls == 2
+    time.sleep(0.05)
+    assert entry(box, "k")[:2] == ("done", 1)
+
+
+def test_retry_resumes_after_delivered_parts(box):
+    send = Recorder(failures=[(1, 1)])
+    box.register("tg_to_vk", send)
+    box.put("k", "tg_to_vk", 100, {"parts": ["text", "photo", "doc"]})
+    assert send.wait(3) == [(100, "text"), (100, "photo"), (100, "doc")]
+    assert send.calls == 2
+
+
+def test_parts_done_survive_restart(tmp_path, monkeypatch):
+    monkeypatch.setattr(outbox, "RETRY_BASE_DELAY", 60)
+    path = str(tmp_path / "outbox.sqlite3")
+    first = Outbox(path)
+    failing = Recorder(failures=[(1, 1)])
+    first.register("tg_to_vk", failing)
+    first.put("k", "tg_to_vk", 100, {"parts": ["text", "photo"]})
+    assert failing.wait(1) == [(100, "text")]
+    time.sleep(0.05)
+    assert entry(first, "k") == ("pending", 1, 1)
+
+    # После перезапуска доставляется только оставшаяся часть
+    first._db.execute("UPDATE outbox SET next_attempt = 0")
+    second = Outbox(path)
+    send = Recorder()
+    second.register("tg_to_vk", send)
+    assert send.wait(1) == [(100, "photo")]
+
+
+def test_retry_later_does_not_count_attempt(box):
+    send = Recorder(failures=[(1, 0, RetryLater(0.05, "429"))])
+    box.register("vk_to_tg", send)
+    box.put("k", "vk_to_tg", -100, {"parts": ["a"]})
+    assert send.wait(1) == [(-100, "a")]
+    time.sleep(0.05)
+    assert entry(box, "k")[:2] == ("done", 0)
+
+
+def test_gives_up_after_max_attempts(box, monkeypatch):
+    monkeypatch.setattr(outbox, "MAX_ATTEMPTS", 2)
+    failures = []
+    send = Recorder(failures=[(1, 0), (2, 0)])
+    box.register("tg_to_vk", send, lambda target, error: failures.append(target))
+    box.put("k", "tg_to_vk", 100, {"parts": ["a"]})
+    deadline = time.monotonic() + 5
+    while not failures and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert failures == [100]
+    assert entry(box, "k")[:2] == ("failed", 2)
+
+
+def test_target_order_is_kept_behind_retry(box):
+    send = Recorder(failures=[(1, 0)])
+    box.register("tg_to_vk", send)
+    for number in range(5):
+        box.put(f"k{number}", "tg_to_vk", 100, {"parts": [number]})
+    box.put("other", "tg_to_vk", 200, {"parts": ["x"]})
+    sent = send.wait(6)
+    assert [item for target, item in sent if target == 100] == [0, 1, 2, 3, 4]
+    assert (200, "x") in sent
+
+
+def test_cursor_roundtrip(box):
+    assert box.get_cursor("tg:offset") is None
+    box.set_cursor("tg:offset", 42)
+    assert box.get_cursor("tg:offset") == "42"
+
+
+def test_cursor_only_outbox_does_not_deliver(tmp_path):
+    before = threading.active_count()
+    path = str(tmp_path / "outbox.sqlite3")
+    store = Outbox(path, deliver=False)
+    store.put("k", "tg_to_vk", 1, {"text": "a"})
+    store.set_cursor("tg:offset", 7)
+    assert threading.active_count() == before
+    assert store.depth() == 1
+    assert store.get_cursor("tg:offset") == "7"
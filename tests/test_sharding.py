@@ -0,0 +1,59 @@
+import queue
+
+from outbox import Outbox
+from routing import ChatPair, RoutingTable
+from sharding import Intake, WorkerConfig, shard_of
+
+
+def make_intake(tmp_path, workers=2):
+    routes = RoutingTable([ChatPair(-1000 - i, 2000000001 + i) for i in range(4)])
+    config = WorkerConfig("tg", "vk", 1, str(tmp_path / "outbox.sqlite3"), "", "")
+    outbox = Outbox(config.outbox_path)
+    intake = Intake(config, routes, workers, outbox)
+    intake._inboxes = [queue.Queue() for _ in range(workers)]
+    return intake, outbox
+
+
+def test_cursor_advances_only_when_earlier_updates_are_acked(tmp_path):
+    intake, outbox = make_intake(tmp_path)
+    intake.submit([(0, "tg", {"update_id": 1}), (1, "tg", {"update_id": 2})], "tg:offset", 2)
+    intake.submit([(0, "tg", {"update_id": 3})], "tg:offset", 3)
+    _, first, _ = intake._inboxes[0].get()
+    _, third, _ = intake._inboxes[0].get()
+    _, second, _ = intake._inboxes[1].get()
+
+    # Более позднее обновление записано раньше: позиция не сдвигается
+    intake._ack(0, third)
+    assert outbox.get_cursor("tg:offset") is None
+    intake._ack(0, first)
+    assert outbox.get_cursor("tg:offset") is None
+    intake._ack(1, second)
+    assert outbox.get_cursor("tg:offset") == "3"
+    assert not any(intake._unacked)
+
+
+def test_unacked_updates_are_kept_for_resend(tmp_path):
+    intake, outbox = make_intake(tmp_path)
+    intake.submit([(1, "vk", {"text": "a"}), (1, "vk", {"text": "b"})], "vk:ts", "10")
+    _, seq, _ = intake._inboxes[1].get()
+    intake._ack(1, seq)
+    assert [raw for _, raw in intake._unacked[1].values()] == [{"text": "b"}]
+    assert outbox.get_cursor("vk:ts") is None
+
+
+def test_done_fires_when_webhook_update_is_acked(tmp_path):
+    intake, _ = make_intake(tmp_path)
+    done = []
+    intake.submit([(0, "tg", {"update_id": 1})], done=lambda: done.append(1))
+    _, seq, _ = intake._inboxes[0].get()
+    assert done == []
+    intake._ack(0, seq)
+    assert done == [1]
+    # Обновление, которое мост не пересылает, подтверждается сразу
+    intake.submit([], done=lambda: done.append(2))
+    assert done == [1, 2]
+
+
+def test_pair_always_goes_to_same_shard():
+    pair = ChatPair(-1001, 2000000001)
+    assert shard_of(pair, 4) == shard_of(ChatPair(-1001, 2000000001), 4)
@@ -0,0 +1,46 @@
+import io
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import transfer
+
+
+class Spooled(io.BytesIO):
+    pass
+
+
+def prefetched_future(spooled):
+    future = Future()
+    future.set_result(((lambda: spooled), 3))
+    return future
+
+
+def test_discard_closes_finished_prefetch():
+    spooled = Spooled(b"abc")
+    transfer.discard_prefetched(prefetched_future(spooled))
+    assert spooled.closed
+
+
+def test_discard_closes_prefetch_when_it_finishes():
+    spooled = Spooled(b"abc")
+    started = threading.Event()
+    release = threading.Event()
+
+    def prefetch():
+        started.set()
+        release.wait(5)
+        return (lambda: spooled), 3
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(prefetch)
+        started.wait(5)
+        transfer.discard_prefetched(future)
+        assert not spooled.closed
+        release.set()
+    assert spooled.closed
+
+
+def test_discard_cancels_pending_prefetch():
+    future = Future()
+    transfer.discard_prefetched(future)
+    assert future.cancelled()
@@ -0,0 +1,44 @@
+import threading
+
+import requests
+
+import vkscheduler
+from vkscheduler import VkScheduler
+
+
+class FakeSession:
+    """
+    Сессия VK, которая задерживает первый вызов, пока очередь не заполнится.
+    """
+
+    def __init__(self):
+        self.http = requests.Session()
+        self.release = threading.Event()
+        self.codes = []
+        self.single = []
+
+    def method(self, method, values=None, raw=False):
+        if method != "execute":
+            self.release.wait(5)
+            self.single.append(values["n"])
+            return values["n"]
+        self.codes.append(values["code"])
+        count = values["code"].count("API.")
+        return {"response": list(range(count))}
+
+
+def test_execute_code_stays_under_limit(monkeypatch):
+    monkeypatch.setattr(vkscheduler, "EXECUTE_CODE_LIMIT", 200)
+    session = FakeSession()
+    scheduler = VkScheduler(session, rate=1000, burst=1000)
+    first = scheduler.submit("users.get", {"n": 0})
+    futures = [scheduler.submit("users.get", {"n": n, "pad": "x" * 40}) for n in range(1, 10)]
+    session.release.set()
+    first.result(5)
+    for future in futures:
+        future.result(5)
+    assert session.codes
+    assert all(len(code) <= 200 + len("return [];") for code in session.codes)
+    # Ни один вызов не потерян
+    calls = sum(code.count("API.") for code in session.codes) + len(session.single)
+    assert calls == 10
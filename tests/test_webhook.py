@@ -0,0 +1,84 @@
+import json
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+import webhook
+from webhook import WebhookConfig, serve_webhook
+
+
+class FailingBot:
+    def set_webhook(self, **kwargs):
+        raise RuntimeError("Telegram недоступен")
+
+
+def test_workers_stop_when_webhook_fails():
+    before = threading.active_count()
+    config = WebhookConfig("http://127.0.0.1/telegram", host="127.0.0.1", port=0, workers=3)
+    for _ in range(3):
+        with pytest.raises(RuntimeError):
+            serve_webhook(FailingBot(), config)
+    deadline = time.monotonic() + 2
+    while threading.active_count() > before and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert threading.active_count() == before
+
+
+class RecordingBot:
+    def __init__(self):
+        self.webhook = None
+
+    def set_webhook(self, **kwargs):
+        self.webhook = kwargs
+
+
+def post(url, secret, update):
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(update).encode(),
+        headers={"X-Telegram-Bot-Api-Secret-Token": secret, "Content-Type": "application/json"},
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def test_reply_waits_for_done(monkeypatch):
+    monkeypatch.setattr(webhook, "WEBHOOK_REPLY_TIMEOUT", 0.5)
+    port = free_port()
+    url = f"http://127.0.0.1:{port}/telegram"
+    config = WebhookConfig(url, "secret", host="127.0.0.1", port=port, workers=1)
+    handled = []
+
+    def handle(update, done):
+        handled.append(update["update_id"])
+        # Первое обновление не подтверждается, как если бы его не удалось записать в журнал
+        if update["update_id"] > 1:
+            done()
+
+    threading.Thread(
+        target=serve_webhook, args=(RecordingBot(), config, handle), daemon=True
+    ).start()
+    deadline = time.monotonic() + 2
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            break
+        except OSError:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+    assert post(url, "secret", {"update_id": 1}) == 503
+    assert post(url, "secret", {"update_id": 2}) == 200
+    assert handled == [1, 2]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
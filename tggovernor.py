@@ -0,0 +1,198 @@
+"""
+Этот модуль содержит регулятор частоты отправки сообщений в Telegram.
+Отправки ограничиваются двумя бюджетами по алгоритму token bucket: общим для бота (30 сообщений
+в секунду) и отдельным для каждого чата (1 сообщение в секунду в личном чате, 20 в минуту
+в группе). Медиагруппа расходует бюджет по количеству элементов. Если Telegram всё же отвечает
+429 Too Many Requests, чат не получает сообщений ровно retry_after секунд, а его скорость
+уменьшается вдвое и затем постепенно восстанавливается после успешных отправок. Отправка,
+которой пришлось бы ждать дольше MAX_INLINE_WAIT, не ждёт в потоке доставки: она
+откладывается в очереди исходящих сообщений (RetryLater) и не считается неудачной попыткой.
+
+Классы:
+- TelegramGovernor(global_rate, chat_rate, group_rate):
+  Регулятор частоты отправки для одного бота.
+
+Использование:
+- governor.send(chat_id, func, *args, cost=1, **kwargs) - вызывает func с учётом бюджетов
+  (в функциях доставки очереди исходящих сообщений).
+- Для асинхронного кода: wait = governor.reserve(chat_id, cost), после ошибки 429 -
+  governor.throttled(chat_id, error), после успешной отправки - governor.succeeded(chat_id).
+"""
+
+import logging
+import threading
+import time
+from typing import Callable
+
+from telebot.apihelper import ApiTelegramException
+
+import metrics
+from outbox import RetryLater
+
+# Ограничения Telegram: сообщений в секунду для бота, в личном чате и в группе
+GLOBAL_RATE = 30.0
+CHAT_RATE = 1.0
+GROUP_RATE = 20 / 60
+# Сколько сообщений чат может получить подряд после паузы
+CHAT_BURST = 3
+# Во сколько раз уменьшается скорость чата после 429 и увеличивается после успешной отправки
+THROTTLE_FACTOR = 0.5
+RECOVERY_FACTOR = 1.05
+# Минимальная скорость чата, сообщений в секунду
+MIN_CHAT_RATE = 1 / 60
+# Дольше этого (в секундах) отправка не ждёт в потоке, а откладывается в очереди
+MAX_INLINE_WAIT = 1.0
+# Пауза после 429, если Telegram не указал retry_after
+DEFAULT_RETRY_AFTER = 5.0
+
+
+class _Budget:
+    """
+    Бюджет отправок по алгоритму token bucket с изменяемой скоростью.
+    """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.ceiling = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def wait(self, now: float, cost: float) -> float:
+        """
+        Возвращает, сколько секунд ждать, пока в бюджете хватит токенов.
+        """
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        # Отправка дороже ёмкости ждёт полного бюджета и уводит его в минус
+        needed = min(cost, self.capacity)
+        if self.tokens >= needed:
+            return 0.0
+        return (needed - self.tokens) / self.rate
+
+
+class TelegramGovernor:
+    """
+    Регулятор частоты отправки сообщений в Telegram для одного бота.
+
+    Параметры:
+        global_rate (float): Сообщений в секунду для всего бота.
+        chat_rate (float): Сообщений в секунду в личном чате.
+        group_rate (float): Сообщений в секунду в группе или канале.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = GLOBAL_RATE,
+        chat_rate: float = CHAT_RATE,
+        group_rate: float = GROUP_RATE,
+    ) -> None:
+        self._global = _Budget(global_rate, global_rate)
+        self._chat_rate = chat_rate
+        self._group_rate = group_rate
+        self._chats = {}
+        self._lock = threading.Lock()
+
+    def reserve(self, chat_id: int, cost: int = 1) -> float:
+        """
+        Забирает бюджет на отправку cost сообщений в чат, если его хватает.
+
+        Параметры:
+            chat_id (int): ID чата Telegram.
+            cost (int): Количество сообщений (элементов медиагруппы).
+
+        Возвращает:
+            float - 0, если отправлять можно сейчас; иначе через сколько секунд повторить
+            (бюджет при этом не забирается)
+        """
+        with self._lock:
+            now = time.monotonic()
+            chat = self._chat(chat_id)
+            wait = max(chat.wait(now, cost), self._global.wait(now, cost))
+            if wait > 0:
+                return wait
+            chat.tokens -= cost
+            self._global.tokens -= cost
+            return 0.0
+
+    def throttled(self, chat_id: int, error: ApiTelegramException) -> float:
+        """
+        Учитывает ответ 429: чат блокируется на retry_after секунд, его скорость уменьшается.
+
+        Параметры:
+            chat_id (int): ID чата Telegram.
+            error (ApiTelegramException): Ошибка 429 Too Many Requests.
+
+        Возвращает:
+            float - retry_after в секундах
+        """
+        parameters = (error.result_json or {}).get("parameters") or {}
+        retry_after = float(parameters.get("retry_after") or DEFAULT_RETRY_AFTER)
+        with self._lock:
+            chat = self._chat(chat_id)
+            chat.blocked_until = time.monotonic() + retry_after
+            chat.rate = max(MIN_CHAT_RATE, chat.rate * THROTTLE_FACTOR)
+            chat.tokens = min(chat.tokens, 0.0)
+            rate = chat.rate
+        metrics.inc("bridge_tg_throttled_total")
+        logging.warning(
+            f"Telegram ограничил отправку в чат {chat_id} на {retry_after:.0f} с,"
+            f" скорость снижена до {rate * 60:.1f} сообщ./мин"
+        )
+        return retry_after
+
+    def succeeded(self, chat_id: int) -> None:
+        """
+        Учитывает успешную отправку: скорость чата понемногу возвращается к ограничению.
+
+        Параметры:
+            chat_id (int): ID чата Telegram.
+
+        Возвращает:
+            None
+        """
+        with self._lock:
+            chat = self._chat(chat_id)
+            chat.rate = min(chat.ceiling, chat.rate * RECOVERY_FACTOR)
+
+    def send(self, chat_id: int, func: Callable, /, *args, cost: int = 1, **kwargs):
+        """
+        Вызывает функцию отправки в чат с учётом бюджетов. Короткое ожидание проходит в потоке;
+        долгое и ответ 429 откладывают доставку через RetryLater, не теряя сообщение.
+
+        Параметры:
+            chat_id (int): ID чата Telegram.
+            func (Callable): Функция отправки.
+            *args, **kwargs: Аргументы функции.
+            cost (int): Количество отправляемых сообщений (элементов медиагруппы).
+
+        Возвращает:
+            Результат функции
+        """
+        while True:
+            wait = self.reserve(chat_id, cost)
+            if wait == 0:
+                break
+            if wait > MAX_INLINE_WAIT:
+                raise RetryLater(wait, f"бюджет отправки в чат {chat_id}")
+            time.sleep(wait)
+        try:
+            result = func(*args, **kwargs)
+        except ApiTelegramException as error:
+            if error.error_code != 429:
+                raise
+            raise RetryLater(self.throttled(chat_id, error), error.description) from error
+        self.succeeded(chat_id)
+        return result
+
+    def _chat(self, chat_id: int) -> _Budget:
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            # ID групп и каналов отрицательные
+            rate = self._group_rate if chat_id < 0 else self._chat_rate
+            chat = self._chats[chat_id] = _Budget(rate, CHAT_BURST)
+        return chat
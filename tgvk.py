@@ -3,62 +3,192 @@
 Он настраивает соединения с API Telegram и VK и управляет процессом пересылки сообщений.
 
 Функции:
-- listen_telegram(tg_token, chat_id, vk_token, vk_chat_id):
-  Прослушивает сообщения в указанном чате Telegram и пересылает их в чат VK. Требует токены API и ID чатов обеих платформ.
+- listen_telegram(tg_token, routes, vk_scheduler, outbox, coalesce_window, media_cache, webhook,
+  message_map, updates, heartbeat):
+  Прослушивает сообщения в чатах Telegram из таблицы маршрутов и пересылает их в связанные чаты VK.
+  Требует токен бота, таблицу маршрутов, общий планировщик вызовов API VK и очередь исходящих сообщений.
+  Альбомы собираются AlbumCollector и уходят в VK одним сообщением со всеми вложениями.
 
 Использование:
 - Укажите необходимые токены API и ID чатов для Telegram и VK.
 - Вызовите функцию listen_telegram для начала прослушивания и пересылки сообщений.
 """
 
-import io
-import os
 from vk_api import VkApiError
+import hashlib
+import json
+import queue
 import telebot
-import vk_api
 from vk_api.utils import get_random_id
 import logging
 from telebot.apihelper import ApiException
 import urllib3
-import time
 from http.client import RemoteDisconnected
+from typing import Callable
 from requests.exceptions import ConnectionError, Timeout
 
-def listen_telegram(tg_token: str, chat_id: int, vk_token: str, vk_chat_id: int) -> None:
+import mediasize
+import metrics
+import transfer
+from albums import AlbumCollector
+from coalesce import COALESCE_WINDOW, Coalescer
+from mediacache import MediaCache
+from mediapipeline import pipeline
+from messagemap import MessageMap
+from outbox import BULK_LANE, BULK_SIZE, CursorTracker, Delivery, Outbox
+from routing import RoutingTable
+from vkscheduler import VkScheduler
+from webhook import WebhookConfig, serve_webhook
+
+# Порядок отправки вложений сообщения
+MEDIA_ORDER = ["reply_photo", "reply_document", "photo", "document"]
+# Максимальное количество вложений в одном сообщении VK
+VK_MAX_ATTACHMENTS = 10
+# Позиция опроса getUpdates в журнале очереди исходящих сообщений
+TG_OFFSET_CURSOR = "tg:offset"
+# Ошибки сети при опросе
+NETWORK_ERRORS = (urllib3.exceptions.ProtocolError, RemoteDisconnected, ConnectionError, Timeout)
+
+
+def listen_telegram(
+    tg_token: str,
+    routes: RoutingTable,
+    vk_scheduler: VkScheduler,
+    outbox: Outbox,
+    coalesce_window: float = COALESCE_WINDOW,
+    media_cache: MediaCache = None,
+    webhook: WebhookConfig = None,
+    message_map: MessageMap = None,
+    updates: queue.Queue = None,
+    heartbeat: Callable[[], None] = None,
+) -> None:
     """
-    Прослушивает сообщения в Telegram и пересылает их в VK.
+    Прослушивает сообщения в Telegram и пересылает их в VK. Ошибки подключения не
+    перехватываются: слушателя перезапускает Supervisor.
 
     Параметры:
         tg_token (str): Токен бота Telegram.
-        chat_id (int): ID чата Telegram.
-        vk_token (str): Токен для VK.
-        vk_chat_id (int): ID чата VK.
+        routes (RoutingTable): Таблица маршрутов пар чатов.
+        vk_scheduler (VkScheduler): Планировщик вызовов API VK.
+        outbox (Outbox): Очередь исходящих сообщений.
+        coalesce_window (float): Окно склейки коротких текстовых сообщений в секундах, 0 - без склейки.
+        media_cache (MediaCache): Кэш уже загруженных медиафайлов.
+        webhook (WebhookConfig): Параметры webhook; без них обновления получаются длинным опросом.
+        message_map (MessageMap): Соответствие пересланных сообщений; ответы на известные
+            сообщения уходят в VK настоящими ответами.
+        updates (queue.Queue): Очередь (обновление в формате JSON, функция подтверждения) от
+            процесса приёма в многопроцессном режиме; тогда опроса нет, а позицию хранит приём.
+            Подтверждение вызывается, когда сообщение записано в журнал.
+        heartbeat (Callable): Вызывается после каждого цикла опроса, по нему Supervisor
+            замечает зависший опрос.
 
     Возвращает:
         None
     """
-    try:
-        bot = telebot.TeleBot(tg_token, parse_mode=None)
-        vk_session = vk_api.VkApi(token=vk_token)
-    except VkApiError as vk_api_error:
-        logging.error(
-            f"Невозможно доставить сообщение об ошибке пользователю. Тип ошибки: {type(vk_api_error)}, Описание: {vk_api_error}"
-        )
-        exit(1)
-
-    @bot.message_handler(
-        func=lambda message: message.chat.type == "group"
-        and message.chat.id == chat_id,
-        content_types=["text", "photo", "audio", "video", "document", "sticker"],
+    # Обработчики вызываются синхронно: при опросе - до сохранения позиции, в режиме webhook -
+    # в потоках webhook, которые сохраняют порядок чата, в многопроцессном режиме - в потоке очереди
+    bot = telebot.TeleBot(tg_token, parse_mode=None, threaded=False)
+
+    # Функция сообщения об ошибке, если доставка не удалась после всех повторов
+    def report_failure(vk_chat_id, error):
+        send_vk_message(vk_scheduler, {"text": f"ERROR: {error}"}, vk_chat_id)
+
+    outbox.register(
+        "tg_to_vk",
+        lambda vk_chat_id, payload, delivery: send_vk_message(
+            vk_scheduler,
+            vk_message_from_payload(bot, payload),
+            vk_chat_id,
+            delivery,
+            media_cache,
+            message_map,
+        ),
+        report_failure,
     )
-    def handle_message(message):
+    # Подряд идущие текстовые сообщения склеиваются в одно
+    coalescer = Coalescer(
+        outbox.put,
+        lambda payloads: {
+            "text": "\n".join(payload["text"] for payload in payloads),
+            "tg_chat_id": payloads[0]["tg_chat_id"],
+            "tg_message_ids": [id for payload in payloads for id in payload["tg_message_ids"]],
+        },
+        coalesce_window,
+    )
+
+    # Ставит в очередь одиночное сообщение или альбом целиком. done вызывается после записи
+    # в журнал, а для сообщения, которое не удалось преобразовать, - сразу
+    def forward_messages(messages, done=None):
+        message = messages[0]
+        vk_chat_id = routes.for_telegram(message.chat.id).vk_chat_id
+        queued = False
         try:
-            vk_message = process_telegram_message(bot, message)
-            send_vk_message(vk_session, vk_message, vk_chat_id)
+            if len(messages) > 1:
+                vk_message = process_telegram_album(bot, messages, message_map)
+            else:
+                vk_message = process_telegram_message(bot, message, message_map)
+            # Исходные сообщения, чтобы запомнить соответствие после доставки
+            source = {
+                "tg_chat_id": message.chat.id,
+                "tg_message_ids": [item.message_id for item in messages],
+            }
+            vk_message.update(source)
+            key = f"tg:{message.chat.id}:{message.message_id}"
+            media = vk_message_media(vk_message)
+            if sum(file.file_size or 0 for _, file in media) >= BULK_SIZE:
+                # Большие вложения идут медленной полосой, а на их месте в переписке сразу
+                # появляется заглушка с текстом, чтобы следующие сообщения не ждали загрузки
+                author_tag = message.from_user.first_name or f"@{message.from_user.username}"
+                placeholder = vk_message.get("text") or f"{author_tag}:"
+                coalescer.add(
+                    key,
+                    "tg_to_vk",
+                    vk_chat_id,
+                    {
+                        "text": f"{placeholder}\n[Вложения загружаются: {len(media)}]",
+                        **source,
+                        **({"reply_to": vk_message["reply_to"]} if "reply_to" in vk_message else {}),
+                    },
+                    None,
+                    message.date,
+                )
+                coalescer.add(
+                    f"{key}:bulk",
+                    "tg_to_vk",
+                    vk_chat_id,
+                    # Исходные сообщения и здесь: ответ в VK на сообщение с вложениями тоже
+                    # должен стать настоящим ответом в Telegram
+                    vk_message_to_payload(
+                        {
+                            **{
+                                name: value
+                                for name, value in vk_message.items()
+                                if name in MEDIA_ORDER or name == "album"
+                            },
+                            **source,
+                        }
+                    ),
+                    None,
+                    message.date,
+                    BULK_LANE,
+                    done,
+                )
+                queued = True
+                return
+            coalescer.add(
+                key,
+                "tg_to_vk",
+                vk_chat_id,
+                vk_message_to_payload(vk_message),
+                vk_message["text"] if is_text_only(vk_message) else None,
+                message.date,
+                done=done,
+            )
+            queued = True
         except VkApiError as vk_api_error:
             try:
                 send_vk_message(
-                    vk_session, {"text": f"ERROR: {vk_api_error}"}, vk_chat_id
+                    vk_scheduler, {"text": f"ERROR: {vk_api_error}"}, vk_chat_id
                 )
             except Exception as e:
                 logging.error(
@@ -67,7 +197,7 @@ def listen_telegram(tg_token: str, chat_id: int, vk_token: str, vk_chat_id: int)
         except ApiException as tg_api_exception:
             try:
                 send_vk_message(
-                    vk_session, {"text": f"ERROR: {tg_api_exception}"}, vk_chat_id
+                    vk_scheduler, {"text": f"ERROR: {tg_api_exception}"}, vk_chat_id
                 )
             except Exception as e:
                 logging.error(
@@ -75,54 +205,178 @@ def listen_telegram(tg_token: str, chat_id: int, vk_token: str, vk_chat_id: int)
                 )
         except Exception as e:
             logging.error(f"Непредвиденная ошибка: {e}")
-    retries = 0
-    while retries < 10:
+        finally:
+            if not queued and done is not None:
+                done()
+
+    album_collector = AlbumCollector(forward_messages)
+    # Подтверждения обновлений, которые обрабатываются сейчас: (id чата, id сообщения) -> функция
+    acks = {}
+
+    @bot.message_handler(
+        func=lambda message: message.chat.type == "group"
+        and routes.for_telegram(message.chat.id) is not None,
+        content_types=["text", "photo", "audio", "video", "document", "sticker"],
+    )
+    def handle_message(message):
+        ack = acks.pop((message.chat.id, message.message_id), None)
         try:
-            bot.polling(non_stop=True, skip_pending=True)
-        except ApiException as tg_api_exception:
+            album_collector.add(message, ack)
+        except Exception as e:
+            # Одно сообщение, которое не удалось обработать, не должно останавливать опрос
+            logging.error(f"Непредвиденная ошибка: {e}, {type(e)}")
+            if ack is not None:
+                ack()
+
+    dispatch = bot.process_new_updates
+
+    # Обрабатывает обновления; подтверждение каждого вызывается после записи его сообщения
+    # в журнал, а для обновлений, которые мост не пересылает, - сразу после обработки
+    def process_updates(updates, update_acks):
+        for update, ack in zip(updates, update_acks):
+            if update.message is not None:
+                acks[(update.message.chat.id, update.message.message_id)] = ack
+            else:
+                ack()
+        try:
+            dispatch(updates)
+        finally:
+            for update in updates:
+                if update.message is not None:
+                    ack = acks.pop((update.message.chat.id, update.message.message_id), None)
+                    if ack is not None:
+                        ack()
+
+    if webhook is not None:
+        # Telegram получает ответ 200, когда сообщение обновления записано в журнал
+        serve_webhook(
+            bot,
+            webhook,
+            lambda update, done: process_updates([telebot.types.Update.de_json(update)], [done]),
+        )
+        return
+
+    if updates is not None:
+        while True:
+            try:
+                update, ack = updates.get(timeout=1)
+            except queue.Empty:
+                pass
+            else:
+                process_updates([telebot.types.Update.de_json(update)], [ack])
+            if heartbeat is not None:
+                heartbeat()
+
+    # Webhook, оставшийся от запуска в режиме webhook, мешает опросу
+    bot.remove_webhook()
+    # Опрос продолжается с сохранённой позиции, накопившиеся за время простоя обновления
+    # не пропускаются
+    offset = outbox.get_cursor(TG_OFFSET_CURSOR)
+    if offset is not None:
+        bot.last_update_id = int(offset)
+    # Позиция сохраняется, только когда все обновления до неё записаны в журнал: сообщения
+    # могут ещё ждать в сборщике альбомов и склейщике
+    cursor = CursorTracker(outbox, TG_OFFSET_CURSOR)
+
+    # Функция обработки обновлений вместо bot.process_new_updates.
+    # Вызывается после каждого getUpdates, в том числе пустого
+    def process_and_save(updates):
+        if updates:
+            ack = cursor.add(max(update.update_id for update in updates), len(updates))
+            process_updates(updates, [ack] * len(updates))
+        if heartbeat is not None:
+            heartbeat()
+
+    bot.process_new_updates = process_and_save
+
+    # Ошибку API telebot не выбрасывает, а только останавливает опрос (non_stop=False),
+    # поэтому она запоминается здесь; перезапуск с задержкой выполняет Supervisor.
+    # Тот же обработчик получает исключения обработчиков сообщений: они только пишутся в лог,
+    # иначе одно сообщение останавливало бы опрос и перезапуск повторял бы его снова
+    polling_errors = []
+
+    class PollingErrors(telebot.ExceptionHandler):
+        def handle(self, exception):
+            if isinstance(exception, (ApiException,) + NETWORK_ERRORS):
+                polling_errors.append(exception)
+                return False
+            logging.error(f"Непредвиденная ошибка: {exception}, {type(exception)}")
+            return True
+
+    bot.exception_handler = PollingErrors()
+    try:
+        bot.polling(non_stop=False, skip_pending=False)
+        if polling_errors:
+            raise polling_errors[-1]
+    except ApiException as tg_api_exception:
+        # Ошибка опроса касается всех пар чатов
+        for pair in routes.pairs:
+            if not pair.tg_to_vk:
+                continue
             try:
                 send_vk_message(
-                    vk_session, {"text": f"ERROR: {tg_api_exception}"}, vk_chat_id
+                    vk_scheduler, {"text": f"ERROR: {tg_api_exception}"}, pair.vk_chat_id
                 )
             except Exception as e:
                 logging.error(
                     f"Невозможно доставить сообщение об ошибке пользователю. Тип ошибки: {type(tg_api_exception)}, Описание: {tg_api_exception}"
                 )
-        except (urllib3.exceptions.ProtocolError, RemoteDisconnected, ConnectionError, Timeout):
-            logging.warning("Проблемы сетью, попытка повторного подключения....")
-            time.sleep(30)
-            retries += 1
-        except Exception as e:
-            logging.error(f"Непредвиденная ошибка: {e}")
-
-
-def process_telegram_message(bot: telebot.TeleBot, message) -> dict:
+        raise
+    except NETWORK_ERRORS:
+        logging.warning("Проблемы сетью, попытка повторного подключения....")
+        raise
+    finally:
+        # Потоки обработчиков остановленного бота не нужны, перезапуск создаст новый бот
+        bot.stop_bot()
+
+
+@metrics.timed("process_telegram_message")
+def process_telegram_message(
+    bot: telebot.TeleBot, message, message_map: MessageMap = None
+) -> dict:
     """
     Преобразует объект сообщения телеграма в формат для ВК
 
     Параметры:
         bot (telebot.TeleBot): Объект бота Telegram.
         message: Объект сообщения телеграм.
+        message_map (MessageMap): Соответствие пересланных сообщений. Если сообщение, на которое
+            отвечают, уже пересылалось, вместо цитаты и его вложений в reply_to записывается
+            conversation_message_id этого сообщения в VK.
 
     Возвращает:
         dict - словарь, подобный вк сообщению во структуре
     """
     vk_message = {}
-
-    # Функция для обработки фотографий
+    reply = message.reply_to_message
+    if reply and message_map is not None:
+        original = message_map.vk_for_tg(message.chat.id, reply.message_id)
+        if original is not None:
+            vk_message["reply_to"] = original[1]
+            # Исходное сообщение уже есть в беседе, цитировать его не нужно
+            reply = None
+
+    # Функция для обработки фотографий: скачивание откладывается до отправки,
+    # чтобы все вложения сообщения скачивались параллельно
     def handle_photo(photo):
-        file_info = bot.get_file(photo.file_id)
-        downloaded_file = bot.download_file(file_info.file_path)
-        return io.BytesIO(downloaded_file)
+        return transfer.TelegramFile(
+            bot,
+            photo.file_id,
+            f"{photo.file_unique_id}.jpg",
+            photo.file_unique_id,
+            photo.file_size,
+        )
 
-    # Функция для обработки документов
+    # Функция для обработки документов: файл не скачивается заранее,
+    # а передаётся потоком в момент загрузки в VK
     def handle_document(document):
-        file_info = bot.get_file(document.file_id)
-        downloaded_file = bot.download_file(file_info.file_path)
-        local_file_path = f"./{document.file_name}"
-        with open(local_file_path, "wb") as file:
-            file.write(downloaded_file)
-        return local_file_path
+        return transfer.TelegramFile(
+            bot,
+            document.file_id,
+            document.file_name or "document",
+            document.file_unique_id,
+            document.file_size,
+        )
 
     # Функция для создания текста ответа
     def create_reply_text(reply_message):
@@ -172,25 +426,25 @@ def process_telegram_message(bot: telebot.TeleBot, message) -> dict:
             text = f"{forward_text}\n|{forward_author_tag}{':' if forward_author_tag != '' else ''} {message.text}"
 
         # Если это ответ
-        if message.reply_to_message:
-            reply_text = create_reply_text(message.reply_to_message)
+        if reply:
+            reply_text = create_reply_text(reply)
             text = f"{text}\n|{reply_text}"
             # Если ответ на фотографию или документ
-            if message.reply_to_message.content_type in ["photo", "document"]:
+            if reply.content_type in ["photo", "document"]:
                 reply_content_key = (
                     "reply_photo"
-                    if message.reply_to_message.content_type == "photo"
+                    if reply.content_type == "photo"
                     else "reply_document"
                 )
                 handle_reply_content = (
                     handle_photo
-                    if message.reply_to_message.content_type == "photo"
+                    if reply.content_type == "photo"
                     else handle_document
                 )
                 reply_content = (
-                    message.reply_to_message.photo[-1]
-                    if message.reply_to_message.content_type == "photo"
-                    else message.reply_to_message.document
+                    mediasize.pick_tg_photo(reply.photo)
+                    if reply.content_type == "photo"
+                    else reply.document
                 )
                 vk_message[reply_content_key] = handle_reply_content(reply_content)
 
@@ -203,35 +457,39 @@ def process_telegram_message(bot: telebot.TeleBot, message) -> dict:
             handle_photo if message.content_type == "photo" else handle_document
         )
         vk_message[content_key] = handle_content(
-            message.photo[-1] if message.content_type == "photo" else message.document
+            mediasize.pick_tg_photo(message.photo)
+            if message.content_type == "photo"
+            else message.document
         )
+        # Подпись отправляется всегда, вместе с автором
+        vk_message["text"] = f"{author_tag}: {message.caption if message.caption else ''}"
 
         # Добавляем текст, если это ответ на сообщение
-        if message.reply_to_message:
-            reply_text = create_reply_text(message.reply_to_message)
+        if reply:
+            reply_text = create_reply_text(reply)
             vk_message[
                 "text"
             ] = f"{author_tag}: {message.caption if message.caption else ''}\n[В ответ на: {reply_text}]"
 
             # Если ответ на фотографию или документ
-            if message.reply_to_message.content_type in ["photo", "document"]:
+            if reply.content_type in ["photo", "document"]:
                 reply_content_key = (
                     "reply_photo"
-                    if message.reply_to_message.content_type == "photo"
+                    if reply.content_type == "photo"
                     else "reply_document"
                 )
                 handle_reply_content = (
                     handle_photo
-                    if message.reply_to_message.content_type == "photo"
+                    if reply.content_type == "photo"
                     else handle_document
                 )
                 reply_content = (
-                    message.reply_to_message.photo[-1]
-                    if message.reply_to_message.content_type == "photo"
-                    else message.reply_to_message.document
+                    mediasize.pick_tg_photo(reply.photo)
+                    if reply.content_type == "photo"
+                    else reply.document
                 )
                 vk_message[reply_content_key] = handle_reply_content(reply_content)
-            # Если это пересланное сообщение
+        # Если это пересланное сообщение
         if message.forward_from:
             forward_author_tag = (
                 message.forward_from.first_name
@@ -246,61 +504,249 @@ def process_telegram_message(bot: telebot.TeleBot, message) -> dict:
     return vk_message
 
 
-def send_vk_message(vk_session: vk_api.VkApi, vk_message: dict, chat_id: int) -> None:
+def process_telegram_album(
+    bot: telebot.TeleBot, messages: list, message_map: MessageMap = None
+) -> dict:
+    """
+    Преобразует альбом телеграма (сообщения с общим media_group_id) в одно сообщение для ВК
+
+    Параметры:
+        bot (telebot.TeleBot): Объект бота Telegram.
+        messages (list): Сообщения альбома по порядку.
+        message_map (MessageMap): Соответствие пересланных сообщений.
+
+    Возвращает:
+        dict - словарь, подобный вк сообщению, вложения альбома лежат по ключу album
+    """
+    texts = []
+    first_text = None
+    album = []
+    reply_to = None
+    for message in messages:
+        vk_message = process_telegram_message(bot, message, message_map)
+        if first_text is None:
+            first_text = vk_message.get("text")
+        # Подпись альбома может быть у любого его элемента
+        if message.caption:
+            texts.append(vk_message["text"])
+        album += vk_message_media(vk_message)
+        reply_to = reply_to or vk_message.get("reply_to")
+    # Без подписей остаётся текст первого элемента: автор, пересылка, цитата ответа
+    if not texts and first_text:
+        texts.append(first_text)
+    vk_message = {"album": album}
+    if reply_to is not None:
+        vk_message["reply_to"] = reply_to
+    if texts:
+        vk_message["text"] = "\n".join(texts)
+    return vk_message
+
+
+def vk_message_media(vk_message: dict) -> list:
+    """
+    Возвращает вложения сообщения для VK в порядке отправки.
+
+    Параметры:
+        vk_message (dict): Результат process_telegram_message или process_telegram_album.
+
+    Возвращает:
+        list - пары (тип вложения, TelegramFile)
+    """
+    return [(key, vk_message[key]) for key in MEDIA_ORDER if key in vk_message] + list(
+        vk_message.get("album", [])
+    )
+
+
+def is_text_only(vk_message: dict) -> bool:
+    """
+    Проверяет, что сообщение для VK состоит только из текста и его можно склеить с соседними.
+
+    Параметры:
+        vk_message (dict): Результат process_telegram_message.
+
+    Возвращает:
+        bool
+    """
+    return bool(
+        vk_message.get("text")
+        and not vk_message_media(vk_message)
+        and "reply_to" not in vk_message
+    )
+
+
+@metrics.timed("send_vk_message")
+def send_vk_message(
+    vk_scheduler: VkScheduler,
+    vk_message: dict,
+    chat_id: int,
+    delivery: Delivery = None,
+    media_cache: MediaCache = None,
+    message_map: MessageMap = None,
+) -> None:
     """
     Отправляет сообщение вк в нужный чат.
+    Текст и вложения уходят одним вызовом messages.send; если вложений больше
+    VK_MAX_ATTACHMENTS, они делятся на несколько сообщений, текст идёт с первым.
+    Отправки ставятся в очередь планировщика без ожидания, чтобы упаковаться в execute
+    вместе с запросами серверов загрузки; порядок отправки сохраняется очередью.
 
     Параметры:
-        vk_session (vk_api.VkApi): Объект сессии.
+        vk_scheduler (VkScheduler): Планировщик вызовов API VK.
         vk_message (dict): Словарь с полями текста и вложений сообщения вк.
         chat_id (int): ID чата VK.
+        delivery (Delivery): Состояние доставки из очереди исходящих сообщений. Части, доставленные
+            при предыдущих попытках, пропускаются, а random_id детерминирован, поэтому повтор
+            уже отправленной части VK отбрасывает как дубликат.
+        media_cache (MediaCache): Кэш медиафайлов. Файл, уже загруженный в VK, не скачивается
+            и не загружается повторно; фотографии дополнительно сверяются по хэшу содержимого.
+        message_map (MessageMap): Соответствие пересланных сообщений. Отправленные сообщения
+            сопоставляются исходным (tg_chat_id, tg_message_ids), а сообщение с reply_to
+            уходит ответом на сообщение беседы с этим conversation_message_id.
 
     Возвращает:
         None
     """
-    vk = vk_session.get_api()
-
-    # Отправка текстового сообщения
-    if "text" in vk_message:
-        vk.messages.send(
-            peer_id=chat_id, message=vk_message["text"], random_id=get_random_id()
+    # Части сообщения по порядку отправки: группы по VK_MAX_ATTACHMENTS вложений
+    # (ответ в виде фотографии, ответ в виде документа, фотография, документ, альбом)
+    media = vk_message_media(vk_message)
+    chunks = [
+        media[start : start + VK_MAX_ATTACHMENTS]
+        for start in range(0, len(media), VK_MAX_ATTACHMENTS)
+    ] or [[]]
+    pending = [
+        part for part in range(len(chunks)) if not (delivery and delivery.done(part))
+    ]
+
+    # Функция загрузки одного вложения, возвращает строку вложения VK
+    def upload_attachment(item):
+        key, file = item
+        cache_keys = []
+        attachment = None
+        if media_cache is not None and file.file_unique_id:
+            cache_keys.append(f"tg:{file.file_unique_id}")
+            attachment = media_cache.get(cache_keys[0])
+            if attachment:
+                metrics.inc("bridge_media_cache_total", result="hit")
+                return attachment
+        if key.endswith("photo"):
+            with metrics.timed("download_telegram_file"):
+                photo = transfer.download_telegram_file(file)
+            if media_cache is not None:
+                cache_keys.append(f"sha1:{hashlib.sha1(photo.getbuffer()).hexdigest()}")
+                attachment = media_cache.get(cache_keys[-1])
+                metrics.inc("bridge_media_cache_total", result="hit" if attachment else "miss")
+            if not attachment:
+                photo = mediasize.fit_photo(photo, mediasize.VK_PHOTO_LIMIT)
+                with metrics.timed("vk_upload_photo"):
+                    photo_info = vk_scheduler.upload.photo_messages(photos=photo)[0]
+                attachment = f"photo{photo_info['owner_id']}_{photo_info['id']}"
+        else:
+            if media_cache is not None:
+                metrics.inc("bridge_media_cache_total", result="miss")
+            with metrics.timed("vk_upload_document"):
+                doc_info = transfer.upload_vk_document(vk_scheduler, file, chat_id)
+            attachment = f"doc{doc_info['doc']['owner_id']}_{doc_info['doc']['id']}"
+        if media_cache is not None:
+            for cache_key in cache_keys:
+                media_cache.put(cache_key, attachment)
+            # Тот же файл, пересланный из VK обратно в Telegram, не загружается заново
+            media_cache.put(f"vk:{attachment}", file.file_id)
+        return attachment
+
+    # Вложения загружаются параллельно, а отправляются в исходном порядке
+    attachments = iter(
+        pipeline.map_ordered(
+            upload_attachment, [item for part in pending for item in chunks[part]]
         )
+    )
+    sends = []
+    for part in pending:
+        # С peer_ids ответ содержит conversation_message_id отправленного сообщения
+        values = {
+            "peer_ids": chat_id,
+            "random_id": delivery.random_id(part) if delivery else get_random_id(),
+        }
+        if part == 0 and vk_message.get("text"):
+            values["message"] = vk_message["text"]
+        if part == 0 and vk_message.get("reply_to"):
+            values["forward"] = json.dumps(
+                {
+                    "peer_id": chat_id,
+                    "conversation_message_ids": [vk_message["reply_to"]],
+                    "is_reply": 1,
+                }
+            )
+        if chunks[part]:
+            values["attachment"] = ",".join(next(attachments) for _ in chunks[part])
+        if "message" in values or "attachment" in values:
+            sends.append((part, vk_scheduler.submit("messages.send", values)))
+
+    # Дожидаемся всех отправок, чтобы ошибки дошли до обработчика
+    for part, result in sends:
+        sent = result.result()[0]
+        if "error" in sent:
+            raise VkApiError(f"Ошибка отправки сообщения: {sent['error']}")
+        if message_map is not None:
+            for tg_message_id in vk_message.get("tg_message_ids", []):
+                message_map.put(
+                    vk_message["tg_chat_id"],
+                    tg_message_id,
+                    chat_id,
+                    sent["conversation_message_id"],
+                )
+        if delivery:
+            delivery.mark(part)
 
-    # Функция для отправки фотографий
-    def send_photo(photo):
-        upload = vk_api.VkUpload(vk_session)
-        photo_info = upload.photo_messages(photos=photo)[0]
-        vk.messages.send(
-            peer_id=chat_id,
-            attachment=f"photo{photo_info['owner_id']}_{photo_info['id']}",
-            random_id=get_random_id(),
-        )
 
-    # Функция для отправки документов
-    def send_document(doc_path):
-        upload = vk_api.VkUpload(vk_session)
-        doc_info = upload.document_message(
-            doc=doc_path, title=os.path.basename(doc_path), peer_id=chat_id
-        )
-        vk.messages.send(
-            peer_id=chat_id,
-            attachment=f"doc{doc_info['doc']['owner_id']}_{doc_info['doc']['id']}",
-            random_id=get_random_id(),
-        )
-        os.remove(doc_path)  # Удаление локального файла после отправки
+def vk_message_to_payload(vk_message: dict) -> dict:
+    """
+    Преобразует сообщение для VK в формат JSON для очереди исходящих сообщений.
+
+    Параметры:
+        vk_message (dict): Результат process_telegram_message или process_telegram_album.
+
+    Возвращает:
+        dict
+    """
 
-    # Отправка ответа в виде фотографии
-    if "reply_photo" in vk_message:
-        send_photo(vk_message["reply_photo"])
+    def dump(value):
+        if isinstance(value, transfer.TelegramFile):
+            return {
+                "file_id": value.file_id,
+                "file_name": value.file_name,
+                "file_unique_id": value.file_unique_id,
+                "file_size": value.file_size,
+            }
+        if isinstance(value, (list, tuple)):
+            return [dump(item) for item in value]
+        return value
 
-    # Отправка ответа в виде документа
-    if "reply_document" in vk_message:
-        send_document(vk_message["reply_document"])
+    return {key: dump(value) for key, value in vk_message.items()}
 
-    # Отправка фотографии
-    if "photo" in vk_message:
-        send_photo(vk_message["photo"])
 
-    # Отправка документа
-    if "document" in vk_message:
-        send_document(vk_message["document"])
+def vk_message_from_payload(bot: telebot.TeleBot, payload: dict) -> dict:
+    """
+    Восстанавливает сообщение для VK из очереди исходящих сообщений.
+
+    Параметры:
+        bot (telebot.TeleBot): Объект бота Telegram.
+        payload (dict): Результат vk_message_to_payload.
+
+    Возвращает:
+        dict
+    """
+
+    def load(value):
+        if isinstance(value, dict):
+            return transfer.TelegramFile(
+                bot,
+                value["file_id"],
+                value["file_name"],
+                value.get("file_unique_id"),
+                value.get("file_size"),
+            )
+        if isinstance(value, list):
+            return tuple(load(item) for item in value)
+        return value
+
+    return {key: load(value) for key, value in payload.items()}
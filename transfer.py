@@ -0,0 +1,427 @@
+"""
+Этот модуль содержит потоковую передачу файлов между Telegram и VK.
+Скачивание идёт по частям и сразу передаётся в multipart-запрос загрузки, поэтому файл
+целиком в памяти не держится. Если размер файла заранее неизвестен, данные сначала
+сбрасываются во временный файл с уникальным именем (в памяти остаётся не больше
+SPOOL_MEMORY_LIMIT байт).
+
+Классы:
+- TelegramFile(bot, file_id, file_name, file_unique_id, file_size):
+  Файл Telegram, который ещё не скачан.
+- RemoteFile(url, title, size, cache_key, file_id):
+  Файл по ссылке (например, документ VK).
+- MultipartStream(fields, files):
+  Тело multipart/form-data, которое читается по частям и открывает источники по мере чтения.
+
+Функции:
+- download_telegram_file(document):
+  Скачивает небольшой файл Telegram (фотографию) в память.
+- upload_vk_document(vk_scheduler, document, peer_id):
+  Потоково загружает файл Telegram в документы сообщений VK.
+- prefetch_url_part(document):
+  Заранее скачивает файл по ссылке во временный файл.
+- discard_prefetched(future):
+  Удаляет временный файл заранее скачанного документа.
+- send_tg_documents(bot, chat_id, documents, parts, caption, reply_to):
+  Потоково отправляет документы по ссылкам в чат Telegram одной медиагруппой.
+"""
+
+import io
+import json
+import tempfile
+import uuid
+from concurrent.futures import Future
+from typing import BinaryIO, NamedTuple, Optional
+
+import requests
+import telebot
+from telebot import apihelper
+from telebot.apihelper import ApiTelegramException
+from vk_api import VkApiError
+
+import httppool
+from vkscheduler import VkScheduler
+
+# Размер части при чтении и записи
+CHUNK_SIZE = 64 * 1024
+# Сколько байт временный файл держит в памяти перед сбросом на диск
+SPOOL_MEMORY_LIMIT = 1024 * 1024
+# Таймауты (подключение, чтение) для скачивания и загрузки
+TRANSFER_TIMEOUT = (15, 120)
+
+
+class TelegramFile(NamedTuple):
+    """
+    Файл Telegram, который будет скачан в момент загрузки.
+    file_unique_id - постоянный id файла, ключ кэша медиафайлов; file_size - размер в байтах.
+    """
+
+    bot: telebot.TeleBot
+    file_id: str
+    file_name: str
+    file_unique_id: Optional[str] = None
+    file_size: Optional[int] = None
+
+
+class RemoteFile(NamedTuple):
+    """
+    Файл, доступный по ссылке. size - размер в байтах, если известен заранее.
+    cache_key - ключ кэша медиафайлов, file_id - файл уже есть в Telegram и не скачивается.
+    """
+
+    url: str
+    title: str
+    size: Optional[int] = None
+    cache_key: Optional[str] = None
+    file_id: Optional[str] = None
+
+
+def _spool(response: requests.Response) -> tuple:
+    """
+    Сбрасывает ответ во временный файл, ограничивая расход памяти.
+
+    Параметры:
+        response (requests.Response): Ответ, открытый с stream=True.
+
+    Возвращает:
+        tuple - (файловый объект, размер в байтах)
+    """
+    spooled = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_LIMIT)
+    try:
+        for chunk in response.iter_content(CHUNK_SIZE):
+            spooled.write(chunk)
+    finally:
+        response.close()
+    size = spooled.tell()
+    spooled.seek(0)
+    return spooled, size
+
+
+def open_url_part(url: str, size: Optional[int] = None) -> tuple:
+    """
+    Готовит источник данных по ссылке для MultipartStream.
+    Если размер известен, соединение откроется только когда до него дойдёт чтение.
+
+    Параметры:
+        url (str): Ссылка на файл.
+        size (int): Размер файла, если известен.
+
+    Возвращает:
+        tuple - (функция открытия источника, размер в байтах)
+    """
+    if size:
+
+        def opener() -> BinaryIO:
+            response = httppool.get_session().get(
+                url, stream=True, timeout=TRANSFER_TIMEOUT
+            )
+            response.raise_for_status()
+            if response.headers.get("Content-Encoding"):
+                # Сжатый ответ не совпадёт по длине с заявленным размером
+                return _spool(response)[0]
+            response.raw.decode_content = False
+            return response.raw
+
+        return opener, size
+
+    response = httppool.get_session().get(url, stream=True, timeout=TRANSFER_TIMEOUT)
+    response.raise_for_status()
+    length = response.headers.get("Content-Length")
+    if length and not response.headers.get("Content-Encoding"):
+        response.raw.decode_content = False
+        return (lambda: response.raw), int(length)
+    spooled, spooled_size = _spool(response)
+    return (lambda: spooled), spooled_size
+
+
+def prefetch_url_part(document: RemoteFile) -> tuple:
+    """
+    Заранее скачивает файл по ссылке во временный файл, чтобы несколько файлов
+    можно было скачивать параллельно, а затем отправить одним запросом.
+
+    Параметры:
+        document (RemoteFile): Файл по ссылке.
+
+    Возвращает:
+        tuple - (функция открытия источника, размер в байтах)
+    """
+    response = httppool.get_session().get(
+        document.url, stream=True, timeout=TRANSFER_TIMEOUT
+    )
+    response.raise_for_status()
+    spooled, size = _spool(response)
+    return (lambda: spooled), size
+
+
+def discard_prefetched(future: Future) -> None:
+    """
+    Удаляет временный файл документа, заранее скачанного prefetch_url_part. Вызывается, когда
+    документ больше не нужен, в том числе если отправка не удалась: ещё не начатое скачивание
+    отменяется, а незавершённое - удаляется по завершении. Уже отправленный файл закрыт
+    MultipartStream, повторное закрытие ничего не делает.
+
+    Параметры:
+        future (Future): Задача prefetch_url_part.
+
+    Возвращает:
+        None
+    """
+
+    def close(done: Future) -> None:
+        if done.cancelled() or done.exception() is not None:
+            return
+        opener, _ = done.result()
+        opener().close()
+
+    if not future.cancel():
+        future.add_done_callback(close)
+
+
+def open_telegram_part(document: TelegramFile) -> tuple:
+    """
+    Готовит файл Telegram как источник данных для MultipartStream.
+
+    Параметры:
+        document (TelegramFile): Файл Telegram.
+
+    Возвращает:
+        tuple - (функция открытия источника, размер в байтах)
+    """
+    file_info = document.bot.get_file(document.file_id)
+    if apihelper.FILE_URL is None:
+        url = f"https://api.telegram.org/file/bot{document.bot.token}/{file_info.file_path}"
+    else:
+        url = apihelper.FILE_URL.format(document.bot.token, file_info.file_path)
+    return open_url_part(url, file_info.file_size)
+
+
+def build_multipart(fields: dict, files: list) -> tuple:
+    """
+    Разбивает тело multipart/form-data на готовые байтовые части и источники файлов.
+
+    Параметры:
+        fields (dict): Текстовые поля формы.
+        files (list): Файлы - кортежи (имя поля, имя файла, источник, размер).
+
+    Возвращает:
+        tuple - (заголовок Content-Type, список частей: bytes или кортеж (источник, размер))
+    """
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(
+            (
+                f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'
+                f"{value}\r\n"
+            ).encode("utf-8")
+        )
+    for name, file_name, source, size in files:
+        quoted_name = file_name.replace('"', "'").replace("\r", "").replace("\n", "")
+        parts.append(
+            (
+                f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; '
+                f'filename="{quoted_name}"\r\n'
+                "Content-Type: application/octet-stream\r\n\r\n"
+            ).encode("utf-8")
+        )
+        parts.append((source, size))
+        parts.append(b"\r\n")
+    parts.append(f"--{boundary}--\r\n".encode("utf-8"))
+    return f"multipart/form-data; boundary={boundary}", parts
+
+
+def multipart_length(parts: list) -> int:
+    """
+    Считает длину тела по частям из build_multipart.
+    """
+    return sum(part[1] if isinstance(part, tuple) else len(part) for part in parts)
+
+
+class MultipartStream:
+    """
+    Тело запроса multipart/form-data, которое читается по частям.
+    Длина известна заранее, поэтому requests передаёт его с Content-Length, не собирая в памяти.
+
+    Параметры:
+        fields (dict): Текстовые поля формы.
+        files (list): Файлы - кортежи (имя поля, имя файла, функция открытия источника, размер).
+    """
+
+    def __init__(self, fields: dict, files: list) -> None:
+        self.content_type, self._parts = build_multipart(fields, files)
+        self._length = multipart_length(self._parts)
+        self._index = 0
+        self._offset = 0
+        self._source = None
+
+    def __len__(self) -> int:
+        return self._length
+
+    def read(self, size: int = -1) -> bytes:
+        """
+        Читает следующую часть тела запроса.
+
+        Параметры:
+            size (int): Максимальное количество байт, -1 - часть размера CHUNK_SIZE.
+
+        Возвращает:
+            bytes - пустая строка означает конец тела
+        """
+        if size is None or size < 0:
+            size = CHUNK_SIZE
+        while self._index < len(self._parts):
+            part = self._parts[self._index]
+            if isinstance(part, bytes):
+                chunk = part[self._offset : self._offset + size]
+                self._offset += len(chunk)
+                if self._offset >= len(part):
+                    self._next_part()
+                if chunk:
+                    return chunk
+                continue
+
+            opener, part_size = part
+            if self._source is None:
+                self._source = opener()
+            remaining = part_size - self._offset
+            chunk = self._source.read(min(size, remaining)) if remaining else b""
+            if remaining and not chunk:
+                raise IOError("Источник файла оказался короче заявленного размера")
+            self._offset += len(chunk)
+            if self._offset >= part_size:
+                self._source.close()
+                self._source = None
+                self._next_part()
+            if chunk:
+                return chunk
+        return b""
+
+    def _next_part(self) -> None:
+        self._index += 1
+        self._offset = 0
+
+    def close(self) -> None:
+        """
+        Закрывает открытый источник, если чтение прервалось.
+        """
+        if self._source is not None:
+            self._source.close()
+            self._source = None
+
+
+def _post_multipart(url: str, body: MultipartStream) -> requests.Response:
+    """
+    Отправляет потоковое multipart-тело и закрывает источники.
+    """
+    try:
+        return httppool.get_session().post(
+            url,
+            data=body,
+            headers={"Content-Type": body.content_type},
+            timeout=TRANSFER_TIMEOUT,
+        )
+    finally:
+        body.close()
+
+
+def download_telegram_file(document: TelegramFile) -> io.BytesIO:
+    """
+    Скачивает небольшой файл Telegram (фотографию) в память.
+
+    Параметры:
+        document (TelegramFile): Файл Telegram.
+
+    Возвращает:
+        io.BytesIO
+    """
+    file_info = document.bot.get_file(document.file_id)
+    file_data = io.BytesIO(document.bot.download_file(file_info.file_path))
+    file_data.name = document.file_name
+    return file_data
+
+
+def upload_vk_document(vk_scheduler: VkScheduler, document: TelegramFile, peer_id: int) -> dict:
+    """
+    Потоково загружает файл Telegram в документы сообщений VK.
+
+    Параметры:
+        vk_scheduler (VkScheduler): Планировщик вызовов API VK.
+        document (TelegramFile): Файл Telegram.
+        peer_id (int): ID беседы VK.
+
+    Возвращает:
+        dict - ответ docs.save
+    """
+    vk = vk_scheduler.get_api()
+    upload_url = vk.docs.getMessagesUploadServer(type="doc", peer_id=peer_id)["upload_url"]
+    opener, size = open_telegram_part(document)
+    body = MultipartStream({}, [("file", document.file_name, opener, size)])
+    response = _post_multipart(upload_url, body).json()
+    if "file" not in response:
+        raise VkApiError(f"Ошибка загрузки документа: {response.get('error', response)}")
+    return vk.docs.save(file=response["file"], title=document.file_name)
+
+
+def send_tg_documents(
+    bot: telebot.TeleBot,
+    chat_id: int,
+    documents: list,
+    parts: list = None,
+    caption: str = None,
+    reply_to: int = None,
+) -> list:
+    """
+    Потоково отправляет документы по ссылкам в чат Telegram одной медиагруппой.
+
+    Параметры:
+        bot (telebot.TeleBot): Объект бота Telegram.
+        chat_id (int): ID чата Telegram.
+        documents (list): Список RemoteFile.
+        parts (list): Заранее подготовленные источники (результаты prefetch_url_part);
+            None на месте документа - источник открывается при отправке.
+        caption (str): Подпись к первому документу.
+        reply_to (int): message_id сообщения, на которое это ответ.
+
+    Возвращает:
+        list - отправленные сообщения в формате JSON
+    """
+    media = []
+    files = []
+    for number, document in enumerate(documents):
+        # Файл, уже загруженный в Telegram, передаётся по file_id
+        if document.file_id:
+            media.append({"type": "document", "media": document.file_id})
+            continue
+        if parts and parts[number]:
+            opener, size = parts[number]
+        else:
+            opener, size = open_url_part(document.url, document.size)
+        media.append({"type": "document", "media": f"attach://file{number}"})
+        files.append((f"file{number}", document.title, opener, size))
+    method_name = "sendMediaGroup" if len(media) > 1 else "sendDocument"
+    fields = {"chat_id": chat_id}
+    if reply_to:
+        fields["reply_to_message_id"] = reply_to
+        fields["allow_sending_without_reply"] = "true"
+    if len(media) > 1:
+        if caption:
+            media[0]["caption"] = caption
+        fields["media"] = json.dumps(media)
+    else:
+        if caption:
+            fields["caption"] = caption
+        if files:
+            files[0] = ("document",) + files[0][1:]
+        else:
+            fields["document"] = media[0]["media"]
+    if apihelper.API_URL is None:
+        url = f"https://api.telegram.org/bot{bot.token}/{method_name}"
+    else:
+        url = apihelper.API_URL.format(bot.token, method_name)
+
+    response = _post_multipart(url, MultipartStream(fields, files))
+    result_json = response.json()
+    if not result_json.get("ok"):
+        raise ApiTelegramException(method_name, response, result_json)
+    result = result_json["result"]
+    return result if isinstance(result, list) else [result]
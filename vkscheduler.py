@@ -0,0 +1,231 @@
+"""
+Этот модуль содержит общий планировщик вызовов API VK для обоих направлений пересылки.
+Вызовы ставятся в очередь, частота запросов ограничивается алгоритмом token bucket,
+а независимые вызовы из очереди упаковываются в один запрос execute (до 25 вызовов).
+
+Классы:
+- TokenBucket(rate, capacity):
+  Ограничитель частоты запросов.
+- VkScheduler(vk_session, rate, burst):
+  Планировщик вызовов API VK. Совместим по интерфейсу с vk_api.VkApi
+  (методы method и get_api). Содержит загрузчик upload, созданный один раз
+  и использующий HTTP-сессию vk_session.
+
+Использование:
+- Создайте один VkScheduler на процесс и передайте его в оба слушателя.
+- Для неблокирующих вызовов используйте submit(method, values), для блокирующих - get_api().
+"""
+
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import vk_api
+from vk_api.vk_api import VkApiMethod
+from vk_api.exceptions import ApiError
+from vk_api.utils import sjson_dumps
+
+import metrics
+
+# Версия API VK: с 5.131 messages.send с peer_ids возвращает conversation_message_id,
+# а параметр forward позволяет ответить на сообщение беседы
+VK_API_VERSION = "5.131"
+# Ограничение API VK - 3 запроса в секунду для ключа сообщества
+VK_RPS = 3.0
+# Максимальное количество вызовов в одном execute
+EXECUTE_BATCH_SIZE = 25
+# Ограничение длины кода execute с запасом
+EXECUTE_CODE_LIMIT = 60000
+
+
+class TokenBucket:
+    """
+    Ограничитель частоты запросов по алгоритму token bucket.
+
+    Параметры:
+        rate (float): Скорость пополнения, токенов в секунду.
+        capacity (float): Максимальное количество накопленных токенов.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1.0) -> None:
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """
+        Забирает один токен, при необходимости ожидая его появления.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self._capacity, self._tokens + (now - self._updated) * self._rate
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self._rate
+            time.sleep(delay)
+
+
+def _code_length(call: tuple) -> int:
+    """
+    Возвращает длину вызова API.method(параметры) в коде execute.
+    """
+    method, values, _ = call
+    return len(sjson_dumps(values)) + len(method) + 8
+
+
+class VkScheduler:
+    """
+    Планировщик вызовов API VK с ограничением частоты и упаковкой в execute.
+
+    Параметры:
+        vk_session (vk_api.VkApi): Объект сессии.
+        rate (float): Допустимое количество запросов в секунду.
+        burst (float): Допустимое количество запросов подряд.
+    """
+
+    def __init__(
+        self, vk_session: vk_api.VkApi, rate: float = VK_RPS, burst: float = 1.0
+    ) -> None:
+        self.vk_session = vk_session
+        self.upload = vk_api.VkUpload(self.get_api())
+        self.upload.http = vk_session.http
+        self._bucket = TokenBucket(rate, burst)
+        self._queue = queue.Queue()
+        self._dispatcher = threading.Thread(target=self._dispatch_loop, daemon=True)
+        self._dispatcher.start()
+
+    def submit(self, method: str, values: dict = None) -> Future:
+        """
+        Ставит вызов метода в очередь, не дожидаясь результата.
+
+        Параметры:
+            method (str): Название метода API, например messages.send.
+            values (dict): Параметры метода.
+
+        Возвращает:
+            Future - результат вызова (поле response) или исключение VkApiError
+        """
+        future = Future()
+        metrics.inc("bridge_vk_calls_total", method=method)
+        self._queue.put((method, dict(values or {}), future))
+        return future
+
+    def depth(self) -> int:
+        """
+        Возвращает количество вызовов, ожидающих отправки.
+        """
+        return self._queue.qsize()
+
+    def method(self, method: str, values: dict = None) -> dict:
+        """
+        Вызывает метод API и дожидается результата. Интерфейс совпадает с vk_api.VkApi.method.
+
+        Параметры:
+            method (str): Название метода API.
+            values (dict): Параметры метода.
+
+        Возвращает:
+            dict - поле response ответа API
+        """
+        return self.submit(method, values).result()
+
+    def get_api(self) -> VkApiMethod:
+        """
+        Возвращает объект для вызова методов через точку (vk.messages.send(...)).
+
+        Возвращает:
+            VkApiMethod
+        """
+        return VkApiMethod(self)
+
+    def _dispatch_loop(self) -> None:
+        """
+        Забирает вызовы из очереди и выполняет их пачками.
+        """
+        # Вызов, который не поместился в предыдущую пачку, открывает следующую
+        carry = None
+        while True:
+            batch = [carry if carry is not None else self._queue.get()]
+            carry = None
+            self._bucket.acquire()
+            # Пока ждали токен, очередь могла пополниться
+            code_length = _code_length(batch[0])
+            while len(batch) < EXECUTE_BATCH_SIZE:
+                try:
+                    call = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                length = _code_length(call)
+                if code_length + length > EXECUTE_CODE_LIMIT:
+                    carry = call
+                    break
+                code_length += length
+                batch.append(call)
+            try:
+                self._execute(batch)
+            except Exception as e:
+                logging.error(f"Непредвиденная ошибка планировщика VK: {e}")
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _execute(self, batch: list) -> None:
+        """
+        Выполняет пачку вызовов одним запросом.
+
+        Параметры:
+            batch (list): Список кортежей (метод, параметры, Future).
+
+        Возвращает:
+            None
+        """
+        if len(batch) == 1:
+            method, values, future = batch[0]
+            try:
+                future.set_result(self.vk_session.method(method, values))
+            except Exception as e:
+                future.set_exception(e)
+            return
+
+        code = "return [{}];".format(
+            ",".join(f"API.{method}({sjson_dumps(values)})" for method, values, _ in batch)
+        )
+        try:
+            response_raw = self.vk_session.method("execute", {"code": code}, raw=True)
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+
+        # Ошибки отдельных вызовов приходят по порядку в execute_errors
+        errors = iter(response_raw.get("execute_errors", []))
+        for (method, values, future), response in zip(batch, response_raw["response"]):
+            if response is not False:
+                future.set_result(response)
+            else:
+                error = next(
+                    errors, {"error_code": -1, "error_msg": "execute call failed"}
+                )
+                future.set_exception(
+                    ApiError(self.vk_session, method, values, False, error)
+                )
+        for method, values, future in batch:
+            if not future.done():
+                future.set_exception(
+                    ApiError(
+                        self.vk_session,
+                        method,
+                        values,
+                        False,
+                        {"error_code": -1, "error_msg": "no response in execute"},
+                    )
+                )
@@ -3,8 +3,13 @@
 Он устанавливает соединения с API VK и Telegram и управляет процессом пересылки сообщений из VK в Telegram.
 
 Функции:
-- listen_vk(vk_token, vk_group_id, VK_CHAT_ID, tg_token, TG_CHAT_ID):
-  Прослушивает сообщения в указанном чате VK и пересылает их в чат Telegram. Требует токены API и ID группы/чата для обеих платформ.
+- create_name_cache(vk_scheduler, routes):
+  Создаёт кэш имён VK и заполняет его участниками бесед из таблицы маршрутов.
+- listen_vk(vk_scheduler, vk_group_id, routes, tg_token, outbox, coalesce_window, media_cache,
+  message_map, governor, updates, name_cache, heartbeat):
+  Прослушивает сообщения в беседах VK из таблицы маршрутов и пересылает их в связанные чаты Telegram.
+  Требует общий планировщик вызовов API VK, ID группы VK, таблицу маршрутов, токен бота Telegram
+  и очередь исходящих сообщений.
 
 Использование:
 - Укажите необходимые токены API, ID группы/чата для VK и Telegram.
@@ -13,112 +18,623 @@
 
 import io
 import logging
-import requests
+import queue
 import telebot
-import vk_api
-from vk_api.bot_longpoll import VkBotEventType, VkBotLongPoll
-from telebot.apihelper import ApiException
-from vk_api import VkApiError
+from telebot.apihelper import ApiTelegramException
+from vk_api.bot_longpoll import VkBotEventType
 import urllib3
-import time
 from http.client import RemoteDisconnected
+from typing import Callable
 from requests.exceptions import ConnectionError, Timeout
 
-def listen_vk(vk_token: str, vk_group_id: int, VK_CHAT_ID: int, tg_token: str, TG_CHAT_ID: int) -> None:
+import httppool
+import mediasize
+import metrics
+import transfer
+from backfill import ResumableLongPoll, fetch_missed
+from coalesce import COALESCE_WINDOW, TEXT_LIMIT, Coalescer, pack_texts
+from mediacache import MediaCache
+from mediapipeline import pipeline
+from messagemap import MessageMap
+from namecache import NameCache
+from outbox import BULK_LANE, BULK_SIZE, CursorTracker, Delivery, Outbox, countdown
+from routing import RoutingTable
+from tggovernor import TelegramGovernor
+from vkscheduler import VkScheduler
+
+# Максимальная длина подписи к медиа в Telegram
+TG_CAPTION_LIMIT = 1024
+# Максимальное количество элементов медиагруппы Telegram
+TG_MEDIA_GROUP_LIMIT = 10
+# Максимальная глубина пересланных сообщений, которые показываются в Telegram
+MAX_FORWARD_DEPTH = 10
+# Позиция опроса Bots Long Poll в журнале очереди исходящих сообщений
+VK_TS_CURSOR = "vk:ts"
+
+
+def listen_vk(
+    vk_scheduler: VkScheduler,
+    vk_group_id: int,
+    routes: RoutingTable,
+    tg_token: str,
+    outbox: Outbox,
+    coalesce_window: float = COALESCE_WINDOW,
+    media_cache: MediaCache = None,
+    message_map: MessageMap = None,
+    governor: TelegramGovernor = None,
+    updates: queue.Queue = None,
+    name_cache: NameCache = None,
+    heartbeat: Callable[[], None] = None,
+) -> None:
     """
-    Прослушивает сообщения в VK и пересылает их в Telegram.
+    Прослушивает сообщения в VK и пересылает их в Telegram. Ошибки подключения не
+    перехватываются: слушателя перезапускает Supervisor.
 
     Параметры:
-        vk_token (str): Токен для VK.
+        vk_scheduler (VkScheduler): Планировщик вызовов API VK.
         vk_group_id (int): ID группы VK.
-        VK_CHAT_ID (int): ID чата VK.
+        routes (RoutingTable): Таблица маршрутов пар чатов.
         tg_token (str): Токен бота Telegram.
-        TG_CHAT_ID (int): ID чата Telegram.
+        outbox (Outbox): Очередь исходящих сообщений.
+        coalesce_window (float): Окно склейки коротких текстовых сообщений в секундах, 0 - без склейки.
+        media_cache (MediaCache): Кэш уже загруженных медиафайлов.
+        message_map (MessageMap): Соответствие пересланных сообщений для настоящих ответов.
+        governor (TelegramGovernor): Регулятор частоты отправки в Telegram; по умолчанию
+            с ограничениями Telegram.
+        updates (queue.Queue): Очередь (сообщение, функция подтверждения) от процесса приёма
+            в многопроцессном режиме; тогда опроса нет, а позицию хранит приём. None вместо
+            сообщения - события потеряны, нужно догрузить историю. Подтверждение вызывается,
+            когда сообщение (или вся догруженная история) записано в журнал.
+        name_cache (NameCache): Кэш имён из create_name_cache. Передайте его, если слушатель
+            перезапускается, чтобы кэш и его поток обновления не создавались заново.
+        heartbeat (Callable): Вызывается после каждого цикла опроса, по нему Supervisor
+            замечает зависший опрос.
 
     Возвращает:
         None
     """
-    try:
-        telegram_bot = telebot.TeleBot(tg_token, parse_mode=None)
-        vk_session = vk_api.VkApi(token=vk_token)
-        longpoll = VkBotLongPoll(vk_session, vk_group_id)
-    except VkApiError as vk_api_error:
-        logging.error(
-            f"Невозможно доставить сообщение об ошибке пользователю. Тип ошибки: {type(vk_api_error)}, Описание: {vk_api_error}"
-        )
-        exit(1)
-    retries = 0
-    while retries < 10:
+    telegram_bot = telebot.TeleBot(tg_token, parse_mode=None)
+    if governor is None:
+        governor = TelegramGovernor()
+    if name_cache is None:
+        name_cache = create_name_cache(vk_scheduler, routes)
+
+    # Функция сообщения об ошибке, если доставка не удалась после всех повторов.
+    # Сообщение тоже расходует бюджет чата и не отправляется, пока чат ограничен
+    def report_failure(TG_CHAT_ID, error):
+        governor.send(TG_CHAT_ID, telegram_bot.send_message, TG_CHAT_ID, f"ERROR: {error}")
+
+    outbox.register(
+        "vk_to_tg",
+        lambda TG_CHAT_ID, message, delivery: send_to_tg(
+            message,
+            name_cache,
+            telegram_bot,
+            TG_CHAT_ID,
+            delivery,
+            media_cache,
+            message_map,
+            governor,
+        ),
+        report_failure,
+    )
+    # Подряд идущие текстовые сообщения склеиваются в одно, тексты собираются при отправке
+    coalescer = Coalescer(
+        outbox.put, lambda messages: {"coalesced": messages}, coalesce_window
+    )
+
+    # Ставит сообщение беседы в очередь. Когда оно записано в журнал, оно запоминается как
+    # последнее пересланное и вызывается done; сообщение, которое не пересылается, - сразу
+    def forward_message(message, done=None):
+        pair = routes.for_vk(message["peer_id"])
+        if pair is None:
+            if done is not None:
+                done()
+            return
+        TG_CHAT_ID = pair.tg_chat_id
+        key = f"vk:{pair.vk_chat_id}:{message['conversation_message_id']}"
+
+        def queued():
+            outbox.set_cursor(f"vk:last:{pair.vk_chat_id}", message["conversation_message_id"])
+            if done is not None:
+                done()
+
         try:
-            for event in longpoll.listen():
-                try:
-                    # если есть новые сообщения
-                    if (
-                        event.type == VkBotEventType.MESSAGE_NEW
-                        and event.object.message["peer_id"] == VK_CHAT_ID
-                    ):
-                        send_to_tg(event.message, vk_session, telegram_bot, TG_CHAT_ID)
-                except VkApiError as vk_api_error:
-                    try:
-                        telegram_bot.send_message(TG_CHAT_ID, f"ERROR: {vk_api_error}")
-                    except Exception as e:
-                        logging.error(
-                            f"Невозможно доставить сообщение об ошибке пользователю. Тип ошибки: {type(vk_api_error)}, Описание: {vk_api_error}"
-                        )
-                except ApiException as tg_api_exception:
-                    try:
-                        telegram_bot.send_message(TG_CHAT_ID, f"ERROR: {tg_api_exception}")
-                    except Exception as e:
-                        logging.error(
-                            f"Невозможно доставить сообщение об ошибке пользователю. Тип ошибки: {type(tg_api_exception)}, Описание: {tg_api_exception}"
-                        )
-                except Exception as e:
-                    logging.error(f"Непредвиденная ошибка: {e}, {type(e)}")
-                    exit(1)
+            if documents_size(message) >= BULK_SIZE:
+                # Большие документы идут медленной полосой, а текст с заглушкой - сразу,
+                # чтобы следующие сообщения не ждали загрузки
+                coalescer.add(
+                    key,
+                    "vk_to_tg",
+                    TG_CHAT_ID,
+                    {"split": "text", "message": message},
+                    None,
+                    message["date"],
+                )
+                coalescer.add(
+                    f"{key}:bulk",
+                    "vk_to_tg",
+                    TG_CHAT_ID,
+                    {"split": "media", "message": message},
+                    None,
+                    message["date"],
+                    BULK_LANE,
+                    queued,
+                )
+            else:
+                coalescer.add(
+                    key,
+                    "vk_to_tg",
+                    TG_CHAT_ID,
+                    message,
+                    message["text"] if is_text_only(message) else None,
+                    message["date"],
+                    done=queued,
+                )
+        except Exception as e:
+            # Одно неудачное сообщение не должно останавливать слушателя и позицию опроса
+            logging.error(f"Непредвиденная ошибка: {e}, {type(e)}")
+            if done is not None:
+                done()
+
+    # Возвращает сообщения, пропущенные, пока мост не работал; повторы отсеет журнал по ключу
+    def fetch_backfill():
+        messages = []
+        for pair in routes.pairs:
+            last_id = outbox.get_cursor(f"vk:last:{pair.vk_chat_id}")
+            if not pair.vk_to_tg or last_id is None:
+                continue
+            with metrics.timed("vk_backfill"):
+                missed = fetch_missed(vk_scheduler, pair.vk_chat_id, int(last_id), vk_group_id)
+            logging.warning(f"Беседа {pair.vk_chat_id}: догружено {len(missed)} сообщений")
+            messages += missed
+        return messages
+
+    if updates is not None:
+        while True:
+            try:
+                message, ack = updates.get(timeout=1)
+            except queue.Empty:
+                pass
+            else:
+                if message is None:
+                    # Приём получает подтверждение, когда в журнал записаны все догруженные
+                    missed = fetch_backfill()
+                    done = countdown(len(missed), ack)
+                    for item in missed:
+                        forward_message(item, done)
+                else:
+                    forward_message(message, ack)
+            if heartbeat is not None:
+                heartbeat()
+
+    # Опрос продолжается с позиции, сохранённой до перезапуска
+    longpoll = ResumableLongPoll(
+        vk_scheduler.vk_session, vk_group_id, outbox.get_cursor(VK_TS_CURSOR)
+    )
+    longpoll.session = httppool.get_session()
+    # Позиция сохраняется, только когда все события до неё записаны в журнал: сообщения
+    # могут ещё ждать в склейщике
+    cursor = CursorTracker(outbox, VK_TS_CURSOR)
+    while True:
+        try:
+            events = longpoll.check()
         except (urllib3.exceptions.ProtocolError, RemoteDisconnected, ConnectionError, Timeout):
             logging.warning("Проблемы сетью, попытка повторного подключения....")
-            time.sleep(30)
-            retries += 1
+            raise
+        messages = []
+        if longpoll.lost:
+            messages += fetch_backfill()
+            longpoll.lost = False
+        # если есть новые сообщения
+        messages += [
+            event.message for event in events if event.type == VkBotEventType.MESSAGE_NEW
+        ]
+        ack = cursor.add(longpoll.ts, len(messages))
+        for message in messages:
+            forward_message(message, ack)
+        if heartbeat is not None:
+            heartbeat()
 
 
-def send_to_tg(message, vk_session: vk_api.VkApi, telegram_bot: telebot.TeleBot, TG_CHAT_ID: int) -> None:
+def create_name_cache(vk_scheduler: VkScheduler, routes: RoutingTable) -> NameCache:
+    """
+    Создаёт кэш имён пользователей и сообществ VK, один на все беседы, и заполняет его
+    участниками бесед из таблицы маршрутов.
+
+    Параметры:
+        vk_scheduler (VkScheduler): Планировщик вызовов API VK.
+        routes (RoutingTable): Таблица маршрутов пар чатов.
+
+    Возвращает:
+        NameCache
+    """
+    name_cache = NameCache(
+        lambda id: get_username(vk_scheduler, id),
+        batch_loader=lambda ids: get_usernames(vk_scheduler, ids),
+    )
+    try:
+        for pair in routes.pairs:
+            if pair.vk_to_tg:
+                name_cache.warm(vk_scheduler, pair.vk_chat_id)
+    except (urllib3.exceptions.ProtocolError, RemoteDisconnected, ConnectionError, Timeout):
+        # Имена загрузятся по мере пересылки сообщений
+        logging.warning("Проблемы сетью, кэш имён не заполнен заранее")
+    return name_cache
+
+
+@metrics.timed("send_to_tg")
+def send_to_tg(
+    message,
+    name_cache: NameCache,
+    telegram_bot: telebot.TeleBot,
+    TG_CHAT_ID: int,
+    delivery: Delivery = None,
+    media_cache: MediaCache = None,
+    message_map: MessageMap = None,
+    governor: TelegramGovernor = None,
+) -> None:
     """
     Отправляет сообщение вк в телеграм.
 
     Параметры:
         message: Объект сообщения.
-        vk_session (vk_api.VkApi): Объект сессии.
+        name_cache (NameCache): Кэш имён пользователей и сообществ.
         telegram_bot (telebot.TeleBot): Объект телеграм бота.
         TG_CHAT_ID (int): ID чата Telegram.
+        delivery (Delivery): Состояние доставки из очереди исходящих сообщений. Части (текст,
+            группы вложений), доставленные при предыдущих попытках, пропускаются.
+        media_cache (MediaCache): Кэш медиафайлов. Файл, уже известный Telegram, отправляется
+            по file_id без повторного скачивания.
+        message_map (MessageMap): Соответствие пересланных сообщений. Ответ на уже пересланное
+            сообщение уходит настоящим ответом (reply_to_message_id) без цитаты и её вложений.
+        governor (TelegramGovernor): Регулятор частоты отправки. Если бюджет чата исчерпан
+            или Telegram ответил 429, выбрасывается RetryLater, и очередь повторит доставку
+            с первой недоставленной части.
+
+    Сообщение с большими документами приходит из очереди двумя частями: {"split": "text"} -
+    текст с заглушкой вместо вложений и {"split": "media"} - только вложения.
+
+    Текст уходит подписью к первой медиагруппе, если помещается; отдельным сообщением - иначе.
 
     Возвращает:
         None
     """
     # TODO обработка видео и аудио
 
-    text_to_send = get_forward_tree(message, 0, vk_session)
-    telegram_bot.send_message(chat_id=TG_CHAT_ID, text=text_to_send)
-    media_dict = {}
-    get_all_attachments(message, media_dict)
-    if media_dict:
-        for media_key in media_dict:
-            telegram_bot.send_media_group(
-                chat_id=TG_CHAT_ID, media=media_dict[media_key]
-            )
+    # Каждая отправка проходит через регулятор частоты; cost - количество сообщений в чате
+    def send(func, *args, cost=1, **kwargs):
+        if governor is None:
+            return func(*args, **kwargs)
+        return governor.send(TG_CHAT_ID, func, *args, cost=cost, **kwargs)
+
+    # Склеенные сообщения: каждая часть - текст не длиннее TEXT_LIMIT
+    if "coalesced" in message:
+        with metrics.timed("render_message"):
+            trees = [render_message(item, name_cache)[0] for item in message["coalesced"]]
+        texts, _ = plan_tg_media({}, "".join(trees))
+        for part, text in enumerate(texts):
+            if not (delivery and delivery.done(part)):
+                sent = send(telegram_bot.send_message, chat_id=TG_CHAT_ID, text=text)
+                if message_map is not None:
+                    for item in message["coalesced"]:
+                        message_map.put(
+                            TG_CHAT_ID,
+                            sent.message_id,
+                            item["peer_id"],
+                            item["conversation_message_id"],
+                        )
+                if delivery:
+                    delivery.mark(part)
+        return
+
+    split = message.get("split")
+    if split is not None:
+        message = message["message"]
+    reply_to_message_id = None
+    reply_message = message.get("reply_message")
+    if reply_message and message_map is not None:
+        original = message_map.tg_for_vk(
+            message["peer_id"], reply_message.get("conversation_message_id")
+        )
+        if original is not None:
+            # Исходное сообщение уже есть в чате: без цитаты и повторной пересылки вложений
+            message = {key: value for key, value in message.items() if key != "reply_message"}
+            if split != "media":
+                reply_to_message_id = original[1]
+    with metrics.timed("render_message"):
+        tree, media_dict = render_message(message, name_cache, media_cache)
+    if split == "text":
+        count = sum(len(media) for media in media_dict.values())
+        texts, groups = plan_tg_media({}, f"{tree}[Вложения загружаются: {count}]")
+    elif split == "media":
+        texts, groups = plan_tg_media(media_dict, None)
+    else:
+        texts, groups = plan_tg_media(media_dict, tree)
+    # Части сообщения: тексты, если они не поместились в подпись, затем медиагруппы
+    parts = [("text", [], text) for text in texts] + groups
+    # Несколько документов скачиваются параллельно, пока отправляются текст и фотографии;
+    # один документ передаётся потоком напрямую
+    documents = [
+        document
+        for part, (kind, items, _) in enumerate(parts)
+        if kind == "doc" and not (delivery and delivery.done(part))
+        for document in items
+        if not document.file_id
+    ]
+    prefetched = (
+        {
+            id(document): pipeline.submit(transfer.prefetch_url_part, document)
+            for document in documents
+        }
+        if len(documents) > 1
+        else {}
+    )
+
+    # Временные файлы документов удаляются и тогда, когда отправка прервалась (RetryLater,
+    # ошибка): повтор из очереди скачает их заново
+    try:
+        for part, (kind, items, caption) in enumerate(parts):
+            if delivery and delivery.done(part):
+                continue
+            # Ответ на уже пересланное сообщение - настоящий ответ первой частью
+            reply_to = reply_to_message_id if part == 0 else None
+            if kind == "text":
+                sent = [
+                    send(
+                        telegram_bot.send_message,
+                        chat_id=TG_CHAT_ID,
+                        text=caption,
+                        reply_to_message_id=reply_to,
+                        allow_sending_without_reply=True,
+                    )
+                ]
+                sent_ids = [result.message_id for result in sent]
+            elif kind == "doc":
+                # Документы передаются потоком, минуя память процесса
+                sent = send(
+                    transfer.send_tg_documents,
+                    telegram_bot,
+                    TG_CHAT_ID,
+                    items,
+                    [
+                        prefetched[id(document)].result() if id(document) in prefetched else None
+                        for document in items
+                    ]
+                    if prefetched
+                    else None,
+                    caption,
+                    reply_to,
+                    cost=len(items),
+                )
+                sent_ids = [result["message_id"] for result in sent]
+                remember_tg_files(
+                    media_cache,
+                    [document.cache_key for document in items],
+                    [
+                        (result["document"]["file_id"], result["document"]["file_unique_id"])
+                        for result in sent
+                    ],
+                )
+            else:
+                sent = send(
+                    send_tg_photos,
+                    telegram_bot,
+                    TG_CHAT_ID,
+                    items,
+                    caption,
+                    reply_to,
+                    cost=len(items),
+                )
+                sent_ids = [result.message_id for result in sent]
+                # Запоминается тот же размер, который выберет обратная пересылка в VK
+                photos = [mediasize.pick_tg_photo(result.photo) for result in sent]
+                remember_tg_files(
+                    media_cache,
+                    [item.cache_key for item in items],
+                    [(photo.file_id, photo.file_unique_id) for photo in photos],
+                )
+            if message_map is not None:
+                for sent_id in sent_ids:
+                    message_map.put(
+                        TG_CHAT_ID, sent_id, message["peer_id"], message["conversation_message_id"]
+                    )
+            if delivery:
+                delivery.mark(part)
+    finally:
+        for future in prefetched.values():
+            transfer.discard_prefetched(future)
+
+
+def send_tg_photos(
+    telegram_bot: telebot.TeleBot,
+    TG_CHAT_ID: int,
+    items: list,
+    caption: str = None,
+    reply_to: int = None,
+) -> list:
+    """
+    Отправляет фотографии одной медиагруппой (одну - отдельной фотографией). Если Telegram
+    не смог получить фотографию по ссылке из-за размера, фотографии скачиваются, при
+    необходимости уменьшаются и отправляются файлами.
+
+    Параметры:
+        telegram_bot (telebot.TeleBot): Объект телеграм бота.
+        TG_CHAT_ID (int): ID чата Telegram.
+        items (list): Фотографии (InputMediaPhoto).
+        caption (str): Подпись к первой фотографии.
+        reply_to (int): message_id сообщения, на которое это ответ.
+
+    Возвращает:
+        list - отправленные сообщения
+    """
+
+    def send():
+        # Медиагруппа должна содержать не меньше двух элементов
+        if len(items) == 1:
+            return [
+                telegram_bot.send_photo(
+                    chat_id=TG_CHAT_ID,
+                    photo=items[0].media,
+                    caption=caption,
+                    reply_to_message_id=reply_to,
+                    allow_sending_without_reply=True,
+                )
+            ]
+        items[0].caption = caption
+        return telegram_bot.send_media_group(
+            chat_id=TG_CHAT_ID,
+            media=items,
+            reply_to_message_id=reply_to,
+            allow_sending_without_reply=True,
+        )
+
+    try:
+        return send()
+    except ApiTelegramException as error:
+        if not mediasize.is_size_error(error):
+            raise
+        logging.warning(f"Telegram не принял фотографии по ссылке: {error.description}")
+    with metrics.timed("download_tg_photos"):
+        for item, media in zip(items, pipeline.map_ordered(download_tg_photo, items)):
+            item.media = media
+    return send()
+
+
+def download_tg_photo(item: telebot.types.InputMediaPhoto):
+    """
+    Скачивает фотографию по ссылке и уменьшает её до ограничения Telegram.
+
+    Параметры:
+        item (telebot.types.InputMediaPhoto): Фотография.
 
+    Возвращает:
+        io.BytesIO или file_id, если фотография уже есть в Telegram
+    """
+    if not item.media.startswith(("http://", "https://")):
+        return item.media
+    response = httppool.get_session().get(item.media, timeout=transfer.TRANSFER_TIMEOUT)
+    response.raise_for_status()
+    photo = io.BytesIO(response.content)
+    photo.name = "photo.jpg"
+    return mediasize.fit_photo(photo, mediasize.TG_PHOTO_LIMIT)
+
+
+def remember_tg_files(media_cache: MediaCache, cache_keys: list, files: list) -> None:
+    """
+    Запоминает file_id отправленных в Telegram файлов VK, чтобы повторная пересылка того же
+    вложения не скачивала его заново. Обратное соответствие (файл Telegram -> вложение VK)
+    не запоминается: вложения пользователей VK приватные и без access_key не отправляются.
+    Его хранят только вложения, которые мост загрузил в VK сам.
+
+    Параметры:
+        media_cache (MediaCache): Кэш медиафайлов или None.
+        cache_keys (list): Ключи кэша отправленных вложений VK.
+        files (list): Отправленные файлы Telegram - пары (file_id, file_unique_id).
+
+    Возвращает:
+        None
+    """
+    if media_cache is None:
+        return
+    for cache_key, (file_id, _) in zip(cache_keys, files):
+        media_cache.put(cache_key, file_id)
+
+
+def documents_size(message) -> int:
+    """
+    Считает суммарный размер документов сообщения вместе с пересланными.
 
-def get_username(vk_session: vk_api.VkApi, id=0) -> str:
+    Параметры:
+        message: Объект сообщения.
+
+    Возвращает:
+        int - размер в байтах
+    """
+    size = sum(
+        attachment["doc"].get("size") or 0
+        for attachment in message["attachments"] or []
+        if attachment["type"] == "doc"
+    )
+    for forwarded in message.get("fwd_messages", []):
+        size += documents_size(forwarded)
+    if message.get("reply_message"):
+        size += documents_size(message["reply_message"])
+    return size
+
+
+def is_text_only(message) -> bool:
+    """
+    Проверяет, что сообщение VK состоит только из текста и его можно склеить с соседними.
+
+    Параметры:
+        message: Объект сообщения.
+
+    Возвращает:
+        bool
+    """
+    return bool(
+        message["text"]
+        and not message["attachments"]
+        and not message.get("fwd_messages")
+        and not message.get("reply_message")
+    )
+
+
+def plan_tg_media(media_dict: dict, text: str) -> tuple:
+    """
+    Раскладывает текст по сообщениям не длиннее TEXT_LIMIT (по границам строк), а вложения -
+    по медиагруппам Telegram.
+    Фотографии и стикеры (они отправляются как фотографии) идут в общие группы, документы - в
+    отдельные, так как Telegram не смешивает их с фотографиями; в каждой группе не больше
+    TG_MEDIA_GROUP_LIMIT элементов, а документы одной группы вместе не больше
+    mediasize.TG_REQUEST_LIMIT байт. Текст становится подписью первой группы, если помещается
+    в TG_CAPTION_LIMIT.
+
+    Параметры:
+        media_dict (dict): Вложения, собранные render_message.
+        text (str): Текст сообщения.
+
+    Возвращает:
+        tuple - (тексты для отдельных сообщений, список групп (тип, элементы, подпись))
+    """
+    # Фотографии Telegram скачивает сам по ссылкам, их размер в запрос не входит
+    photos = mediasize.split_batches(
+        media_dict.get("photo", []) + media_dict.get("sticker", []),
+        mediasize.TG_REQUEST_LIMIT,
+        lambda photo: 0,
+        TG_MEDIA_GROUP_LIMIT,
+    )
+    documents = mediasize.split_batches(
+        media_dict.get("doc", []),
+        mediasize.TG_REQUEST_LIMIT,
+        lambda document: 0 if document.file_id else document.size or 0,
+        TG_MEDIA_GROUP_LIMIT,
+    )
+    groups = [("photo", items, None) for items in photos] + [
+        ("doc", items, None) for items in documents
+    ]
+    if groups and text and len(text) <= TG_CAPTION_LIMIT:
+        kind, items, _ = groups[0]
+        groups[0] = (kind, items, text)
+        return [], groups
+    texts = pack_texts(text.splitlines(keepends=True), TEXT_LIMIT, "") if text else []
+    # Telegram не принимает сообщения из одних пробелов
+    return [text for text in texts if text.strip()], groups
+
+
+def get_username(vk_scheduler: VkScheduler, id=0) -> str:
     """
     Отправляет сообщение вк в телеграм.
     
     Параметры:
-        vk_session (vk_api.VkApi): Объект сессии.
+        vk_scheduler (VkScheduler): Планировщик вызовов API VK.
         id (int): id пользователя или группы.
 
     Возвращает:
         Фамилия Имя (str) 
     """
-    api = vk_session.get_api()
+    api = vk_scheduler.get_api()
     if id > 0:
         user_get = api.users.get(user_ids=id)[0]
         name = str(user_get["first_name"]) + " " + str(user_get["last_name"])
@@ -130,14 +646,54 @@ def get_username(vk_session: vk_api.VkApi, id=0) -> str:
     return name
 
 
-def get_forward_tree(message, depth: int, vk_session: vk_api.VkApi) -> str:
+def get_usernames(vk_scheduler: VkScheduler, ids: list) -> dict:
+    """
+    Получает имена нескольких пользователей и сообществ: один users.get и один groups.getById,
+    которые планировщик отправляет одним запросом execute.
+
+    Параметры:
+        vk_scheduler (VkScheduler): Планировщик вызовов API VK.
+        ids (list): id пользователей (> 0) и сообществ (< 0).
+
+    Возвращает:
+        dict - {id: имя}
+    """
+    user_ids = [str(id) for id in ids if id > 0]
+    group_ids = [str(-id) for id in ids if id < 0]
+    users = (
+        vk_scheduler.submit("users.get", {"user_ids": ",".join(user_ids)}) if user_ids else None
+    )
+    groups = (
+        vk_scheduler.submit("groups.getById", {"group_ids": ",".join(group_ids)})
+        if group_ids
+        else None
+    )
+    names = {}
+    if users is not None:
+        for user in users.result():
+            names[user["id"]] = str(user["first_name"]) + " " + str(user["last_name"])
+    if groups is not None:
+        for group in groups.result():
+            names[-group["id"]] = group["name"]
+    return names
+
+
+def render_message(
+    message,
+    name_cache: NameCache,
+    media_cache: MediaCache = None,
+    max_depth: int = MAX_FORWARD_DEPTH,
+) -> tuple:
     """
-    Функция возвращает дерево вложенных сообщений в текстовом формате
+    Функция за один обход (без рекурсии) возвращает дерево вложенных сообщений в текстовом
+    формате и все вложения дерева. Имена всех авторов загружаются одним пакетным запросом.
+    Сообщения глубже max_depth не показываются, вместо них выводится их количество.
 
     Параметры:
         message: Объект сообщения.
-        depth (int): Текущая глубина рекурсии.
-        vk_session (vk_api.VkApi): Объект сессии.
+        name_cache (NameCache): Кэш имён пользователей и сообществ.
+        media_cache (MediaCache): Кэш медиафайлов; файлы, уже известные Telegram, берутся по file_id.
+        max_depth (int): Максимальная глубина вложенности.
 
     Пример:
     Я пересылаю сообщение
@@ -145,68 +701,83 @@ def get_forward_tree(message, depth: int, vk_session: vk_api.VkApi) -> str:
     ||Более глубокая вложенность
 
     Возвращает:
-        str
-    """
-    # date_str = datetime.fromtimestamp(message["date"]).strftime("%d %b %Y")
-    # time_str = datetime.fromtimestamp(message["date"]).strftime("%H:%M:%S")
-    username = get_username(vk_session, message["from_id"])
-    author = (
-        "|" * depth
-        + (f"{username}: " if username != get_username(vk_session) else "")
-        # + " "
-        # + localized_text("fwd_written_at", BOT_LANGUAGE)[0]
-        # + " "
-        # + date_str
-        # + " "
-        # + localized_text("fwd_written_at", BOT_LANGUAGE)[1]
-        # + " "
-        # + time_str
-    )
-    tree = author
-    if message["text"]:
-        tree += message["text"] + "\n"
-    if message["attachments"]:
-        tree += f'<{len(message["attachments"])} вложений>' + "\n"
-    for forwarded in message.get("fwd_messages", []):
-        tree += get_forward_tree(forwarded, depth + 1, vk_session)
-    if message.get("reply_message"):
-        tree += get_forward_tree(message["reply_message"], depth + 1, vk_session)
-    return tree
+        tuple - (текст, словарь вложений по типам: photo, doc, sticker)
+    """
+    # Узлы в порядке вывода: сообщение, его пересланные сообщения, затем ответ
+    nodes = []  # (сообщение или None, глубина, количество скрытых сообщений)
+    stack = [(message, 0)]
+    while stack:
+        node, depth = stack.pop()
+        nodes.append((node, depth, 0))
+        children = list(node.get("fwd_messages", []))
+        if node.get("reply_message"):
+            children.append(node["reply_message"])
+        if depth >= max_depth:
+            if children:
+                nodes.append((None, depth + 1, len(children)))
+            continue
+        stack.extend((child, depth + 1) for child in reversed(children))
+
+    names = name_cache.get_many([0] + [node["from_id"] for node, _, _ in nodes if node])
+    parts = []
+    media_dict = {}
+    for node, depth, hidden in nodes:
+        if node is None:
+            parts.append("|" * depth + f"<ещё {hidden} пересланных сообщений>\n")
+            continue
+        username = names[node["from_id"]]
+        parts.append("|" * depth + (f"{username}: " if username != names[0] else ""))
+        if node["text"]:
+            parts += [node["text"], "\n"]
+        if node.get("attachments"):
+            parts.append(f'<{len(node["attachments"])} вложений>' + "\n")
+            collect_attachments(node["attachments"], media_dict, media_cache)
+    return "".join(parts), media_dict
 
 
-def get_all_attachments(message, attachments_dict: dict) -> None:
+def collect_attachments(
+    attachments: list, attachments_dict: dict, media_cache: MediaCache = None
+) -> None:
     """
-    Функция получает фото, видео и стикеры из всех вложенных сообщений, они динамически добавляются в attachments_array
+    Функция добавляет фото, документы и стикеры одного сообщения в attachments_dict
 
     Параметры:
-        message: Объект сообщения.
+        attachments (list): Вложения сообщения VK.
         attachments_dict (dict): Словарь, в который будут добавлены вложения.
+        media_cache (MediaCache): Кэш медиафайлов; файлы, уже известные Telegram, берутся по file_id.
+            У каждого вложения есть атрибут cache_key - ключ кэша.
     Возвращает:
         None
     """
-    if message["attachments"]:
-        for attachment in message["attachments"]:
-            if attachment["type"] == "photo":
-                image_url = attachment["photo"]["sizes"][-1]["url"]
-                attachments_dict.setdefault("photo", []).append(
-                    telebot.types.InputMediaPhoto(media=image_url)
-                )
-            if attachment["type"] == "doc":
-                doc_info = attachment["doc"]
-                doc_url = doc_info["url"]
-                response = requests.get(doc_url)
-                file_data = io.BytesIO(response.content)
-                file_data.name = doc_info["title"]
-                attachments_dict.setdefault("doc", []).append(
-                    telebot.types.InputMediaDocument(media=file_data)
-                )
-            if attachment["type"] == "sticker":
-                sticker_url = attachment["sticker"]["images"][-1]["url"]
-                attachments_dict.setdefault("sticker", []).append(
-                    telebot.types.InputMediaPhoto(media=sticker_url)
-                )
 
-    for forwarded in message.get("fwd_messages", []):
-        get_all_attachments(forwarded, attachments_dict)
-    if message.get("reply_message"):
-        get_all_attachments(message["reply_message"], attachments_dict)
+    # Функция возвращает file_id Telegram для вложения VK, если файл уже пересылался
+    def cached(cache_key):
+        return media_cache.get(cache_key) if media_cache is not None else None
+
+    for attachment in attachments:
+        if attachment["type"] == "photo":
+            photo_info = attachment["photo"]
+            cache_key = f"vk:photo{photo_info['owner_id']}_{photo_info['id']}"
+            image_url = mediasize.pick_vk_size(photo_info["sizes"])["url"]
+            media = telebot.types.InputMediaPhoto(media=cached(cache_key) or image_url)
+            media.cache_key = cache_key
+            attachments_dict.setdefault("photo", []).append(media)
+        if attachment["type"] == "doc":
+            doc_info = attachment["doc"]
+            cache_key = f"vk:doc{doc_info['owner_id']}_{doc_info['id']}"
+            attachments_dict.setdefault("doc", []).append(
+                transfer.RemoteFile(
+                    doc_info["url"],
+                    doc_info["title"],
+                    doc_info.get("size"),
+                    cache_key,
+                    cached(cache_key),
+                )
+            )
+        if attachment["type"] == "sticker":
+            sticker_info = attachment["sticker"]
+            cache_key = f"vk:sticker{sticker_info['sticker_id']}"
+            sticker_url = mediasize.pick_vk_size(sticker_info["images"])["url"]
+            media = telebot.types.InputMediaPhoto(media=cached(cache_key) or sticker_url)
+            media.cache_key = cache_key
+            attachments_dict.setdefault("sticker", []).append(media)
@@ -0,0 +1,170 @@
+"""
+Этот модуль содержит приём обновлений Telegram через webhook вместо длинного опроса.
+Встроенный HTTP-сервер принимает обновления от Telegram, проверяет секретный токен
+(заголовок X-Telegram-Bot-Api-Secret-Token) и передаёт их в ограниченный пул потоков.
+Обновления одного чата попадают в один поток, поэтому их порядок сохраняется. Ответ 200
+отправляется только после обработки обновления (сообщение записано в журнал исходящих
+сообщений); если очередь потока переполнена или обработка не закончилась за
+WEBHOOK_REPLY_TIMEOUT, сервер отвечает 503 и Telegram повторит доставку позже (повтор
+отсеивает журнал по ключу идемпотентности). Несколько экземпляров могут стоять за
+балансировщиком нагрузки.
+
+Классы:
+- WebhookConfig(url, secret, host, port, workers, queue_size):
+  Параметры webhook.
+
+Функции:
+- serve_webhook(bot, config, handle):
+  Регистрирует webhook в Telegram и принимает обновления, передавая их обработчикам бота
+  или функции handle(update, done).
+
+Использование:
+- serve_webhook(bot, WebhookConfig("https://example.com/telegram", secret)) вместо bot.polling.
+"""
+
+import hmac
+import json
+import logging
+import queue
+import secrets
+import threading
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, NamedTuple, Optional
+from urllib.parse import urlsplit
+
+import telebot
+
+# Количество потоков обработки обновлений
+WEBHOOK_WORKERS = 4
+# Максимальное количество обновлений в очереди одного потока
+WEBHOOK_QUEUE_SIZE = 1000
+# Максимальный размер тела обновления в байтах
+MAX_UPDATE_SIZE = 1024 * 1024
+# Сколько секунд запрос ждёт обработки обновления, прежде чем ответить 503
+WEBHOOK_REPLY_TIMEOUT = 30
+
+
+class WebhookConfig(NamedTuple):
+    """
+    Параметры webhook Telegram.
+    url - публичный адрес, который Telegram вызывает для доставки обновлений;
+    secret - секретный токен (1-256 символов A-Z, a-z, 0-9, _ и -), без него создаётся случайный;
+    host и port - адрес встроенного HTTP-сервера.
+    """
+
+    url: str
+    secret: Optional[str] = None
+    host: str = "0.0.0.0"
+    port: int = 8443
+    workers: int = WEBHOOK_WORKERS
+    queue_size: int = WEBHOOK_QUEUE_SIZE
+
+
+def _chat_id(update: dict) -> int:
+    for key in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        if key in update:
+            return update[key]["chat"]["id"]
+    return 0
+
+
+def serve_webhook(
+    bot: telebot.TeleBot,
+    config: WebhookConfig,
+    handle: Callable[[dict, Callable[[], None]], None] = None,
+) -> None:
+    """
+    Регистрирует webhook в Telegram и принимает обновления. Не возвращает управление.
+
+    Параметры:
+        bot (telebot.TeleBot): Объект бота Telegram с зарегистрированными обработчиками.
+        config (WebhookConfig): Параметры webhook.
+        handle (Callable): Получает обновление в формате JSON и функцию подтверждения вместо
+            обработчиков бота (в многопроцессном режиме обновление передаётся
+            процессу-обработчику). Подтверждение вызывается, когда сообщение записано в журнал;
+            только после него Telegram получает ответ 200.
+
+    Возвращает:
+        None
+    """
+    secret = config.secret or secrets.token_urlsafe(32)
+    path = urlsplit(config.url).path or "/"
+    queues = [queue.Queue(maxsize=config.queue_size) for _ in range(config.workers)]
+    stopped = threading.Event()
+
+    def process(update: dict, done: Callable[[], None]) -> None:
+        bot.process_new_updates([telebot.types.Update.de_json(update)])
+        done()
+
+    def work(updates: queue.Queue) -> None:
+        while not stopped.is_set():
+            try:
+                update, done = updates.get(timeout=1)
+            except queue.Empty:
+                continue
+            try:
+                (handle or process)(update, done)
+            except Exception as e:
+                # Без подтверждения Telegram получит 503 и доставит обновление повторно
+                logging.error(f"Непредвиденная ошибка: {e}")
+
+    for updates in queues:
+        threading.Thread(target=work, args=(updates,), daemon=True).start()
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format: str, *args) -> None:
+            # Каждое обновление не пишется в лог
+            pass
+
+        def reply(self, status: int) -> None:
+            self.send_response(status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def do_POST(self) -> None:
+            if self.path.split("?")[0] != path:
+                self.reply(404)
+                return
+            token = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+            if not hmac.compare_digest(token.encode(), secret.encode()):
+                self.reply(403)
+                return
+            length = int(self.headers.get("Content-Length") or 0)
+            if length <= 0 or length > MAX_UPDATE_SIZE:
+                self.reply(400)
+                return
+            try:
+                update = json.loads(self.rfile.read(length))
+            except ValueError:
+                self.reply(400)
+                return
+            # Обновления одного чата обрабатываются одним потоком по порядку
+            updates = queues[zlib.crc32(str(_chat_id(update)).encode()) % len(queues)]
+            done = threading.Event()
+            try:
+                updates.put_nowait((update, done.set))
+            except queue.Full:
+                logging.warning("Очередь обновлений webhook переполнена")
+                self.reply(503)
+                return
+            # Telegram не удаляет обновление, пока не получит 200, поэтому ответ ждёт записи
+            # сообщения в журнал
+            if done.wait(WEBHOOK_REPLY_TIMEOUT):
+                self.reply(200)
+            else:
+                logging.warning("Обновление webhook не обработано вовремя")
+                self.reply(503)
+
+    server = ThreadingHTTPServer((config.host, config.port), Handler)
+    server.daemon_threads = True
+    try:
+        # Обновления, накопившиеся за время простоя, Telegram доставит после регистрации
+        bot.set_webhook(url=config.url, secret_token=secret, drop_pending_updates=False)
+        server.serve_forever()
+    finally:
+        # Порт освобождается, чтобы перезапущенный слушатель мог занять его снова
+        server.server_close()
+        # Потоки обработки завершаются после текущего обновления; перезапущенный слушатель
+        # создаст новые. Обновления, оставшиеся в очередях, Telegram доставит повторно: ответа
+        # 200 на них не было
+        stopped.set()